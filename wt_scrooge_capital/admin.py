@@ -2,12 +2,51 @@
 # File: wt_scrooge_capital/admin.py
 
 from django.contrib import admin
-from .models import Portfolio, StockPriceHistory, Transaction, UserProfile, Stock, WatchList
+from .models import Order, Portfolio, PortfolioSnapshot, PortfolioValuation, PriceBar, RealizedPnL, StockIndicators, StockPriceHistory, TaxLot, Transaction, UserProfile, Stock, WatchList
+
+
+
+class StockPriceHistoryAdmin(admin.ModelAdmin):
+    """
+        The daily records are derived data (import_prices, seed_bench) and the charts read PriceBar,
+        so they are shown read-only: a record added or edited here would never reach the bars
+    """
+    list_display = ['stock', 'date', 'open_price', 'close_price']
+    list_filter = ['date']
+
+
+    def has_add_permission(self, request):
+        """
+            new records come from the bars
+        """
+        return False
+
+
+    def has_change_permission(self, request, obj=None):
+        """
+            edits would not reach the bars
+        """
+        return False
+
+
+    def has_delete_permission(self, request, obj=None):
+        """
+            the records are rebuilt by the imports, not removed by hand
+        """
+        return False
+
 
 # Register your models here.
 admin.site.register(UserProfile)
 admin.site.register(Stock)
-admin.site.register(StockPriceHistory)
+admin.site.register(StockPriceHistory, StockPriceHistoryAdmin)
+admin.site.register(PriceBar)
+admin.site.register(StockIndicators)
 admin.site.register(Portfolio)
+admin.site.register(PortfolioValuation)
+admin.site.register(PortfolioSnapshot)
 admin.site.register(WatchList)
-admin.site.register(Transaction)
\ No newline at end of file
+admin.site.register(Transaction)
+admin.site.register(TaxLot)
+admin.site.register(RealizedPnL)
+admin.site.register(Order)
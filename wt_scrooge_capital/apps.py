@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WtScroogeCapitalConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "wt_scrooge_capital"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,229 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/backtest.py
+
+# Backtesting strategies over the stored daily price history
+
+# The closes of the universe are loaded from StockPriceHistory once into a
+# (days x stocks) matrix, forward filled over missing days. A strategy is a
+# function of that matrix and its parameters returning the position to hold
+# in every stock on every day, 1 (long) or 0 (flat), computed for all the
+# stocks at once with NumPy. STRATEGIES lists the built-in ones.
+#
+# The fills follow the rules of the order service (orders.py): long only, so
+# nothing is sold that isn't held, whole shares paid from cash at the day's
+# price, without fees. The capital is split equally across the stocks, each
+# stock buys as many whole shares as its cash pays for when its position
+# turns on and sells them all when it turns off, the leftover cash stays with
+# it. The signals are computed for the whole matrix at once; the fills loop
+# over the days only, with every stock of a day handled by one array
+# operation, so the cost of a backtest grows with the number of days, not
+# with the number of bars times the Python overhead per bar.
+#
+# sweep() runs a grid of parameter sets across a process pool. The matrix is
+# sent to each worker once, when the worker starts, and the parameter sets
+# are handed out in chunks. `manage.py backtest` runs sweeps from the command
+# line, the `backtest/` endpoint runs single backtests.
+
+
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import math
+
+import django
+import numpy as np
+import pandas as pd
+
+from .indicators import max_drawdown
+from .models import StockPriceHistory
+
+
+TRADING_DAYS = 252
+
+
+def rolling_mean(close, window):
+    """
+        return the trailing mean of every column, NaN where the window isn't full or holds a NaN
+    """
+    out = np.full(close.shape, np.nan)
+    if window <= 0 or len(close) < window:
+        return out
+    # running sums of the values and of the missing ones, so a NaN only spoils the windows holding it
+    padding = np.zeros((1, close.shape[1]))
+    cumsum = np.cumsum(np.vstack([padding, np.nan_to_num(close)]), axis=0)
+    missing = np.cumsum(np.vstack([padding, np.isnan(close)]), axis=0)
+    sums = cumsum[window:] - cumsum[:-window]
+    out[window - 1:] = np.where(missing[window:] - missing[:-window] > 0, np.nan, sums / window)
+    return out
+
+
+def sma_crossover(close, fast=10, slow=30):
+    """
+        long while the fast moving average is above the slow one
+    """
+    if not 0 < fast < slow:
+        raise ValueError("the fast window must be shorter than the slow one")
+    return rolling_mean(close, fast) > rolling_mean(close, slow)
+
+
+def momentum(close, lookback=20, threshold=0.0):
+    """
+        long while the return over the lookback is above the threshold
+    """
+    if lookback <= 0:
+        raise ValueError("the lookback must be positive")
+    out = np.zeros(close.shape, dtype=bool)
+    out[lookback:] = close[lookback:] / close[:-lookback] - 1 > threshold
+    return out
+
+
+def mean_reversion(close, window=20, k=2.0):
+    """
+        long from a close below the lower Bollinger band until a close back above the moving average
+    """
+    if window < 2:
+        raise ValueError("the window must be at least 2")
+    middle = rolling_mean(close, window)
+    deviation = np.full(close.shape, np.nan)
+    if len(close) >= window:
+        deviation[window - 1:] = np.lib.stride_tricks.sliding_window_view(close, window, axis=0).std(axis=-1)
+    # enter (1) below the band, exit (0) above the average, hold the last state in between
+    state = np.where(close < middle - k * deviation, 1.0, np.where(close > middle, 0.0, np.nan))
+    return pd.DataFrame(state).ffill().fillna(0).to_numpy() > 0
+
+
+# name -> (strategy, default parameters)
+STRATEGIES = {
+    'sma_crossover': (sma_crossover, {'fast': 10, 'slow': 30}),
+    'momentum': (momentum, {'lookback': 20, 'threshold': 0.0}),
+    'mean_reversion': (mean_reversion, {'window': 20, 'k': 2.0}),
+}
+
+
+def load_closes(stock_ids=None, start=None, end=None):
+    """
+        return (dates, stock ids, closes) of the stored daily history, closes is a days x stocks float64
+        matrix, forward filled and NaN before a stock's first record
+    """
+    rows = StockPriceHistory.objects.order_by()
+    if stock_ids is not None:
+        rows = rows.filter(stock_id__in=list(stock_ids))
+    if start:
+        rows = rows.filter(date__gte=start)
+    if end:
+        rows = rows.filter(date__lte=end)
+    data = list(rows.values_list('date', 'stock_id', 'close_price'))
+    if not data:
+        return np.array([], dtype='datetime64[D]'), [], np.empty((0, 0))
+
+    dates, stocks, closes = zip(*data)
+    dates, day_index = np.unique(np.array(dates, dtype='datetime64[D]'), return_inverse=True)
+    stocks, stock_index = np.unique(np.array(stocks), return_inverse=True)
+    matrix = np.full((len(dates), len(stocks)), np.nan)
+    matrix[day_index, stock_index] = np.array(closes, dtype=np.float64)
+    return dates, stocks.tolist(), pd.DataFrame(matrix).ffill().to_numpy()
+
+
+def simulate(close, positions, initial_cash=10_000.0):
+    """
+        return the equity curve of holding the positions, each day's position filled in whole shares at its close
+
+        every stock trades with its equal part of the cash, a stock without a price yet is not bought
+    """
+    days, columns = close.shape
+    if not columns:
+        return np.full(days, float(initial_cash))
+    positions = np.asarray(positions, dtype=bool)
+    cash = np.full(columns, initial_cash / columns)
+    shares = np.zeros(columns)
+    equity = np.empty(days)
+    for day in range(days):
+        price = close[day]
+        priced = ~np.isnan(price)
+        # sell everything of the stocks turning flat, then buy the ones turning long with their own cash
+        sell = priced & (shares > 0) & ~positions[day]
+        cash[sell] += shares[sell] * price[sell]
+        shares[sell] = 0
+        buy = priced & (shares == 0) & positions[day] & (price > 0)
+        shares[buy] = np.floor(cash[buy] / price[buy])
+        cash[buy] -= shares[buy] * price[buy]
+        equity[day] = cash.sum() + (shares[priced] * price[priced]).sum()
+    return equity
+
+
+def performance(equity, positions, periods_per_year=TRADING_DAYS):
+    """
+        return the total return, annualized Sharpe ratio, max drawdown, trades and exposure of a run
+    """
+    returns = np.diff(equity) / equity[:-1] if len(equity) > 1 else np.array([])
+    deviation = returns.std(ddof=1) if len(returns) > 1 else 0.0
+    positions = np.asarray(positions, dtype=np.int8)
+    return {
+        'total_return': float(equity[-1] / equity[0] - 1) if len(equity) else 0.0,
+        'sharpe': float(returns.mean() / deviation * math.sqrt(periods_per_year)) if deviation > 0 else 0.0,
+        'max_drawdown': max_drawdown(equity),
+        'trades': int(np.abs(np.diff(positions, axis=0, prepend=0)).sum()),
+        'exposure': float(positions.mean()) if positions.size else 0.0,
+    }
+
+
+def run_backtest(close, strategy, params=None, initial_cash=10_000.0):
+    """
+        backtest a strategy by name over a closes matrix, returns its performance and equity curve
+    """
+    function, defaults = STRATEGIES[strategy]
+    params = {**defaults, **(params or {})}
+    positions = function(close, **params)
+    equity = simulate(close, positions, initial_cash)
+    return {'strategy': strategy, 'params': params, **performance(equity, positions), 'equity': equity}
+
+
+def param_grid(grid):
+    """
+        return every combination of a {parameter: [values]} grid as a list of dicts
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# the closes of the sweep, set once in every worker process
+_sweep_close = None
+
+
+def _init_sweep(close):
+    """
+        keep the closes in the worker so they're only sent once
+    """
+    global _sweep_close
+    django.setup()
+    _sweep_close = close
+
+
+def _sweep_chunk(strategy, param_sets):
+    """
+        backtest a chunk of parameter sets in a worker, the equity curves stay behind
+    """
+    results = []
+    for params in param_sets:
+        try:
+            result = run_backtest(_sweep_close, strategy, params)
+        except ValueError:
+            continue
+        result.pop('equity')
+        results.append(result)
+    return results
+
+
+def sweep(close, strategy, param_sets, workers=1, chunk_size=16):
+    """
+        backtest every parameter set, best Sharpe ratio first, invalid parameter sets are skipped
+    """
+    chunks = [param_sets[i:i + chunk_size] for i in range(0, len(param_sets), max(1, chunk_size))]
+    if workers <= 1:
+        _init_sweep(close)
+        results = [result for chunk in chunks for result in _sweep_chunk(strategy, chunk)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep, initargs=(close,)) as pool:
+            futures = [pool.submit(_sweep_chunk, strategy, chunk) for chunk in chunks]
+            results = [result for future in futures for result in future.result()]
+    results.sort(key=lambda result: result['sharpe'], reverse=True)
+    return results
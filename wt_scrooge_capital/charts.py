@@ -0,0 +1,211 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/charts.py
+
+# Price chart building for the stock detail page
+
+# Charts are downsampled so they never send more than CHART_MAX_POINTS points,
+# and the rendered HTML fragment is cached per (stock, price version, names,
+# size).
+# The same window is also served as a compact JSON payload for browsers that
+# render the chart themselves (CHART_RENDER_MODE = "client").
+
+
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+import plotly.express as px
+from plotly.io import to_html
+
+from .models import PriceBar, Stock
+from .profiling import profiled
+from .versions import get_price_version, get_search_version
+
+
+CHART_WINDOW = datetime.timedelta(hours=12)  # span of bars shown on the graph
+CHART_WIDTH = 900
+CHART_HEIGHT = 600
+
+
+def chart_max_points():
+    """
+        return the most points a chart may send, set with the CHART_MAX_POINTS setting
+    """
+    return getattr(settings, "CHART_MAX_POINTS", 500)
+
+
+def chart_cache_timeout():
+    """
+        return how long a rendered chart stays cached, set with the CHART_CACHE_TIMEOUT setting
+    """
+    return getattr(settings, "CHART_CACHE_TIMEOUT", 60 * 60)
+
+
+def chart_render_mode():
+    """
+        return "server" (plotly HTML built here) or "client" (the page fetches the JSON series),
+        set with the CHART_RENDER_MODE setting
+    """
+    return getattr(settings, "CHART_RENDER_MODE", "server")
+
+
+def lttb_indices(x, y, threshold):
+    """
+        pick the indices of at most `threshold` points that keep the shape of the series
+        (Largest-Triangle-Three-Buckets), the first and last points are always kept
+
+        a threshold below 3 or above the number of points keeps everything
+    """
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)  # points per bucket, the first and last points get their own
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # the average of the next bucket is the third corner of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        # keep the point of this bucket that makes the largest triangle with the last kept point
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        indices.append(best)
+        a = best
+
+    indices.append(n - 1)
+    return indices
+
+
+def window_bars(stock):
+    """
+        return the (timestamp, open, high, low, close, volume) rows of the chart window ending at the
+        stock's latest bar, oldest first
+
+        the window is half-open, (latest - CHART_WINDOW, latest], so 12 hours of hourly bars are 12 bars
+    """
+    bars = PriceBar.objects.for_stock(stock)
+    latest_bar = bars.order_by('-timestamp').values_list('timestamp', flat=True).first()
+    if latest_bar is None:
+        return []
+
+    return list(
+        bars.filter(timestamp__gt=latest_bar - CHART_WINDOW).order_by('timestamp')
+        .values_list('timestamp', 'open_price', 'high_price', 'low_price', 'close_price', 'volume')
+    )
+
+
+def downsample_bars(rows, max_points):
+    """
+        reduce the window rows to at most max_points, shaped on the close price
+    """
+    keep = lttb_indices([row[0].timestamp() for row in rows], [float(row[4]) for row in rows], max_points)
+    return [rows[i] for i in keep]
+
+
+@profiled('chart')
+def build_price_chart(stock, width=CHART_WIDTH, height=CHART_HEIGHT, max_points=None):
+    """
+        build the price graph for the window of bars ending at the stock's latest bar
+
+        returns a dict with the chart HTML and the window's max and min price, or None if there are no bars
+    """
+    rows = window_bars(stock)
+    if not rows:
+        return None
+    max_price = max(row[2] for row in rows)
+    min_price = min(row[3] for row in rows)
+
+    # downsample before anything is handed to plotly
+    rows = downsample_bars(rows, chart_max_points() if max_points is None else max_points)
+    times = [(timezone.localtime(row[0]) if timezone.is_aware(row[0]) else row[0]).strftime("%H:%M") for row in rows]
+    prices = [float(row[4]) for row in rows]
+    line_color = 'rgb(0, 200, 5)' if prices[-1] > prices[0] else 'rgb(255, 80, 0)'
+
+    price_chart = px.line(
+        x=times,
+        y=prices,
+        labels={"x": "Hour", "y": "Price ($)"},
+        title=f"{stock.company_name} ({stock.ticker}) - 12-Hour Price History",
+    )
+    price_chart.update_traces(
+        mode="lines+markers",
+        line=dict(color=line_color),
+    )
+    price_chart.update_layout(
+        width=width,
+        height=height,
+        # plot_bgcolor="rgba(30, 30, 30, 1)",
+        title_font=dict(size=18),
+        xaxis_title_font=dict(size=14),
+        yaxis_title_font=dict(size=14),
+    )
+
+    return {
+        # plotly.js itself is loaded from the CDN instead of being inlined into every page
+        'html': to_html(price_chart, full_html=False, include_plotlyjs='cdn'),
+        'max_price': max_price,
+        'min_price': min_price,
+    }
+
+
+def get_price_chart(stock, width=CHART_WIDTH, height=CHART_HEIGHT):
+    """
+        return the cached price graph of a stock, building it on a miss
+    """
+    max_points = chart_max_points()
+    # the title shows the names, a renamed or re-ticked stock gets a new key
+    names = hashlib.md5(f"{stock.ticker}:{stock.company_name}".encode(), usedforsecurity=False).hexdigest()[:8]
+    key = f"wt_scrooge_capital:price-chart:{stock.pk}:{get_price_version(stock.pk)}:{names}:{width}x{height}:{max_points}"
+    chart = cache.get(key)
+    if chart is None:
+        chart = build_price_chart(stock, width, height, max_points)
+        # stocks without bars are cached too, as an empty dict
+        cache.set(key, chart or {}, chart_cache_timeout())
+    return chart or None
+
+
+@profiled('series')
+def build_price_series(stock, max_points):
+    """
+        build the compact chart-data payload of a stock: one array per OHLCV column, times in epoch seconds
+    """
+    rows = window_bars(stock)
+    series = {
+        'ticker': stock.ticker,
+        'company_name': stock.company_name,
+        'max_price': float(max(row[2] for row in rows)) if rows else None,
+        'min_price': float(min(row[3] for row in rows)) if rows else None,
+    }
+    rows = downsample_bars(rows, max_points)
+    series['t'] = [int(row[0].timestamp()) for row in rows]
+    for i, column in enumerate(('o', 'h', 'l', 'c'), start=1):
+        series[column] = [float(row[i]) for row in rows]
+    series['v'] = [row[5] for row in rows]
+    return series
+
+
+def get_price_series(stock_id, max_points):
+    """
+        return the cached chart-data payload of a stock, or None if the stock doesn't exist
+    """
+    # the payload carries the names too, the search version moves when a stock is renamed
+    key = f"wt_scrooge_capital:price-series:{stock_id}:{get_price_version(stock_id)}:{get_search_version()}:{max_points}"
+    series = cache.get(key)
+    if series is None:
+        stock = Stock.objects.filter(pk=stock_id).first()
+        if stock is None:
+            return None
+        series = build_price_series(stock, max_points)
+        cache.set(key, series, chart_cache_timeout())
+    return series
@@ -0,0 +1,242 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/fields.py
+
+# Custom model fields of the app
+
+# Price series are stored as packed binary instead of comma-separated text so
+# that reading a stock's history is a single memcpy rather than a split() and a
+# float() per value (int-cents series are converted value by value). Only
+# prices_as_numpy avoids the copy, by viewing the blob in place. Every blob
+# starts with a small header:
+#
+#     magic (2 bytes) | version (1 byte) | typecode (1 byte) | count (uint32)
+#
+# followed by `count` little-endian values. The typecode is 'd' for float64
+# prices or 'q' for int64 cents.
+
+
+import array
+import struct
+import sys
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import models
+
+
+PRICE_SERIES_MAGIC = b"PS"
+PRICE_SERIES_VERSION = 1
+PRICE_SERIES_HEADER = struct.Struct("<2sBcI")
+PRICE_SERIES_TYPECODES = ("d", "q")
+
+
+def parse_price_text(text):
+    """
+        parse the legacy comma-separated price text, with or without the surrounding "[]"
+    """
+    return array.array("d", (float(price) for price in text.strip().strip("[]").split(",") if price.strip()))
+
+
+def encode_prices(prices, typecode="d"):
+    """
+        pack a sequence of prices into the versioned binary format
+    """
+    if typecode not in PRICE_SERIES_TYPECODES:
+        raise ValueError(f"unsupported price series typecode: {typecode!r}")
+
+    if typecode == "q":
+        values = array.array("q", (round(float(price) * 100) for price in prices))
+    elif isinstance(prices, array.array) and prices.typecode == "d":
+        values = array.array("d", prices)
+    else:
+        values = array.array("d", (float(price) for price in prices))
+
+    if sys.byteorder != "little":
+        values.byteswap()
+
+    header = PRICE_SERIES_HEADER.pack(PRICE_SERIES_MAGIC, PRICE_SERIES_VERSION, typecode.encode(), len(values))
+    return header + values.tobytes()
+
+
+def price_series_payload(data):
+    """
+        validate the header of a packed price series and return (typecode, memoryview of the values)
+    """
+    data = memoryview(data)
+    if len(data) < PRICE_SERIES_HEADER.size:
+        raise ValueError("price series is shorter than its header")
+
+    magic, version, typecode, count = PRICE_SERIES_HEADER.unpack_from(data)
+    typecode = typecode.decode()
+    if magic != PRICE_SERIES_MAGIC or version != PRICE_SERIES_VERSION or typecode not in PRICE_SERIES_TYPECODES:
+        raise ValueError("unrecognised price series header")
+
+    payload = data[PRICE_SERIES_HEADER.size:]
+    if len(payload) != count * 8:
+        raise ValueError("price series length does not match its header")
+    return typecode, payload
+
+
+def decode_prices(data):
+    """
+        unpack a binary price series into an array.array of float prices, copying the values out of the blob
+    """
+    typecode, payload = price_series_payload(data)
+    values = array.array(typecode)
+    values.frombytes(payload)
+
+    if sys.byteorder != "little":
+        values.byteswap()
+    if typecode == "q":
+        values = array.array("d", (cents / 100 for cents in values))
+    return values
+
+
+def prices_as_numpy(data):
+    """
+        return a read-only NumPy float64 view of a binary price series without copying it
+
+        int-cents series have to be converted, so those come back as a new array
+    """
+    import numpy as np
+
+    typecode, payload = price_series_payload(data)
+    if typecode == "q":
+        return np.frombuffer(payload, dtype="<i8") / 100
+    return np.frombuffer(payload, dtype="<f8")
+
+
+class PriceSeriesField(models.BinaryField):
+    """
+        Model field that stores a price series as packed binary and exposes it as an array.array('d')
+    """
+    description = "Packed binary price series"
+
+
+    def __init__(self, *args, typecode="d", **kwargs):
+        """
+            set the storage typecode, the field is editable (as text) unlike a plain BinaryField
+        """
+        self.typecode = typecode
+        kwargs.setdefault("editable", True)
+        super().__init__(*args, **kwargs)
+
+
+    def deconstruct(self):
+        """
+            include the typecode in migrations
+        """
+        name, path, args, kwargs = super().deconstruct()
+        if self.typecode != "d":
+            kwargs["typecode"] = self.typecode
+        if kwargs.get("editable") is True:
+            del kwargs["editable"]
+        else:
+            kwargs["editable"] = False
+        return name, path, args, kwargs
+
+
+    def get_default(self):
+        """
+            default to an empty series
+        """
+        if self.has_default():
+            return self.to_python(super().get_default())
+        return array.array("d")
+
+
+    def from_db_value(self, value, expression, connection):
+        """
+            decode the stored bytes into an array of prices
+        """
+        if value is None:
+            return value
+        if not value:
+            return array.array("d")
+        return decode_prices(value)
+
+
+    def to_python(self, value):
+        """
+            accept arrays, sequences of prices, packed bytes, or legacy comma-separated text
+        """
+        if value is None or isinstance(value, array.array):
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            if not value:
+                return array.array("d")
+            try:
+                return decode_prices(value)
+            except ValueError as error:
+                raise ValidationError(str(error), code="invalid")
+        if isinstance(value, str):
+            try:
+                return parse_price_text(value)
+            except ValueError:
+                raise ValidationError("Enter prices as comma-separated numbers.", code="invalid")
+        return array.array("d", (float(price) for price in value))
+
+
+    def get_prep_value(self, value):
+        """
+            pack the prices before they are sent to the database
+        """
+        if value is None:
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value)
+        return encode_prices(self.to_python(value), self.typecode)
+
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        """
+            let BinaryField wrap the packed bytes for the backend
+        """
+        if not prepared:
+            value = self.get_prep_value(value)
+        return super().get_db_prep_value(value, connection, prepared=True)
+
+
+    def value_to_string(self, obj):
+        """
+            serialize the series as comma-separated text (fixtures, dumpdata)
+        """
+        value = self.value_from_object(obj)
+        return "" if value is None else ",".join(repr(price) for price in value)
+
+
+    def formfield(self, **kwargs):
+        """
+            edit the series as comma-separated text in forms and the admin
+        """
+        return models.Field.formfield(self, **{
+            "form_class": PriceSeriesFormField,
+            **kwargs,
+        })
+
+
+class PriceSeriesFormField(forms.CharField):
+    """
+        Form field for entering a price series as comma-separated text
+    """
+    widget = forms.Textarea
+
+
+    def prepare_value(self, value):
+        """
+            show the stored series as comma-separated text
+        """
+        if isinstance(value, (array.array, list, tuple)):
+            return ",".join(repr(float(price)) for price in value)
+        return value
+
+
+    def to_python(self, value):
+        """
+            parse the comma-separated text into an array of prices
+        """
+        value = super().to_python(value)
+        try:
+            return parse_price_text(value)
+        except ValueError:
+            raise ValidationError("Enter prices as comma-separated numbers.", code="invalid")
@@ -3,6 +3,8 @@
 
 # This file has all the forms used in the app
 
+import uuid
+
 from django import forms
 from .models import Stock, UserProfile
 from django.contrib.auth.models import User
@@ -80,13 +82,74 @@ class UpdateProfileForm(forms.ModelForm):
     
     class Meta:
         model = UserProfile
-        fields = ['first_name', 'last_name', 'email', 'dob']
+        fields = ['first_name', 'last_name', 'email', 'dob', 'lot_method']
+
+
+class StockAutocompleteInput(forms.TextInput):
+    """
+        A text input for a ticker that suggests stocks from the search endpoint as the user types
+
+        no options are rendered, the page stays the same size however many stocks are listed
+    """
+    template_name = 'wt_scrooge_capital/widgets/stock_autocomplete.html'
+
+
+    def get_context(self, name, value, attrs):
+        """
+            turn the browser's own autocomplete off and point the input at its suggestion list
+        """
+        context = super().get_context(name, value, attrs)
+        context['widget']['attrs'].setdefault('autocomplete', 'off')
+        context['widget']['attrs']['list'] = f"{context['widget']['attrs'].get('id', name)}-suggestions"
+        return context
+
+
+class TickerChoiceField(forms.ModelChoiceField):
+    """
+        A stock chosen by its ticker, in any case
+    """
+
+    def to_python(self, value):
+        """
+            look the stock up by its ticker, ignoring case and surrounding spaces
+        """
+        return super().to_python(value.strip().upper() if isinstance(value, str) else value)
 
 
 class BuySellForm(forms.Form):
     """
         Form for buying or selling stocks
     """
-    stock = forms.ModelChoiceField(queryset=Stock.objects.all(), label="Stock")
+    stock = TickerChoiceField(
+        queryset=Stock.objects.all(),
+        to_field_name='ticker',
+        widget=StockAutocompleteInput(attrs={'placeholder': "Ticker or company"}),
+        label="Stock",
+    )
     action = forms.ChoiceField(choices=[('buy', 'Buy'), ('sell', 'Sell')], label="Action")
-    shares = forms.IntegerField(min_value=1, label="Shares")
\ No newline at end of file
+    shares = forms.IntegerField(min_value=1, label="Shares")
+    # market orders trade now, limit and stop orders rest until the price reaches `price`
+    order_type = forms.ChoiceField(
+        choices=[('market', 'Market'), ('limit', 'Limit'), ('stop', 'Stop')],
+        initial='market',
+        required=False,
+        label="Order Type",
+    )
+    price = forms.DecimalField(min_value=0.01, max_digits=10, decimal_places=2, required=False, label="Limit/Stop Price")
+    # a fresh key per rendered form, so submitting the same form twice only trades once
+    idempotency_key = forms.CharField(
+        widget=forms.HiddenInput,
+        required=False,
+        max_length=64,
+        initial=lambda: uuid.uuid4().hex,
+    )
+
+
+    def clean(self):
+        """
+            limit and stop orders need a price
+        """
+        cleaned_data = super().clean()
+        if cleaned_data.get('order_type') in ('limit', 'stop') and cleaned_data.get('price') is None:
+            self.add_error('price', "Limit and stop orders need a price.")
+        return cleaned_data
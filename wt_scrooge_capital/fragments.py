@@ -0,0 +1,82 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/fragments.py
+
+# Versioned template fragment caching
+
+# The data parts of the home, stock list, portfolio and watchlist pages are
+# wrapped in Django's {% cache %} tag, varied on a version string built here:
+#
+#   user pages   the user's holdings version and the quote versions of the
+#                stocks they hold or watch
+#   stock pages  the stock list version
+#
+# Signals bump the versions when the data changes (signals.py), so a cached
+# fragment is reused exactly as long as nothing it shows has changed. Views
+# hand the templates lazy querysets, so a cache hit runs no query for the
+# fragment at all. The stock ids of a user's holdings are cached under the
+# holdings version too, so building the version string costs cache reads only.
+#
+# The version counters live in the cache, so every process must share one
+# (Redis, Memcached, database) for a bump in one process to reach the
+# fragments cached by the others. With the local-memory backend each process
+# keeps its own counters and only sees its own writes, which is fine for a
+# single-process development server only. FRAGMENT_CACHE_TIMEOUT sets how long
+# fragments live (default 600 seconds, 0 turns the caching off).
+
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+
+from .models import Portfolio, WatchList
+from .versions import get_holdings_version, get_quote_versions, get_stock_list_version
+
+
+def fragment_timeout():
+    """
+        return how long cached fragments live, in seconds
+    """
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600)
+
+
+def holdings_stock_ids(user_profile_id, holdings_version):
+    """
+        return the ids of the stocks a user holds or watches, cached under their holdings version
+    """
+    key = f"wt_scrooge_capital:holdings-stocks:{user_profile_id}:{holdings_version}"
+    stock_ids = cache.get(key)
+    if stock_ids is None:
+        held = Portfolio.objects.filter(user_id=user_profile_id).values_list('stock_id', flat=True)
+        watched = WatchList.objects.filter(user_id=user_profile_id).values_list('stock_id', flat=True)
+        stock_ids = sorted(held.union(watched))
+        cache.set(key, stock_ids, fragment_timeout())
+    return stock_ids
+
+
+def user_fragment_version(user_profile_id):
+    """
+        return the version string of fragments showing a user's holdings at current prices
+    """
+    holdings_version = get_holdings_version(user_profile_id)
+    quotes = get_quote_versions(holdings_stock_ids(user_profile_id, holdings_version))
+    digest = hashlib.md5(repr(sorted(quotes.items())).encode(), usedforsecurity=False).hexdigest()
+    return f"{user_profile_id}-{holdings_version}-{digest}"
+
+
+def stock_list_fragment_version():
+    """
+        return the version string of fragments listing stocks
+    """
+    return str(get_stock_list_version())
+
+
+def form_fragment_version(request):
+    """
+        return the CSRF secret of the request, for fragments with forms in them
+
+        the tokens rendered into a cached fragment stay valid as long as the secret doesn't change
+    """
+    get_token(request)
+    return request.META.get('CSRF_COOKIE', '')
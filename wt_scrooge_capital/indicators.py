@@ -0,0 +1,172 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/indicators.py
+
+# Technical indicators over a price series
+
+# Every function takes NumPy arrays and works on the whole series at once
+# (cumulative sums, sliding windows), there are no per-bar Python loops.
+# Rolling indicators return arrays as long as the input, with NaN where the
+# window isn't full yet. The recursive averages (EMA, RSI) use pandas' ewm,
+# which runs the recursion in C.
+
+
+import numpy as np
+import pandas as pd
+
+from .models import PriceBar
+
+
+def _rolling_sum(x, window):
+    """
+        return the sum over each trailing window, NaN before the first full window
+    """
+    x = np.asarray(x, dtype=np.float64)
+    out = np.full(x.shape, np.nan)
+    if window <= 0 or len(x) < window:
+        return out
+    cumsum = np.cumsum(np.insert(x, 0, 0.0))
+    out[window - 1:] = cumsum[window:] - cumsum[:-window]
+    return out
+
+
+def _rolling_std(x, window, ddof):
+    """
+        return the standard deviation over each trailing window, NaN before the first full window
+
+        computed on strided window views rather than running sums of squares, which lose precision
+    """
+    x = np.asarray(x, dtype=np.float64)
+    out = np.full(x.shape, np.nan)
+    if window <= ddof or len(x) < window:
+        return out
+    out[window - 1:] = np.lib.stride_tricks.sliding_window_view(x, window).std(axis=1, ddof=ddof)
+    return out
+
+
+def sma(x, window):
+    """
+        simple moving average
+    """
+    return _rolling_sum(x, window) / window
+
+
+def ema(x, span):
+    """
+        exponential moving average with smoothing 2 / (span + 1)
+    """
+    return pd.Series(np.asarray(x, dtype=np.float64)).ewm(span=span, adjust=False).mean().to_numpy()
+
+
+def vwap(price, volume):
+    """
+        cumulative volume-weighted average price, falls back to the plain average where no volume traded
+    """
+    price = np.asarray(price, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    traded = np.cumsum(volume)
+    weighted = np.cumsum(price * volume)
+    plain = np.cumsum(price) / np.arange(1, len(price) + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(traded > 0, weighted / traded, plain)
+
+
+def rsi(x, period=14):
+    """
+        relative strength index with Wilder's smoothing, NaN for the first `period` values
+    """
+    x = np.asarray(x, dtype=np.float64)
+    out = np.full(x.shape, np.nan)
+    if len(x) <= period:
+        return out
+
+    change = np.diff(x)
+    gains = pd.Series(np.clip(change, 0, None)).ewm(alpha=1 / period, adjust=False, min_periods=period).mean()
+    losses = pd.Series(np.clip(-change, 0, None)).ewm(alpha=1 / period, adjust=False, min_periods=period).mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        strength = gains.to_numpy() / losses.to_numpy()
+        out[1:] = np.where(losses.to_numpy() == 0, 100.0, 100 - 100 / (1 + strength))
+    out[1:period] = np.nan
+    return out
+
+
+def bollinger_bands(x, window=20, k=2.0):
+    """
+        return (middle, upper, lower) bands, k population standard deviations around the SMA
+    """
+    x = np.asarray(x, dtype=np.float64)
+    middle = sma(x, window)
+    deviation = _rolling_std(x, window, ddof=0)
+    return middle, middle + k * deviation, middle - k * deviation
+
+
+def log_returns(x):
+    """
+        return the log returns between consecutive prices (one shorter than the input)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    return np.diff(np.log(x))
+
+
+def rolling_volatility(x, window=20):
+    """
+        standard deviation of the log returns over each trailing window of `window` returns
+    """
+    out = np.full(np.asarray(x).shape, np.nan)
+    if window < 2:
+        return out
+    out[1:] = _rolling_std(log_returns(x), window, ddof=1)
+    return out
+
+
+def max_drawdown(x):
+    """
+        largest fall from a running peak, as a fraction of the peak (0.25 is a 25% drawdown)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return 0.0
+    peaks = np.maximum.accumulate(x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drawdowns = np.where(peaks > 0, (peaks - x) / peaks, 0.0)
+    return float(np.nanmax(drawdowns))
+
+
+def _last(values):
+    """
+        return the last value of an indicator as a float, or None if it isn't defined yet
+    """
+    if len(values) == 0 or np.isnan(values[-1]):
+        return None
+    return float(values[-1])
+
+
+def compute_indicators(close, volume, window=20, rsi_period=14):
+    """
+        return the latest value of every indicator for a close/volume series, keyed like StockIndicators
+    """
+    close = np.asarray(close, dtype=np.float64)
+    middle, upper, lower = bollinger_bands(close, window)
+    return {
+        'bars': len(close),
+        'sma': _last(sma(close, window)),
+        'ema': _last(ema(close, window)) if len(close) else None,
+        'vwap': _last(vwap(close, volume)),
+        'rsi': _last(rsi(close, rsi_period)),
+        'bollinger_upper': _last(upper),
+        'bollinger_lower': _last(lower),
+        'volatility': _last(rolling_volatility(close, window)),
+        'max_drawdown': max_drawdown(close) if len(close) else None,
+    }
+
+
+def load_series(stock_id, lookback):
+    """
+        return the close and volume arrays of a stock's latest `lookback` bars, oldest first
+    """
+    rows = (
+        PriceBar.objects.filter(stock_id=stock_id)
+        .order_by('-timestamp')
+        .values_list('close_price', 'volume')[:lookback]
+    )
+    data = np.array([(float(close), volume) for close, volume in rows], dtype=np.float64).reshape(-1, 2)[::-1]
+    return data[:, 0], data[:, 1]
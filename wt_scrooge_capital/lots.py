@@ -0,0 +1,178 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/lots.py
+
+# Tax lots and realized P&L
+
+# Every buy opens a TaxLot with the shares it bought and their price, every
+# sell closes shares of the open lots of the position. The user's lot method
+# picks which lots a sell closes and what cost it takes with it:
+#
+#   fifo     the oldest lots first, at their own prices
+#   lifo     the newest lots first, at their own prices
+#   average  the oldest lots first, at the average cost of the position
+#
+# The gain or loss of each sell is stored on its Transaction and added to a
+# RealizedPnL row per user and stock and to the user's PortfolioValuation, so
+# the P&L of a portfolio is read from one row per position (position_pnl)
+# instead of replaying its transactions. The order service (orders.py) loads
+# the open lots of the positions an order touches into a LotBook, changes them
+# in memory and writes them back in bulk, under the same account lock.
+
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import ExpressionWrapper, F
+
+from .models import Portfolio, RealizedPnL, TaxLot
+from .valuations import CENTS, MONEY
+
+
+def removed_cost(item, shares):
+    """
+        return the part of a position's cost basis that selling `shares` of it removes (average cost)
+    """
+    if shares >= item.shares:
+        return item.cost_basis
+    return (item.cost_basis * shares / item.shares).quantize(CENTS)
+
+
+class LotBook:
+    """
+        the open lots of some of a user's positions, changed in memory and written back in bulk
+    """
+
+    def __init__(self, user_profile, stock_ids, method=None):
+        self.user_profile = user_profile
+        self.method = method or user_profile.lot_method
+        self.open = defaultdict(list)  # stock id -> open lots, oldest first
+        lots = TaxLot.objects.filter(user=user_profile, stock_id__in=stock_ids, remaining_shares__gt=0)
+        for lot in lots.order_by('opened_on', 'id'):
+            self.open[lot.stock_id].append(lot)
+        self.created = []
+        self.changed = {}
+        self.realized = defaultdict(lambda: [0, Decimal(0), Decimal(0)])  # stock id -> shares, proceeds, P&L
+
+
+    def buy(self, stock, shares, price, opened_on):
+        """
+            open a lot for a buy, returns it so the caller can link its transaction
+        """
+        lot = TaxLot(
+            user=self.user_profile,
+            stock=stock,
+            opened_on=opened_on,
+            shares=shares,
+            remaining_shares=shares,
+            price=price,
+        )
+        self.open[stock.pk].append(lot)
+        self.created.append(lot)
+        return lot
+
+
+    def sell(self, item, shares, price):
+        """
+            close `shares` of a position's lots, returns the cost basis they remove and the realized P&L
+
+            `item` is the position before the sell
+        """
+        lots = self.open[item.stock_id]
+        left, lot_cost = shares, Decimal(0)
+        for lot in (reversed(lots) if self.method == 'lifo' else lots):
+            if not left:
+                break
+            taken = min(left, lot.remaining_shares)
+            lot.remaining_shares -= taken
+            lot_cost += taken * lot.price
+            left -= taken
+            if lot.pk:
+                self.changed[lot.pk] = lot
+        self.open[item.stock_id] = [lot for lot in lots if lot.remaining_shares]
+
+        if shares >= item.shares:
+            # closing the position takes all of its cost, whatever the rounding of the lots left
+            cost = item.cost_basis
+        elif self.method == 'average' or left:
+            # positions from before lots were kept may not have enough of them, fall back to their average
+            cost = removed_cost(item, shares)
+        else:
+            cost = min(lot_cost.quantize(CENTS), item.cost_basis)
+
+        proceeds = shares * price
+        pnl = (proceeds - cost).quantize(CENTS)
+        totals = self.realized[item.stock_id]
+        totals[0] += shares
+        totals[1] += proceeds
+        totals[2] += pnl
+        return cost, pnl
+
+
+    def save(self):
+        """
+            write the new and changed lots and the realized P&L, returns the P&L realized in total
+        """
+        TaxLot.objects.bulk_create(self.created)
+        TaxLot.objects.bulk_update(self.changed.values(), ['remaining_shares'])
+        if not self.realized:
+            return Decimal(0)
+
+        # the account is locked, adding to the rows read here can't lose a concurrent update
+        rows = {
+            row.stock_id: row
+            for row in RealizedPnL.objects.filter(user=self.user_profile, stock_id__in=list(self.realized))
+        }
+        for stock_id, (shares, proceeds, pnl) in self.realized.items():
+            row = rows.setdefault(stock_id, RealizedPnL(user=self.user_profile, stock_id=stock_id))
+            row.shares_sold += shares
+            row.proceeds += Decimal(proceeds).quantize(CENTS)
+            row.realized_pnl += pnl
+        RealizedPnL.objects.bulk_create(
+            rows.values(),
+            update_conflicts=True,
+            unique_fields=['user', 'stock'],
+            update_fields=['shares_sold', 'proceeds', 'realized_pnl'],
+        )
+        return sum(pnl for _, _, pnl in self.realized.values())
+
+
+def position_pnl(user_profile):
+    """
+        return the realized and unrealized P&L of each of the user's positions, including closed ones
+
+        reads one row per position and one per stock ever sold, never the transactions
+    """
+    positions = (
+        Portfolio.objects.filter(user=user_profile)
+        .select_related('stock')
+        .annotate(market_value=ExpressionWrapper(F('shares') * F('stock__current_price'), output_field=MONEY))
+    )
+    realized = {
+        row.stock_id: row for row in RealizedPnL.objects.filter(user=user_profile).select_related('stock')
+    }
+
+    report = []
+    for item in positions:
+        row = realized.pop(item.stock_id, None)
+        market_value = Decimal(item.market_value).quantize(CENTS)
+        report.append({
+            'ticker': item.stock.ticker,
+            'shares': item.shares,
+            'cost_basis': item.cost_basis,
+            'average_cost': (item.cost_basis / item.shares).quantize(CENTS),
+            'market_value': market_value,
+            'unrealized_pnl': market_value - item.cost_basis,
+            'realized_pnl': row.realized_pnl if row else Decimal(0),
+        })
+    for row in realized.values():
+        report.append({
+            'ticker': row.stock.ticker,
+            'shares': 0,
+            'cost_basis': Decimal(0),
+            'average_cost': None,
+            'market_value': Decimal(0),
+            'unrealized_pnl': Decimal(0),
+            'realized_pnl': row.realized_pnl,
+        })
+    report.sort(key=lambda position: position['ticker'])
+    return report
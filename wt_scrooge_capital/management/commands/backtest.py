@@ -0,0 +1,99 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/backtest.py
+
+# Backtests a strategy over the stored price history, sweeping parameters
+#
+#     manage.py backtest sma_crossover --param fast=5,10,20 --param slow=50,100,200 --workers 8
+#     manage.py backtest momentum --param lookback=5:60:5 --tickers AAPL MSFT --output sweep.json
+#
+# Every combination of the --param values is backtested across the whole
+# universe (or --tickers) on a process pool and the best parameter sets by
+# Sharpe ratio are printed. A value list is comma-separated or a
+# start:stop:step range.
+
+
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+import numpy as np
+
+from wt_scrooge_capital.backtest import STRATEGIES, load_closes, param_grid, sweep
+from wt_scrooge_capital.models import Stock
+
+
+def parse_values(text):
+    """
+        return the values of a --param, "1,2,3" or "start:stop:step", as ints where possible
+    """
+    if ':' in text:
+        start, stop, step = (float(part) for part in text.split(':'))
+        values = np.arange(start, stop + step / 2, step).round(10).tolist()
+    else:
+        values = [float(part) for part in text.split(',') if part.strip()]
+    return [int(value) if float(value).is_integer() else value for value in values]
+
+
+class Command(BaseCommand):
+    """
+        manage.py backtest
+    """
+    help = "Backtest a strategy over the stored daily price history, sweeping its parameters across a process pool."
+
+
+    def add_arguments(self, parser):
+        """
+            the strategy, its parameter grid, the universe and the tuning knobs
+        """
+        parser.add_argument('strategy', choices=sorted(STRATEGIES))
+        parser.add_argument('--param', action='append', default=[], help="name=values, repeat for every parameter.")
+        parser.add_argument('--tickers', nargs='*', help="Only backtest these tickers.")
+        parser.add_argument('--start', help="First day, YYYY-MM-DD.")
+        parser.add_argument('--end', help="Last day, YYYY-MM-DD.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes, 1 runs in-process.")
+        parser.add_argument('--chunk-size', type=int, default=16, help="Parameter sets handed to a worker at a time.")
+        parser.add_argument('--top', type=int, default=10, help="Results printed.")
+        parser.add_argument('--output', help="Write every result to this JSON file.")
+
+
+    def handle(self, *args, **options):
+        """
+            load the closes once, run the sweep and report the best parameter sets
+        """
+        grid = {}
+        for param in options['param']:
+            name, _, values = param.partition('=')
+            if not values:
+                raise CommandError(f"--param takes name=values, got {param!r}.")
+            grid[name.strip()] = parse_values(values)
+        param_sets = param_grid(grid)
+
+        stock_ids = None
+        if options['tickers']:
+            stock_ids = list(Stock.objects.filter(ticker__in=[t.upper() for t in options['tickers']]).values_list('pk', flat=True))
+        dates, stocks, close = load_closes(stock_ids, options['start'], options['end'])
+        if len(dates) < 2:
+            raise CommandError("Not enough price history to backtest.")
+
+        started = time.perf_counter()
+        # forked workers must not inherit the parent's open connections
+        connections.close_all()
+        results = sweep(close, options['strategy'], param_sets, options['workers'], options['chunk_size'])
+        seconds = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{len(param_sets)} parameter sets over {len(stocks)} stocks and {len(dates)} days "
+            f"in {seconds:.1f}s, {len(param_sets) - len(results)} invalid."
+        )
+        for result in results[:options['top']]:
+            params = ", ".join(f"{name}={value}" for name, value in result['params'].items())
+            self.stdout.write(
+                f"{params:<40} sharpe {result['sharpe']:>6.2f}  return {result['total_return']:>+8.2%}  "
+                f"drawdown {result['max_drawdown']:>6.2%}  trades {result['trades']:>6}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'strategy': options['strategy'], 'start': str(dates[0]), 'end': str(dates[-1]), 'results': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
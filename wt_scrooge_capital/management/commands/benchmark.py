@@ -0,0 +1,262 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/benchmark.py
+
+# End-to-end benchmark of every URL of the app
+#
+#     manage.py seed_bench
+#     manage.py benchmark --iterations 50 --output bench.json
+#     manage.py benchmark --baseline bench.json
+#
+# Each URL in urls.py is requested through the Django test client as one of
+# the seeded users, and the p50/p95/mean latency, the number of queries and
+# the peak memory allocated by the request are reported. The queries and the
+# memory are measured on a separate pass so their instrumentation doesn't
+# skew the timings. Everything the requests write is rolled back at the end.
+#
+# --output writes the results as JSON to diff between releases, --baseline
+# prints the change against such a file. A URL without an entry in REQUESTS
+# below is listed as skipped so new views don't go unmeasured silently.
+
+
+import json
+import platform
+import time
+import tracemalloc
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+import numpy as np
+
+from wt_scrooge_capital.models import Order, Portfolio, Stock, UserProfile, WatchList
+from wt_scrooge_capital.urls import urlpatterns
+
+
+def _remove_from_watchlist(client, ctx):
+    """
+        every removal needs a watchlist row to remove
+    """
+    item, _ = WatchList.objects.get_or_create(
+        user=ctx['profile'], stock=ctx['spare_stock'], defaults={'added_price': 1, 'current_price': 1}
+    )
+    return {'method': 'post', 'path': reverse('remove_from_watchlist', args=[item.pk])}
+
+
+def _cancel_order(client, ctx):
+    """
+        every cancellation needs an open order to cancel, priced so no tick fills it
+    """
+    order = Order.objects.create(
+        user=ctx['profile'], stock=ctx['stock'], side='buy', order_type='limit', price='0.01', shares=1
+    )
+    return {'method': 'post', 'path': reverse('cancel_order', args=[order.pk])}
+
+
+def _logout(client, ctx):
+    """
+        log back in after the previous logout
+    """
+    client.force_login(ctx['user'])
+    return {'method': 'post', 'path': reverse('logout')}
+
+
+# how to request each URL name, called before every timed request with the client and the context
+REQUESTS = {
+    'home': lambda client, ctx: {'method': 'get', 'path': reverse('home')},
+    'portfolio': lambda client, ctx: {'method': 'get', 'path': reverse('portfolio')},
+    'portfolio_pnl': lambda client, ctx: {'method': 'get', 'path': reverse('portfolio_pnl')},
+    'portfolio_risk': lambda client, ctx: {'method': 'get', 'path': reverse('portfolio_risk')},
+    'watchlist': lambda client, ctx: {'method': 'get', 'path': reverse('watchlist')},
+    'transactions': lambda client, ctx: {'method': 'get', 'path': reverse('transactions')},
+    'profile': lambda client, ctx: {'method': 'get', 'path': reverse('profile')},
+    'stock_detail': lambda client, ctx: {'method': 'get', 'path': reverse('stock_detail', args=[ctx['stock'].pk])},
+    'stock_series': lambda client, ctx: {'method': 'get', 'path': reverse('stock_series', args=[ctx['stock'].pk])},
+    'price_stream': lambda client, ctx: {'method': 'get', 'path': reverse('price_stream')},
+    'profiling_stats': lambda client, ctx: {'method': 'get', 'path': reverse('profiling_stats')},
+    'backtest': lambda client, ctx: {'method': 'get', 'path': reverse('backtest'), 'data': {'strategy': 'sma_crossover', 'fast': 5, 'slow': 20}},
+    'screener': lambda client, ctx: {
+        'method': 'get', 'path': reverse('screener'), 'data': {'price__gte': 50, 'change__gt': -0.5, 'sort': '-change', 'limit': 20},
+    },
+    'stock_search': lambda client, ctx: {'method': 'get', 'path': reverse('stock_search'), 'data': {'q': ctx['stock'].ticker[:3]}},
+    'stock_list': lambda client, ctx: {'method': 'get', 'path': reverse('stock_list')},
+    'login': lambda client, ctx: {'method': 'get', 'path': reverse('login')},
+    'signup': lambda client, ctx: {'method': 'get', 'path': reverse('signup')},
+    'add_to_watchlist': lambda client, ctx: {
+        'method': 'post', 'path': reverse('add_to_watchlist', args=[ctx['stock'].pk]),
+    },
+    'remove_from_watchlist': _remove_from_watchlist,
+    'cancel_order': _cancel_order,
+    'logout': _logout,
+    'batch_orders': lambda client, ctx: {
+        'method': 'post',
+        'path': reverse('batch_orders'),
+        'data': json.dumps([{'ticker': ctx['stock'].ticker, 'action': 'buy', 'shares': 1}] * 10),
+        'content_type': 'application/json',
+    },
+    'portfolio_order': lambda client, ctx: {
+        'method': 'post',
+        'path': reverse('portfolio'),
+        'data': {'stock': ctx['stock'].ticker, 'action': 'buy', 'shares': 1},
+    },
+    'portfolio_limit_order': lambda client, ctx: {
+        'method': 'post',
+        'path': reverse('portfolio'),
+        'data': {'stock': ctx['stock'].ticker, 'action': 'buy', 'shares': 1, 'order_type': 'limit', 'price': '0.01'},
+    },
+}
+
+
+def send(client, request):
+    """
+        send a request described by a REQUESTS entry, returns the response
+    """
+    request = dict(request)
+    method = getattr(client, request.pop('method'))
+    return method(request.pop('path'), **request)
+
+
+def percentile(values, q):
+    """
+        return the q-th percentile of the values in milliseconds
+    """
+    return round(float(np.percentile(values, q)) * 1000, 3)
+
+
+class Command(BaseCommand):
+    """
+        manage.py benchmark
+    """
+    help = "Request every URL as a seeded user and report latency percentiles, query counts and peak memory."
+
+
+    def add_arguments(self, parser):
+        """
+            the number of runs, the user to run as and where the results go
+        """
+        parser.add_argument('--iterations', type=int, default=30, help="Timed requests per URL.")
+        parser.add_argument('--warmup', type=int, default=3, help="Untimed requests per URL first.")
+        parser.add_argument('--prefix', default="B", help="Prefix of the data seeded by seed_bench.")
+        parser.add_argument('--only', nargs='*', help="Only benchmark these URL names.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--baseline', help="Compare with the results in this JSON file.")
+
+
+    def handle(self, *args, **options):
+        """
+            run the benchmark, print it and write the JSON
+        """
+        profile = UserProfile.objects.filter(user__username=f"{options['prefix'].lower()}-user-0").select_related('user').first()
+        held = Portfolio.objects.filter(user=profile).select_related('stock').first() if profile else None
+        if held is None:
+            raise CommandError("No seeded user with a portfolio found, run `manage.py seed_bench` first.")
+        spare_stock = Stock.objects.exclude(watchlist__user=profile).first()
+        ctx = {'user': profile.user, 'profile': profile, 'stock': held.stock, 'spare_stock': spare_stock}
+
+        names = [pattern.name for pattern in urlpatterns if pattern.name] + ['portfolio_order', 'portfolio_limit_order']
+        if options['only']:
+            names = [name for name in names if name in options['only']]
+
+        setup_test_environment()
+        try:
+            results = {}
+            with transaction.atomic():
+                client = Client()
+                for name in names:
+                    if name in REQUESTS:
+                        # every URL starts logged in, whatever the previous one did to the session
+                        client.force_login(profile.user)
+                        results[name] = self.measure(client, ctx, REQUESTS[name], options['iterations'], options['warmup'])
+                        self.stdout.write(self.format_row(name, results[name]))
+                transaction.set_rollback(True)
+        finally:
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'results': results,
+            'skipped': [name for name in names if name not in REQUESTS],
+        }
+        for name in report['skipped']:
+            self.stdout.write(self.style.WARNING(f"{name}: skipped, no request defined"))
+
+        if options['baseline']:
+            self.compare(report, options['baseline'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+
+    def measure(self, client, ctx, make_request, iterations, warmup):
+        """
+            return the latency, query and memory figures of one URL
+        """
+        for _ in range(warmup):
+            send(client, make_request(client, ctx))
+
+        timings = []
+        for _ in range(iterations):
+            request = make_request(client, ctx)
+            started = time.perf_counter()
+            response = send(client, request)
+            timings.append(time.perf_counter() - started)
+
+        # one instrumented request for the query count and the peak memory
+        request = make_request(client, ctx)
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                send(client, request)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'method': request['method'].upper(),
+            'path': request['path'],
+            'status': response.status_code,
+            'p50_ms': percentile(timings, 50),
+            'p95_ms': percentile(timings, 95),
+            'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+            'queries': len(queries),
+            'peak_kib': round(peak / 1024, 1),
+        }
+
+
+    def format_row(self, name, result):
+        """
+            return one result as a line of text
+        """
+        return (
+            f"{name:<24} {result['method']:<5} {result['status']:>3}  p50 {result['p50_ms']:>8.2f} ms  "
+            f"p95 {result['p95_ms']:>8.2f} ms  {result['queries']:>3} queries  {result['peak_kib']:>8.1f} KiB"
+        )
+
+
+    def compare(self, report, path):
+        """
+            print the change of every figure against a previous run
+        """
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\nChange against {path}"))
+        for name, result in report['results'].items():
+            if name not in baseline:
+                self.stdout.write(f"{name:<24} new")
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'queries', 'peak_kib'):
+                old, new = baseline[name][key], result[key]
+                change = f"{(new - old) / old * 100:+.0f}%" if old else f"{new - old:+g}"
+                changes.append(f"{key} {old:g} -> {new:g} ({change})")
+            self.stdout.write(f"{name:<24} " + ", ".join(changes))
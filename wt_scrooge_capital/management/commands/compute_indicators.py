@@ -0,0 +1,106 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/compute_indicators.py
+
+# Precomputes the technical indicators of every stock into StockIndicators
+#
+#     manage.py compute_indicators --workers 8
+#
+# Stocks are split into chunks and handed to a process pool. Each worker opens
+# its own database connection, loads the bars of its stocks and computes the
+# indicators with NumPy, the parent process writes all results back with one
+# upsert per chunk. The stock detail page only reads the stored row.
+
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from wt_scrooge_capital.indicators import compute_indicators, load_series
+from wt_scrooge_capital.models import Stock, StockIndicators
+
+
+INDICATOR_FIELDS = [
+    'computed_at', 'bars', 'sma', 'ema', 'vwap', 'rsi',
+    'bollinger_upper', 'bollinger_lower', 'volatility', 'max_drawdown',
+]
+
+
+def _init_worker():
+    """
+        make sure the worker has Django set up and doesn't reuse the parent's connections
+    """
+    django.setup()
+    connections.close_all()
+
+
+def compute_chunk(stock_ids, lookback, window):
+    """
+        compute the indicators of a chunk of stocks, returns a list of (stock id, indicators)
+    """
+    return [(stock_id, compute_indicators(*load_series(stock_id, lookback), window=window)) for stock_id in stock_ids]
+
+
+class Command(BaseCommand):
+    """
+        manage.py compute_indicators
+    """
+    help = "Precompute the technical indicators of every stock across a process pool."
+
+
+    def add_arguments(self, parser):
+        """
+            tickers to limit the run to and the tuning knobs
+        """
+        parser.add_argument('tickers', nargs='*', help="Only compute these tickers.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes, 1 runs in-process.")
+        parser.add_argument('--chunk-size', type=int, default=50, help="Stocks handed to a worker at a time.")
+        parser.add_argument('--lookback', type=int, default=5000, help="Latest bars each stock is computed over.")
+        parser.add_argument('--window', type=int, default=20, help="Window of the rolling indicators.")
+
+
+    def handle(self, *args, **options):
+        """
+            compute and store the indicators, reporting the stocks per second
+        """
+        stocks = Stock.objects.order_by('pk')
+        if options['tickers']:
+            stocks = stocks.filter(ticker__in=[ticker.upper() for ticker in options['tickers']])
+        stock_ids = list(stocks.values_list('pk', flat=True))
+        size = max(1, options['chunk_size'])
+        chunks = [stock_ids[i:i + size] for i in range(0, len(stock_ids), size)]
+        started = time.perf_counter()
+
+        if options['workers'] <= 1:
+            results = (compute_chunk(chunk, options['lookback'], options['window']) for chunk in chunks)
+            self.store_all(results)
+        else:
+            # forked workers must not inherit the parent's open connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+                futures = [pool.submit(compute_chunk, chunk, options['lookback'], options['window']) for chunk in chunks]
+                self.store_all(future.result() for future in futures)
+
+        seconds = time.perf_counter() - started
+        rate = len(stock_ids) / seconds if seconds else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Computed indicators for {len(stock_ids)} stocks in {seconds:.1f}s ({rate:,.0f} stocks/s)."
+        ))
+
+
+    def store_all(self, results):
+        """
+            upsert every chunk of results as it arrives
+        """
+        for chunk in results:
+            now = timezone.now()
+            StockIndicators.objects.bulk_create(
+                [StockIndicators(stock_id=stock_id, computed_at=now, **values) for stock_id, values in chunk],
+                update_conflicts=True,
+                unique_fields=['stock'],
+                update_fields=INDICATOR_FIELDS,
+            )
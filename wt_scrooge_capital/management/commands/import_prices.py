@@ -0,0 +1,263 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/import_prices.py
+
+# Streams market data files into Stock, PriceBar and StockPriceHistory
+#
+#     manage.py import_prices bars.csv more_bars.jsonl 2024.parquet --chunk-size 100000
+#
+# Each file is read chunk by chunk with pandas and pushed through a small
+# generator pipeline (read -> clean -> upsert), so memory stays constant however
+# large the file is. Expected columns are ticker, timestamp, open, high, low,
+# close and optionally volume and company_name. Stocks are upserted on ticker
+# and bars on (stock, timestamp) with bulk_create(update_conflicts=True), so a
+# file can be re-imported safely. The daily StockPriceHistory records that the
+# backtests, the risk report and the screener read are rebuilt from the bars
+# of every (stock, day) a chunk touched, so a day split across chunks or files
+# still ends up whole. The bulk writes send no signals, so the cache versions
+# of the touched stocks are bumped once each chunk commits.
+
+
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import pandas as pd
+
+from wt_scrooge_capital.models import PriceBar, Stock, StockPriceHistory
+from wt_scrooge_capital.prices import update_prices
+from wt_scrooge_capital.versions import bump_stock_versions
+
+
+REQUIRED_COLUMNS = ['ticker', 'timestamp', 'open', 'high', 'low', 'close']
+FORMATS = {
+    '.csv': 'csv',
+    '.csv.gz': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.jsonl.gz': 'jsonl',
+    '.parquet': 'parquet',
+}
+
+
+def detect_format(path):
+    """
+        return the file format from the file name
+    """
+    for suffix, file_format in FORMATS.items():
+        if path.lower().endswith(suffix):
+            return file_format
+    raise CommandError(f"Can't tell the format of {path}, pass --format.")
+
+
+def read_chunks(path, file_format, chunk_size):
+    """
+        yield the file as DataFrames of at most chunk_size rows
+    """
+    if file_format == 'csv':
+        yield from pd.read_csv(path, chunksize=chunk_size)
+    elif file_format == 'jsonl':
+        yield from pd.read_json(path, lines=True, chunksize=chunk_size)
+    elif file_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise CommandError("Reading Parquet files needs pyarrow (pip install pyarrow).")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise CommandError(f"Unknown format: {file_format}")
+
+
+def clean_chunks(chunks):
+    """
+        normalise the column names and types of every chunk, dropping rows without a price
+    """
+    for chunk in chunks:
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise CommandError(f"Missing columns: {', '.join(missing)}")
+
+        chunk = chunk.dropna(subset=REQUIRED_COLUMNS).copy()
+        chunk['ticker'] = chunk['ticker'].astype(str).str.strip().str.upper()
+        chunk['timestamp'] = pd.to_datetime(chunk['timestamp'], utc=True)
+        if not settings.USE_TZ:
+            chunk['timestamp'] = chunk['timestamp'].dt.tz_localize(None)
+        for column in ('open', 'high', 'low', 'close'):
+            chunk[column] = chunk[column].astype(float).round(2)
+        chunk['volume'] = chunk['volume'].fillna(0).astype('int64') if 'volume' in chunk.columns else 0
+        yield chunk
+
+
+class Command(BaseCommand):
+    """
+        manage.py import_prices
+    """
+    help = "Stream CSV, JSONL or Parquet market data into stocks and price bars."
+
+
+    def add_arguments(self, parser):
+        """
+            files to import and the tuning knobs
+        """
+        parser.add_argument('paths', nargs='+', help="Files to import.")
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help="Override the detected file format.")
+        parser.add_argument('--chunk-size', type=int, default=50_000, help="Rows read from a file at a time.")
+        parser.add_argument('--batch-size', type=int, default=5_000, help="Rows per INSERT statement.")
+        parser.add_argument(
+            '--update-prices',
+            action='store_true',
+            help="Set each stock's current price to its latest imported close.",
+        )
+
+
+    def handle(self, *args, **options):
+        """
+            import every file and report the throughput
+        """
+        self.stock_ids = {}
+        self.latest_close = {}
+        total_rows = 0
+        started = time.perf_counter()
+
+        for path in options['paths']:
+            file_format = options['format'] or detect_format(path)
+            file_rows = 0
+            file_started = time.perf_counter()
+            for chunk in clean_chunks(read_chunks(path, file_format, options['chunk_size'])):
+                file_rows += self.import_chunk(chunk, options['batch_size'])
+                if options['verbosity'] >= 2:
+                    self.stdout.write(f"{path}: {file_rows} rows")
+            total_rows += file_rows
+            self.report(path, file_rows, time.perf_counter() - file_started)
+
+        if options['update_prices'] and self.latest_close:
+            changes = update_prices((ticker, close) for ticker, (_, close) in self.latest_close.items())
+            self.stdout.write(f"Updated the current price of {len(changes)} stocks.")
+
+        self.report("total", total_rows, time.perf_counter() - started, style=self.style.SUCCESS)
+
+
+    def import_chunk(self, chunk, batch_size):
+        """
+            upsert the chunk's stocks and bars, returns the number of bars written
+        """
+        with transaction.atomic():
+            self.upsert_stocks(chunk, batch_size)
+            stock_ids = chunk['ticker'].map(self.stock_ids)
+
+            bars = [
+                PriceBar(
+                    stock_id=stock_id,
+                    timestamp=timestamp,
+                    open_price=open_price,
+                    high_price=high_price,
+                    low_price=low_price,
+                    close_price=close_price,
+                    volume=volume,
+                )
+                for stock_id, timestamp, open_price, high_price, low_price, close_price, volume in zip(
+                    stock_ids,
+                    chunk['timestamp'].dt.to_pydatetime(),
+                    chunk['open'],
+                    chunk['high'],
+                    chunk['low'],
+                    chunk['close'],
+                    chunk['volume'],
+                )
+            ]
+            PriceBar.objects.ingest(bars, batch_size=batch_size)
+            self.write_daily_history(stock_ids, chunk['timestamp'], batch_size)
+
+        # remember each ticker's latest close for --update-prices
+        latest = chunk.loc[chunk.groupby('ticker')['timestamp'].idxmax(), ['ticker', 'timestamp', 'close']]
+        for ticker, timestamp, close in latest.itertuples(index=False):
+            if ticker not in self.latest_close or self.latest_close[ticker][0] < timestamp:
+                self.latest_close[ticker] = (timestamp, close)
+        return len(bars)
+
+
+    def write_daily_history(self, stock_ids, timestamps, batch_size):
+        """
+            rebuild the daily records of the (stock, day) pairs in the chunk from all their stored bars
+        """
+        days = set(zip(stock_ids, timestamps.dt.date))
+        first, last = min(day for _, day in days), max(day for _, day in days)
+        start = datetime.datetime.combine(first, datetime.time())
+        end = datetime.datetime.combine(last + datetime.timedelta(days=1), datetime.time())
+        if settings.USE_TZ:
+            # the chunk's timestamps are UTC, so are its days
+            start, end = start.replace(tzinfo=datetime.timezone.utc), end.replace(tzinfo=datetime.timezone.utc)
+
+        records = {}
+        bars = PriceBar.objects.filter(
+            stock_id__in={stock_id for stock_id, _ in days}, timestamp__gte=start, timestamp__lt=end,
+        ).order_by('stock_id', 'timestamp').values_list('stock_id', 'timestamp', 'open_price', 'close_price')
+        for stock_id, timestamp, open_price, close_price in bars.iterator(chunk_size=batch_size):
+            day = timestamp.astimezone(datetime.timezone.utc).date() if settings.USE_TZ else timestamp.date()
+            if (stock_id, day) not in days:
+                continue
+            record = records.get((stock_id, day))
+            if record is None:
+                record = records[(stock_id, day)] = StockPriceHistory(
+                    stock_id=stock_id, date=day, open_price=open_price, region="", type="", price_history=[],
+                )
+            record.close_price = close_price
+            record.price_history.append(float(close_price))
+
+        StockPriceHistory.objects.bulk_create(
+            records.values(),
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['stock', 'date'],
+            update_fields=['open_price', 'close_price', 'price_history'],
+        )
+
+
+    def upsert_stocks(self, chunk, batch_size):
+        """
+            create the stocks the chunk introduces and refresh company names, then learn their ids
+        """
+        has_names = 'company_name' in chunk.columns
+        columns = ['ticker', 'close'] + (['company_name'] if has_names else [])
+        new = chunk.drop_duplicates('ticker', keep='last')[columns]
+        if not has_names:
+            # without names there is nothing to update on tickers that were already seen
+            new = new[~new['ticker'].isin(self.stock_ids.keys())]
+        if new.empty:
+            return
+
+        stocks = [
+            Stock(
+                ticker=row.ticker,
+                company_name=(row.company_name if has_names and isinstance(row.company_name, str) else row.ticker),
+                current_price=row.close,
+            )
+            for row in new.itertuples(index=False)
+        ]
+        if has_names:
+            Stock.objects.bulk_create(
+                stocks,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['ticker'],
+                update_fields=['company_name'],
+            )
+        else:
+            Stock.objects.bulk_create(stocks, batch_size=batch_size, ignore_conflicts=True)
+
+        ids = dict(Stock.objects.filter(ticker__in=list(new['ticker'])).values_list('ticker', 'pk'))
+        self.stock_ids.update(ids)
+        # bulk_create skips post_save, the typeahead, the screener and the cached fragments learn of the stocks here
+        transaction.on_commit(lambda: bump_stock_versions(*ids.values()))
+
+
+    def report(self, label, rows, seconds, style=None):
+        """
+            print the rows imported and the rows per second
+        """
+        rate = rows / seconds if seconds else 0
+        message = f"{label}: {rows} rows in {seconds:.1f}s ({rate:,.0f} rows/s)"
+        self.stdout.write(style(message) if style else message)
@@ -0,0 +1,36 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/match_orders.py
+
+# Reloads the order books and fills every resting limit and stop order the
+# current prices trigger, e.g. after a restart or with ORDER_MATCHING off
+
+
+import collections
+
+from django.core.management.base import BaseCommand
+
+from wt_scrooge_capital.orderbook import sweep
+
+
+class Command(BaseCommand):
+    """
+        manage.py match_orders
+    """
+    help = "Fill the resting limit and stop orders triggered by the current prices."
+
+
+    def add_arguments(self, parser):
+        """
+            the number of stocks matched at a time can be tuned
+        """
+        parser.add_argument("--batch-size", type=int, default=500, help="Stocks matched per pass.")
+
+
+    def handle(self, *args, **options):
+        """
+            sweep the books and report what happened to the triggered orders
+        """
+        outcome = collections.Counter(sweep(batch_size=options["batch_size"]).values())
+        self.stdout.write(self.style.SUCCESS(
+            f"Filled {outcome['filled']} orders, rejected {outcome['rejected']}, {outcome['open']} moved out of range."
+        ))
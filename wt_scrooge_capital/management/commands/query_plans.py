@@ -0,0 +1,110 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/query_plans.py
+
+# Shows the query plans and timings of the app's hot lookups on a large dataset
+#
+#     manage.py query_plans --users 2000 --stocks 500
+#
+# The data is seeded inside a transaction that is rolled back at the end, so
+# the database is left as it was. To compare before and after the indexes and
+# unique constraints, run it once migrated back to before them and once at the
+# latest migration:
+#
+#     manage.py migrate wt_scrooge_capital 0011 && manage.py query_plans
+#     manage.py migrate wt_scrooge_capital && manage.py query_plans
+
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from wt_scrooge_capital.models import Portfolio, Stock, StockPriceHistory, Transaction, UserProfile, WatchList
+from wt_scrooge_capital.seeding import seed_data
+
+
+class Rollback(Exception):
+    """
+        raised to roll the seeded data back
+    """
+
+
+def hot_queries(profile, stock):
+    """
+        return the app's hot lookups as (name, queryset, how to run it)
+    """
+    return [
+        ("position by (user, stock)", Portfolio.objects.filter(user=profile, stock=stock), lambda qs: qs.first()),
+        ("watchlist exists (user, stock)", WatchList.objects.filter(user=profile, stock=stock), lambda qs: qs.exists()),
+        (
+            "latest price history of a stock",
+            StockPriceHistory.objects.filter(stock=stock).order_by('-date'),
+            lambda qs: qs.first(),
+        ),
+        (
+            "first page of a user's transactions",
+            Transaction.objects.filter(user=profile).order_by('-purchase_date', '-id')[:25],
+            list,
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    """
+        manage.py query_plans
+    """
+    help = "Seed a large dataset, print the query plans and timings of the hot lookups, then roll back."
+
+
+    def add_arguments(self, parser):
+        """
+            the size of the seeded data and the number of timed runs
+        """
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--stocks', type=int, default=500)
+        parser.add_argument('--transactions', type=int, default=50, help="Transactions per user.")
+        parser.add_argument('--history-days', type=int, default=30, help="Price history records per stock.")
+        parser.add_argument('--repeat', type=int, default=200, help="Timed runs of each query.")
+
+
+    def handle(self, *args, **options):
+        """
+            seed, explain and time every query, roll back
+        """
+        try:
+            with transaction.atomic():
+                counts = seed_data(
+                    users=options['users'],
+                    stocks=options['stocks'],
+                    transactions=options['transactions'],
+                    history_days=options['history_days'],
+                    prefix="QP",
+                )
+                self.stdout.write("Seeded " + ", ".join(f"{count} {name}" for name, count in counts.items()))
+                if connection.vendor in ('postgresql', 'sqlite'):
+                    with connection.cursor() as cursor:
+                        cursor.execute("ANALYZE")
+
+                profile = UserProfile.objects.filter(user__username__startswith="qp-user-").order_by('pk').last()
+                stock = Stock.objects.filter(ticker__startswith="QP").order_by('pk').last()
+                for name, queryset, run in hot_queries(profile, stock):
+                    self.report(name, queryset, run, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+
+    def report(self, name, queryset, run, repeat):
+        """
+            print the plan and the median time of one query
+        """
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run(queryset.all())
+            timings.append(time.perf_counter() - started)
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{name}: median {statistics.median(timings) * 1e3:.3f} ms"))
+        self.stdout.write(str(queryset.query))
+        self.stdout.write(queryset.explain())
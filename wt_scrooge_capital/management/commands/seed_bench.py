@@ -0,0 +1,69 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/seed_bench.py
+
+# Fills the database with synthetic data to benchmark against
+#
+#     manage.py seed_bench --users 5000 --stocks 1000 --bars 2000
+#     manage.py seed_bench --clear
+#
+# The rows are tagged with --prefix (default "B": tickers B00000..., users
+# b-user-0...) and every seeded user can be logged in as by the benchmark
+# command. --clear deletes the seeded rows again.
+
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from wt_scrooge_capital.seeding import clear_seed_data, seed_data
+
+
+class Command(BaseCommand):
+    """
+        manage.py seed_bench
+    """
+    help = "Generate synthetic users, stocks, price histories, portfolios, watchlists and transactions."
+
+
+    def add_arguments(self, parser):
+        """
+            the size of the data and the prefix it is tagged with
+        """
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--stocks', type=int, default=500)
+        parser.add_argument('--positions', type=int, default=20, help="Stocks held per user.")
+        parser.add_argument('--watched', type=int, default=20, help="Stocks watched per user.")
+        parser.add_argument('--transactions', type=int, default=50, help="Transactions per user.")
+        parser.add_argument('--history-days', type=int, default=30, help="Daily price history records per stock.")
+        parser.add_argument('--bars', type=int, default=500, help="Hourly price bars per stock.")
+        parser.add_argument('--prefix', default="B", help="Ticker prefix the seeded rows are tagged with.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per INSERT statement.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, the same seed gives the same data.")
+        parser.add_argument('--clear', action='store_true', help="Delete the rows seeded with --prefix instead.")
+
+
+    def handle(self, *args, **options):
+        """
+            seed (or clear) and report what was done
+        """
+        started = time.perf_counter()
+        if options['clear']:
+            deleted = clear_seed_data(options['prefix'])
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} seeded rows."))
+            return
+
+        counts = seed_data(
+            users=options['users'],
+            stocks=options['stocks'],
+            positions=options['positions'],
+            watched=options['watched'],
+            transactions=options['transactions'],
+            history_days=options['history_days'],
+            bars=options['bars'],
+            prefix=options['prefix'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+        )
+        for name, count in counts.items():
+            self.stdout.write(f"{name}: {count}")
+        self.stdout.write(self.style.SUCCESS(f"Seeded in {time.perf_counter() - started:.1f}s."))
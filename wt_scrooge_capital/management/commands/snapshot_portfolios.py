@@ -0,0 +1,32 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/management/commands/snapshot_portfolios.py
+
+# Stores the current value of every portfolio as a PortfolioSnapshot, meant to
+# be run periodically (cron, a scheduler) to build portfolio value time series
+
+
+from django.core.management.base import BaseCommand
+
+from wt_scrooge_capital.valuations import take_snapshots
+
+
+class Command(BaseCommand):
+    """
+        manage.py snapshot_portfolios
+    """
+    help = "Store a snapshot of every user's portfolio valuation."
+
+
+    def add_arguments(self, parser):
+        """
+            the snapshot batch size can be tuned
+        """
+        parser.add_argument("--batch-size", type=int, default=1000, help="Snapshots inserted per query.")
+
+
+    def handle(self, *args, **options):
+        """
+            take the snapshots and report how many were stored
+        """
+        count = take_snapshots(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Stored {count} portfolio snapshots."))
@@ -0,0 +1,83 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/middleware.py
+
+# Middleware of the app
+
+# UserProfileMiddleware attaches a lazy `request.user_profile`, so a request
+# loads the logged-in user's profile at most once however many times the view
+# asks for it. Enable it after AuthenticationMiddleware:
+#
+#     MIDDLEWARE = [
+#         ...
+#         "django.contrib.auth.middleware.AuthenticationMiddleware",
+#         "wt_scrooge_capital.middleware.UserProfileMiddleware",
+#     ]
+#
+# Setting USER_PROFILE_CACHE_TIMEOUT (seconds, default 0 = off) also keeps the
+# profile in the cache between requests. Saving or deleting a profile drops its
+# cache entry (see signals.py).
+
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from .models import UserProfile
+
+
+def user_profile_cache_key(user_id):
+    """
+        return the cache key holding the profile of a user
+    """
+    return f"wt_scrooge_capital:user-profile:{user_id}"
+
+
+def get_user_profile(request):
+    """
+        return the profile of the logged-in user, loaded once per request
+
+        raises UserProfile.DoesNotExist like UserProfile.objects.get() if the user has no profile
+    """
+    if not hasattr(request, '_cached_user_profile'):
+        timeout = getattr(settings, 'USER_PROFILE_CACHE_TIMEOUT', 0)
+        key = user_profile_cache_key(request.user.pk)
+        user_profile = cache.get(key) if timeout else None
+
+        if user_profile is None:
+            user_profile = UserProfile.objects.get(user=request.user)
+            if timeout:
+                cache.set(key, user_profile, timeout)
+
+        # reuse the already loaded auth user instead of fetching it again through the relation
+        user_profile.user = request.user
+        request._cached_user_profile = user_profile
+    return request._cached_user_profile
+
+
+def invalidate_user_profile(user_id):
+    """
+        drop the cross-request cache entry of a user's profile
+    """
+    cache.delete(user_profile_cache_key(user_id))
+
+
+class UserProfileMiddleware:
+    """
+        Sets request.user_profile, resolved on first access
+    """
+    def __init__(self, get_response):
+        """
+            standard middleware setup
+        """
+        self.get_response = get_response
+
+
+    def __call__(self, request):
+        """
+            attach the lazy profile for authenticated users
+        """
+        if request.user.is_authenticated:
+            request.user_profile = SimpleLazyObject(lambda: get_user_profile(request))
+        else:
+            request.user_profile = None
+        return self.get_response(request)
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.2 on 2026-10-18
+
+from django.db import migrations
+
+import wt_scrooge_capital.fields
+
+
+BATCH_SIZE = 500
+
+
+def pack_price_history(apps, schema_editor):
+    """
+        convert the comma-separated price_history text into the packed binary column
+    """
+    StockPriceHistory = apps.get_model("wt_scrooge_capital", "StockPriceHistory")
+    batch = []
+    for record in StockPriceHistory.objects.only("id", "price_history").iterator(chunk_size=BATCH_SIZE):
+        record.packed_price_history = wt_scrooge_capital.fields.parse_price_text(record.price_history)
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            StockPriceHistory.objects.bulk_update(batch, ["packed_price_history"])
+            batch = []
+    if batch:
+        StockPriceHistory.objects.bulk_update(batch, ["packed_price_history"])
+
+
+def unpack_price_history(apps, schema_editor):
+    """
+        convert the packed binary column back into comma-separated text
+    """
+    StockPriceHistory = apps.get_model("wt_scrooge_capital", "StockPriceHistory")
+    batch = []
+    for record in StockPriceHistory.objects.only("id", "packed_price_history").iterator(chunk_size=BATCH_SIZE):
+        prices = record.packed_price_history or []
+        record.price_history = ",".join(repr(price) for price in prices)
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            StockPriceHistory.objects.bulk_update(batch, ["price_history"])
+            batch = []
+    if batch:
+        StockPriceHistory.objects.bulk_update(batch, ["price_history"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0006_stockpricehistory_price_history"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stockpricehistory",
+            name="packed_price_history",
+            field=wt_scrooge_capital.fields.PriceSeriesField(null=True),
+        ),
+        migrations.RunPython(pack_price_history, unpack_price_history),
+        migrations.RemoveField(
+            model_name="stockpricehistory",
+            name="price_history",
+        ),
+        migrations.RenameField(
+            model_name="stockpricehistory",
+            old_name="packed_price_history",
+            new_name="price_history",
+        ),
+        migrations.AlterField(
+            model_name="stockpricehistory",
+            name="price_history",
+            field=wt_scrooge_capital.fields.PriceSeriesField(),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:39
+
+import datetime
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+BATCH_SIZE = 1000
+
+
+def price_history_to_bars(apps, schema_editor):
+    """
+        expand every stored hourly price_history series into one bar per hour
+    """
+    StockPriceHistory = apps.get_model("wt_scrooge_capital", "StockPriceHistory")
+    PriceBar = apps.get_model("wt_scrooge_capital", "PriceBar")
+    bars = []
+    for record in StockPriceHistory.objects.only("stock_id", "date", "price_history").iterator(chunk_size=BATCH_SIZE):
+        midnight = datetime.datetime.combine(record.date, datetime.time())
+        if settings.USE_TZ:
+            midnight = timezone.make_aware(midnight, datetime.timezone.utc)
+        for hour, price in enumerate(record.price_history or [], start=1):
+            price = Decimal(str(round(price, 2)))
+            bars.append(PriceBar(
+                stock_id=record.stock_id,
+                timestamp=midnight + datetime.timedelta(hours=hour),
+                open_price=price,
+                high_price=price,
+                low_price=price,
+                close_price=price,
+            ))
+        if len(bars) >= BATCH_SIZE:
+            PriceBar.objects.bulk_create(bars, batch_size=BATCH_SIZE, ignore_conflicts=True)
+            bars = []
+    if bars:
+        PriceBar.objects.bulk_create(bars, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0007_pack_stockpricehistory_price_history"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PriceBar",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField()),
+                ("open_price", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("high_price", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("low_price", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("close_price", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("volume", models.BigIntegerField(default=0)),
+                (
+                    "stock",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="bars",
+                        to="wt_scrooge_capital.stock",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["stock", "timestamp"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("stock", "timestamp"),
+                        name="unique_price_bar_stock_timestamp",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(price_history_to_bars, migrations.RunPython.noop),
+    ]
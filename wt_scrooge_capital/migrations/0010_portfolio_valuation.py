@@ -0,0 +1,99 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_cost_basis(apps, schema_editor):
+    """
+        the last purchase price is the only cost information existing positions have
+    """
+    Portfolio = apps.get_model("wt_scrooge_capital", "Portfolio")
+    Portfolio.objects.update(
+        cost_basis=models.ExpressionWrapper(
+            models.F("shares") * models.F("purchase_price"),
+            output_field=models.DecimalField(max_digits=16, decimal_places=2),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0009_transaction_idempotency_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="portfolio",
+            name="cost_basis",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=16),
+        ),
+        migrations.RunPython(fill_cost_basis, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name="PortfolioValuation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("total_shares", models.BigIntegerField(default=0)),
+                (
+                    "market_value",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=16),
+                ),
+                (
+                    "cost_basis",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=16),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="valuation",
+                        to="wt_scrooge_capital.userprofile",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PortfolioSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("taken_at", models.DateTimeField()),
+                ("total_shares", models.BigIntegerField()),
+                ("market_value", models.DecimalField(decimal_places=2, max_digits=16)),
+                ("cost_basis", models.DecimalField(decimal_places=2, max_digits=16)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="portfolio_snapshots",
+                        to="wt_scrooge_capital.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["user", "taken_at"],
+                "indexes": [
+                    models.Index(
+                        fields=["user", "taken_at"], name="portfolio_snapshot_user_time"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0010_portfolio_valuation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StockIndicators",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("computed_at", models.DateTimeField()),
+                ("bars", models.PositiveIntegerField(default=0)),
+                ("sma", models.FloatField(blank=True, null=True)),
+                ("ema", models.FloatField(blank=True, null=True)),
+                ("vwap", models.FloatField(blank=True, null=True)),
+                ("rsi", models.FloatField(blank=True, null=True)),
+                ("bollinger_upper", models.FloatField(blank=True, null=True)),
+                ("bollinger_lower", models.FloatField(blank=True, null=True)),
+                ("volatility", models.FloatField(blank=True, null=True)),
+                ("max_drawdown", models.FloatField(blank=True, null=True)),
+                (
+                    "stock",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="indicators",
+                        to="wt_scrooge_capital.stock",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0011_stockindicators"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="transaction",
+            options={"ordering": ["-purchase_date", "-id"]},
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "-purchase_date", "-id"],
+                name="transaction_user_date_id",
+            ),
+        ),
+    ]
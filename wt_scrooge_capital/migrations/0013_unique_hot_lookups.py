@@ -0,0 +1,83 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:55
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+        fold duplicate rows into one before the unique constraints go on
+
+        duplicate positions are merged into the oldest one, duplicate watchlist rows and
+        price history records keep the oldest and the newest row respectively
+    """
+    Portfolio = apps.get_model("wt_scrooge_capital", "Portfolio")
+    WatchList = apps.get_model("wt_scrooge_capital", "WatchList")
+    StockPriceHistory = apps.get_model("wt_scrooge_capital", "StockPriceHistory")
+
+    duplicates = (
+        Portfolio.objects.values("user", "stock")
+        .annotate(
+            rows=Count("id"),
+            keep=Min("id"),
+            shares_total=Sum("shares"),
+            cost_total=Sum("cost_basis"),
+        )
+        .filter(rows__gt=1)
+    )
+    for group in duplicates:
+        Portfolio.objects.filter(pk=group["keep"]).update(
+            shares=group["shares_total"], cost_basis=group["cost_total"]
+        )
+        Portfolio.objects.filter(user=group["user"], stock=group["stock"]).exclude(
+            pk=group["keep"]
+        ).delete()
+
+    duplicates = (
+        WatchList.objects.values("user", "stock")
+        .annotate(rows=Count("id"), keep=Min("id"))
+        .filter(rows__gt=1)
+    )
+    for group in duplicates:
+        WatchList.objects.filter(user=group["user"], stock=group["stock"]).exclude(
+            pk=group["keep"]
+        ).delete()
+
+    duplicates = (
+        StockPriceHistory.objects.values("stock", "date")
+        .annotate(rows=Count("id"), keep=Max("id"))
+        .filter(rows__gt=1)
+    )
+    for group in duplicates:
+        StockPriceHistory.objects.filter(
+            stock=group["stock"], date=group["date"]
+        ).exclude(pk=group["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0012_transaction_keyset_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="portfolio",
+            constraint=models.UniqueConstraint(
+                fields=("user", "stock"), name="unique_portfolio_user_stock"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stockpricehistory",
+            constraint=models.UniqueConstraint(
+                fields=("stock", "date"), name="unique_stock_price_history_date"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="watchlist",
+            constraint=models.UniqueConstraint(
+                fields=("user", "stock"), name="unique_watchlist_user_stock"
+            ),
+        ),
+    ]
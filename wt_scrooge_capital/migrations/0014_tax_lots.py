@@ -0,0 +1,164 @@
+# Generated by Django 5.1.2 on 2026-10-18 05:05
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def open_existing_lots(apps, schema_editor):
+    """
+        open one lot per existing position at its average cost
+
+        the positions don't record which buys they were built from, so their history starts here
+    """
+    Portfolio = apps.get_model("wt_scrooge_capital", "Portfolio")
+    TaxLot = apps.get_model("wt_scrooge_capital", "TaxLot")
+
+    lots = []
+    for item in Portfolio.objects.filter(shares__gt=0).iterator(chunk_size=2000):
+        lots.append(
+            TaxLot(
+                user_id=item.user_id,
+                stock_id=item.stock_id,
+                opened_on=item.purchase_date,
+                shares=item.shares,
+                remaining_shares=item.shares,
+                price=(item.cost_basis / item.shares).quantize(Decimal("0.0001")),
+            )
+        )
+        if len(lots) >= 2000:
+            TaxLot.objects.bulk_create(lots)
+            lots = []
+    TaxLot.objects.bulk_create(lots)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wt_scrooge_capital", "0013_unique_hot_lookups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="portfoliovaluation",
+            name="realized_pnl",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=16),
+        ),
+        migrations.AddField(
+            model_name="transaction",
+            name="realized_pnl",
+            field=models.DecimalField(
+                blank=True, decimal_places=2, max_digits=16, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="userprofile",
+            name="lot_method",
+            field=models.CharField(
+                choices=[
+                    ("average", "Average cost"),
+                    ("fifo", "First in, first out"),
+                    ("lifo", "Last in, first out"),
+                ],
+                default="average",
+                max_length=8,
+            ),
+        ),
+        migrations.CreateModel(
+            name="RealizedPnL",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("shares_sold", models.BigIntegerField(default=0)),
+                (
+                    "proceeds",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=16),
+                ),
+                (
+                    "realized_pnl",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=16),
+                ),
+                (
+                    "stock",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="wt_scrooge_capital.stock",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="realized",
+                        to="wt_scrooge_capital.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "stock"), name="unique_realized_pnl_user_stock"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="TaxLot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("opened_on", models.DateField()),
+                ("shares", models.PositiveIntegerField()),
+                ("remaining_shares", models.PositiveIntegerField()),
+                ("price", models.DecimalField(decimal_places=4, max_digits=14)),
+                (
+                    "stock",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="wt_scrooge_capital.stock",
+                    ),
+                ),
+                (
+                    "transaction",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="wt_scrooge_capital.transaction",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="lots",
+                        to="wt_scrooge_capital.userprofile",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "stock", "opened_on", "id"],
+                        name="taxlot_user_stock_opened",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(open_existing_lots, migrations.RunPython.noop),
+    ]
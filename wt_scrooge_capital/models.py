@@ -7,18 +7,28 @@
 from django.db import models
 
 # Create your models here.
+import datetime
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from .fields import PriceSeriesField
+from .versions import bump_price_version
 
 class UserProfile(models.Model):
     """
         User profile model to store additional user information
     """
+    LOT_METHOD_CHOICES = [  # how sells pick the tax lots they close (see lots.py)
+        ('average', 'Average cost'),
+        ('fifo', 'First in, first out'),
+        ('lifo', 'Last in, first out'),
+    ]
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
     email = models.EmailField(unique=True)
     dob = models.DateField(null=True, blank=True)
+    lot_method = models.CharField(max_length=8, choices=LOT_METHOD_CHOICES, default='average')
 
 
     def __str__(self):
@@ -37,6 +47,23 @@ class Stock(models.Model):
     current_price = models.DecimalField(max_digits=10, decimal_places=2)
 
 
+    def save(self, *args, **kwargs):
+        """
+            save the stock, an existing stock's row is locked first and its committed price re-read,
+            so the post_save fan-out (signals.py) moves the valuations by the right delta even when
+            two saves started from the same loaded price
+        """
+        update_fields = kwargs.get('update_fields')
+        saves_price = update_fields is None or 'current_price' in update_fields
+        if self._state.adding or not saves_price or 'current_price' not in self.__dict__:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            self._loaded_current_price = (
+                Stock.objects.select_for_update().filter(pk=self.pk).values_list('current_price', flat=True).first()
+            )
+            return super().save(*args, **kwargs)
+
+
     def __str__(self):
         """
             return the company name, ticker, and current price of the stock
@@ -54,14 +81,36 @@ class StockPriceHistory(models.Model):
     close_price = models.DecimalField(max_digits=10, decimal_places=2)
     region = models.CharField(max_length=50)
     type = models.CharField(max_length=50)
-    price_history = models.TextField(blank=False, default="")
+    price_history = PriceSeriesField(blank=False)
+
+
+    class Meta:
+        """
+            one record per stock and day, the unique index also finds a stock's latest record
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['stock', 'date'], name='unique_stock_price_history_date'),
+        ]
 
 
     def get_price_history(self):
-        """"
-            return the price history of the stock
         """
-        return [float(price) for price in self.price_history.split(",") if price]
+            return the price history of the stock as an array.array of floats
+        """
+        return self.price_history
+
+
+    def get_price_array(self):
+        """
+            return the price history as a NumPy float64 array, a view over the decoded array.array
+            (decoding the stored blob copies it once, use fields.prices_as_numpy on the raw bytes to avoid that)
+        """
+        import numpy as np
+
+        prices = self._meta.get_field('price_history').to_python(self.price_history)
+        if not prices:
+            return np.empty(0)
+        return np.frombuffer(prices, dtype=np.float64)
 
 
     def __str__(self):
@@ -71,6 +120,144 @@ class StockPriceHistory(models.Model):
         return f"{self.stock.ticker} on {self.date}, open_price: ${self.open_price}, close_price: ${self.close_price}"
 
 
+class PriceBarQuerySet(models.QuerySet):
+    """
+        Query API for price bars: range, last-N and downsampled reads
+    """
+
+    def for_stock(self, stock):
+        """
+            return the bars of a single stock
+        """
+        return self.filter(stock=stock)
+
+
+    def between(self, start, end):
+        """
+            return the bars with start <= timestamp < end, oldest first
+        """
+        return self.filter(timestamp__gte=start, timestamp__lt=end).order_by("timestamp")
+
+
+    def last_n(self, n):
+        """
+            return the latest n bars, oldest first
+        """
+        latest = self.order_by("-timestamp").values_list("pk", flat=True)[:n]
+        return self.filter(pk__in=list(latest)).order_by("timestamp")
+
+
+    def downsample(self, interval):
+        """
+            aggregate the bars into OHLCV buckets of the given timedelta, oldest first
+
+            the bars are streamed as tuples so no model instances are built
+        """
+        step = interval.total_seconds()
+        if step <= 0:
+            raise ValueError("interval must be positive")
+
+        rows = self.order_by("timestamp").values_list(
+            "timestamp", "open_price", "high_price", "low_price", "close_price", "volume"
+        )
+        buckets = []
+        current = None
+        for timestamp, open_price, high_price, low_price, close_price, volume in rows.iterator():
+            start = timestamp - datetime.timedelta(seconds=timestamp.timestamp() % step)
+            if current is None or current["timestamp"] != start:
+                current = {
+                    "timestamp": start,
+                    "open_price": open_price,
+                    "high_price": high_price,
+                    "low_price": low_price,
+                    "close_price": close_price,
+                    "volume": volume,
+                }
+                buckets.append(current)
+            else:
+                current["high_price"] = max(current["high_price"], high_price)
+                current["low_price"] = min(current["low_price"], low_price)
+                current["close_price"] = close_price
+                current["volume"] += volume
+        return buckets
+
+
+    def ingest(self, bars, batch_size=1000):
+        """
+            bulk insert PriceBar instances, overwriting existing bars with the same (stock, timestamp)
+
+            bulk_create skips post_save, so the price versions of the touched stocks are bumped here,
+            once the bars are committed
+        """
+        bars = self.bulk_create(
+            bars,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["stock", "timestamp"],
+            update_fields=["open_price", "high_price", "low_price", "close_price", "volume"],
+        )
+        stock_ids = {bar.stock_id for bar in bars}
+        transaction.on_commit(lambda: bump_price_version(*stock_ids))
+        return bars
+
+
+class PriceBar(models.Model):
+    """
+        Price bar model to store one OHLCV bar of a stock at a point in time
+    """
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name="bars")
+    timestamp = models.DateTimeField()
+    open_price = models.DecimalField(max_digits=10, decimal_places=2)
+    high_price = models.DecimalField(max_digits=10, decimal_places=2)
+    low_price = models.DecimalField(max_digits=10, decimal_places=2)
+    close_price = models.DecimalField(max_digits=10, decimal_places=2)
+    volume = models.BigIntegerField(default=0)
+
+    objects = PriceBarQuerySet.as_manager()
+
+
+    class Meta:
+        """
+            one bar per stock and timestamp, the unique index also serves range queries
+        """
+        ordering = ["stock", "timestamp"]
+        constraints = [
+            models.UniqueConstraint(fields=["stock", "timestamp"], name="unique_price_bar_stock_timestamp"),
+        ]
+
+
+    def __str__(self):
+        """
+            return the stock ticker, timestamp and close price of the bar
+        """
+        return f"{self.stock.ticker} at {self.timestamp}, close_price: ${self.close_price}"
+
+
+class StockIndicators(models.Model):
+    """
+        Stock indicators model to store the latest precomputed technical indicators of a stock
+        (see indicators.py and the compute_indicators command)
+    """
+    stock = models.OneToOneField(Stock, on_delete=models.CASCADE, related_name="indicators")
+    computed_at = models.DateTimeField()
+    bars = models.PositiveIntegerField(default=0)  # number of bars the indicators were computed over
+    sma = models.FloatField(null=True, blank=True)
+    ema = models.FloatField(null=True, blank=True)
+    vwap = models.FloatField(null=True, blank=True)
+    rsi = models.FloatField(null=True, blank=True)
+    bollinger_upper = models.FloatField(null=True, blank=True)
+    bollinger_lower = models.FloatField(null=True, blank=True)
+    volatility = models.FloatField(null=True, blank=True)
+    max_drawdown = models.FloatField(null=True, blank=True)
+
+
+    def __str__(self):
+        """
+            return the stock ticker and when the indicators were computed
+        """
+        return f"{self.stock.ticker} indicators at {self.computed_at}"
+
+
 class Portfolio(models.Model):
     """
         Portfolio model to store user's portfolio information
@@ -80,6 +267,16 @@ class Portfolio(models.Model):
     shares = models.PositiveIntegerField()
     purchase_price = models.DecimalField(max_digits=10, decimal_places=2)
     purchase_date = models.DateField()
+    cost_basis = models.DecimalField(max_digits=16, decimal_places=2, default=0)  # average-cost total paid for the shares held
+
+
+    class Meta:
+        """
+            a user has one position per stock, the unique index serves the (user, stock) lookups
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'stock'], name='unique_portfolio_user_stock'),
+        ]
 
 
     def get_context_data(self, **kwargs):
@@ -105,6 +302,62 @@ class Portfolio(models.Model):
         return f"{self.user}'s portfolio - {self.stock.ticker}"
 
 
+class PortfolioValuation(models.Model):
+    """
+        Portfolio valuation model to store the running totals of a user's portfolio, kept up to date
+        incrementally by trades and price changes (see valuations.py)
+    """
+    user = models.OneToOneField(UserProfile, on_delete=models.CASCADE, related_name="valuation")
+    total_shares = models.BigIntegerField(default=0)
+    market_value = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    cost_basis = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    realized_pnl = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+    @property
+    def unrealized_pnl(self):
+        """
+            return the gain or loss of the held shares at current prices
+        """
+        return self.market_value - self.cost_basis
+
+
+    def __str__(self):
+        """
+            return the valuation information
+        """
+        return f"{self.user}'s portfolio value: ${self.market_value}"
+
+
+class PortfolioSnapshot(models.Model):
+    """
+        Portfolio snapshot model to store a user's portfolio valuation at a point in time
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="portfolio_snapshots")
+    taken_at = models.DateTimeField()
+    total_shares = models.BigIntegerField()
+    market_value = models.DecimalField(max_digits=16, decimal_places=2)
+    cost_basis = models.DecimalField(max_digits=16, decimal_places=2)
+
+
+    class Meta:
+        """
+            snapshots are read per user over time
+        """
+        ordering = ['user', 'taken_at']
+        indexes = [
+            models.Index(fields=['user', 'taken_at'], name='portfolio_snapshot_user_time'),
+        ]
+
+
+    def __str__(self):
+        """
+            return the snapshot information
+        """
+        return f"{self.user}'s portfolio at {self.taken_at}: ${self.market_value}"
+
+
 class WatchList(models.Model):
     """
         Watchlist model to store user's watchlist information
@@ -116,6 +369,15 @@ class WatchList(models.Model):
     current_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
 
 
+    class Meta:
+        """
+            a stock is on a user's watchlist once, the unique index serves the (user, stock) lookups
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'stock'], name='unique_watchlist_user_stock'),
+        ]
+
+
     def __str__(self):
         """
             return the watchlist information
@@ -137,13 +399,22 @@ class Transaction(models.Model):
     purchase_price = models.DecimalField(max_digits=10, decimal_places=2)
     purchase_date = models.DateField()
     transaction_type = models.CharField(max_length=4, choices=TRANSACTION_CHOICES)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)  # set by the client to make retries safe
+    realized_pnl = models.DecimalField(max_digits=16, decimal_places=2, null=True, blank=True)  # gain or loss of a sell
 
 
     class Meta:
         """
-            ordering the transaction by purchase date
+            ordering the transaction by purchase date, an idempotency key can only be used once per user,
+            the index serves the keyset pages of a user's history
         """
-        ordering = ['-purchase_date'] 
+        ordering = ['-purchase_date', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_transaction_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-purchase_date', '-id'], name='transaction_user_date_id'),
+        ]
 
 
     def __str__(self):
@@ -151,3 +422,107 @@ class Transaction(models.Model):
             return the transaction information
         """
         return f"{self.user} {self.transaction_type} {self.stock.ticker} at ${self.purchase_price}"
+
+
+class TaxLot(models.Model):
+    """
+        Tax lot model to store the shares bought by one buy that haven't been sold yet (see lots.py)
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="lots")
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
+    transaction = models.ForeignKey(Transaction, on_delete=models.SET_NULL, null=True, blank=True)
+    opened_on = models.DateField()
+    shares = models.PositiveIntegerField()  # bought
+    remaining_shares = models.PositiveIntegerField()  # not sold yet
+    price = models.DecimalField(max_digits=14, decimal_places=4)  # cost per share
+
+
+    class Meta:
+        """
+            the index serves the open lots of a position in the order they were opened
+        """
+        indexes = [
+            models.Index(fields=['user', 'stock', 'opened_on', 'id'], name='taxlot_user_stock_opened'),
+        ]
+
+
+    def __str__(self):
+        """
+            return the lot information
+        """
+        return f"{self.user} {self.remaining_shares}/{self.shares} {self.stock.ticker} at ${self.price}"
+
+
+class RealizedPnL(models.Model):
+    """
+        Realized P&L model to store the running gain or loss of a user's sells of one stock
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="realized")
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
+    shares_sold = models.BigIntegerField(default=0)
+    proceeds = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    realized_pnl = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+
+    class Meta:
+        """
+            one row per user and stock
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'stock'], name='unique_realized_pnl_user_stock'),
+        ]
+
+
+    def __str__(self):
+        """
+            return the realized P&L information
+        """
+        return f"{self.user} realized ${self.realized_pnl} on {self.stock.ticker}"
+
+
+class Order(models.Model):
+    """
+        Order model to store a limit or stop order resting until the price reaches it (see orderbook.py)
+    """
+    SIDE_CHOICES = [
+        ('buy', 'Buy'),
+        ('sell', 'Sell')
+    ]
+    ORDER_TYPE_CHOICES = [  # a limit order fills at its price or better, a stop order fills once the price crosses it
+        ('limit', 'Limit'),
+        ('stop', 'Stop')
+    ]
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('filled', 'Filled'),
+        ('cancelled', 'Cancelled'),
+        ('rejected', 'Rejected')
+    ]
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="orders")
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
+    side = models.CharField(max_length=4, choices=SIDE_CHOICES)
+    order_type = models.CharField(max_length=5, choices=ORDER_TYPE_CHOICES)
+    price = models.DecimalField(max_digits=10, decimal_places=2)  # the limit or the stop price
+    shares = models.PositiveIntegerField()
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default='open')
+    created_at = models.DateTimeField(auto_now_add=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+    transaction = models.ForeignKey(Transaction, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.CharField(max_length=200, blank=True)  # why a rejected order couldn't fill
+
+
+    class Meta:
+        """
+            the indexes serve the open orders of a stock (loading its book) and of a user (the portfolio page)
+        """
+        indexes = [
+            models.Index(fields=['stock', 'status'], name='order_stock_status'),
+            models.Index(fields=['user', 'status', '-created_at'], name='order_user_status_created'),
+        ]
+
+
+    def __str__(self):
+        """
+            return the order information
+        """
+        return f"{self.user} {self.order_type} {self.side} {self.shares} {self.stock.ticker} at ${self.price} ({self.status})"
@@ -0,0 +1,367 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/orderbook.py
+
+# Resting limit and stop orders
+
+# An Order waits until the price of its stock reaches it:
+#
+#   limit buy    fills once the price is at or below its price
+#   limit sell   fills once the price is at or above its price
+#   stop buy     fills once the price rises to or above its price
+#   stop sell    fills once the price falls to or below its price
+#
+# Each process keeps the open orders of a stock in an OrderBook, two heaps in
+# price-time priority: the orders filling at or below a price are a max-heap
+# on it, the ones filling at or above a min-heap, ties go to the older order.
+# A price tick only looks at the tops of the two heaps, so checking a stock
+# with thousands of resting orders costs the same as one with none, and every
+# triggered order is popped in O(log n). Cancelled orders are dropped lazily.
+#
+# match_orders() runs after every committed price change (signals.py). It
+# pops the orders the new prices trigger and fills them one account at a time:
+# the account is locked, the orders are re-read with their status and the
+# current price, and the fills go through execute_orders() as one batch, so
+# the Transaction, Portfolio, lot and valuation changes of an account's fills
+# and the order statuses are written in one database transaction. Each fill
+# carries the idempotency key "order-<pk>", an order can't fill twice even if
+# two processes match it.
+#
+# The books are loaded from the database the first time a stock is matched.
+# The orders placed in this process are added once they're committed, the
+# ones placed by other processes are caught up with at most every
+# ORDER_BOOK_SYNC_INTERVAL seconds (default 5) by reading the open orders
+# created since the last catch-up, less ORDER_BOOK_GRACE seconds (default 60)
+# for the transactions that commit a while after they created their order.
+# A tick in between runs no query at all. Every ORDER_BOOK_RESYNC seconds
+# (default 600) the books are dropped and loaded again from scratch.
+# `manage.py match_orders` reloads them and sweeps every stock at its current
+# price, e.g. after a restart. ORDER_MATCHING = False turns the matching on
+# price changes off.
+
+
+import collections
+import datetime
+import heapq
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, Stock, UserProfile
+from .orders import OrderError, execute_orders
+from .versions import bump_holdings_version
+
+
+def matching_enabled():
+    """
+        return whether price changes fill the resting orders
+    """
+    return getattr(settings, 'ORDER_MATCHING', True)
+
+
+def order_book_sync_interval():
+    """
+        return how many seconds may pass between two catch-ups with the orders of other processes
+    """
+    return getattr(settings, 'ORDER_BOOK_SYNC_INTERVAL', 5)
+
+
+def order_book_grace():
+    """
+        return how many seconds before the last catch-up an order may have been created and still be new
+    """
+    return getattr(settings, 'ORDER_BOOK_GRACE', 60)
+
+
+def order_book_resync():
+    """
+        return how many seconds the books are kept before they are loaded again from scratch
+    """
+    return getattr(settings, 'ORDER_BOOK_RESYNC', 600)
+
+
+def cents(price):
+    """
+        return a price as integer cents, the heaps compare ints much faster than Decimals
+    """
+    return int(round(price * 100))
+
+
+def fills_below(side, order_type):
+    """
+        return whether the order fills at or below its price (limit buys and stop sells)
+    """
+    return (side == 'buy') == (order_type == 'limit')
+
+
+def is_triggered(side, order_type, order_price, price):
+    """
+        return whether the price triggers the order
+    """
+    if fills_below(side, order_type):
+        return price <= order_price
+    return price >= order_price
+
+
+class OrderBook:
+    """
+        the open orders of one stock in price-time priority
+    """
+
+    def __init__(self):
+        self.below = []  # (-price, id) of the orders filling at or below their price
+        self.above = []  # (price, id) of the orders filling at or above their price
+        self.entries = {}  # id -> (heap, entry) of every live order
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def add(self, order_id, side, order_type, price):
+        """
+            rest an order on the book, adding it twice changes nothing
+        """
+        if order_id in self.entries:
+            return
+        if fills_below(side, order_type):
+            heap, entry = self.below, (-cents(price), order_id)
+        else:
+            heap, entry = self.above, (cents(price), order_id)
+        heapq.heappush(heap, entry)
+        self.entries[order_id] = (heap, entry)
+
+
+    def discard(self, order_id):
+        """
+            take an order off the book, its heap entry is skipped when it comes up
+        """
+        if self.entries.pop(order_id, None) and len(self.below) + len(self.above) > 2 * len(self.entries) + 64:
+            # mostly dead entries, rebuild the heaps from the live ones
+            self.below = [entry for heap, entry in self.entries.values() if heap is self.below]
+            self.above = [entry for heap, entry in self.entries.values() if heap is self.above]
+            heapq.heapify(self.below)
+            heapq.heapify(self.above)
+            self.entries = {entry[1]: (self.below, entry) for entry in self.below}
+            self.entries.update({entry[1]: (self.above, entry) for entry in self.above})
+
+
+    def match(self, price):
+        """
+            pop the orders the price triggers, best priced and oldest first, returns their ids
+        """
+        price = cents(price)
+        matched = []
+        for heap, triggered in ((self.below, lambda key: -key >= price), (self.above, lambda key: key <= price)):
+            while heap and triggered(heap[0][0]):
+                _, order_id = heapq.heappop(heap)
+                if self.entries.pop(order_id, None):
+                    matched.append(order_id)
+        return matched
+
+
+class OrderBooks:
+    """
+        the order books of this process, one per stock, thread-safe
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.books = {}
+        self.loaded_at = None  # when the books were last dropped and started again
+        self.synced_at = None  # when the orders of other processes were last caught up with
+
+
+    def load(self, stock_ids):
+        """
+            load the books of the stocks not loaded yet and catch up with the orders of other processes
+            when it is time to, call it with the lock held
+        """
+        now = timezone.now()
+        if self.loaded_at is None or now - self.loaded_at >= datetime.timedelta(seconds=order_book_resync()):
+            self.books.clear()
+            self.loaded_at = self.synced_at = now
+
+        rows = []
+        if now - self.synced_at >= datetime.timedelta(seconds=order_book_sync_interval()):
+            # only the recent orders, an order the books already hold is not added twice
+            since = self.synced_at - datetime.timedelta(seconds=order_book_grace())
+            rows.append(Order.objects.filter(status='open', created_at__gte=since))
+            self.synced_at = now
+        missing = [stock_id for stock_id in stock_ids if stock_id not in self.books]
+        for stock_id in missing:
+            self.books[stock_id] = OrderBook()
+        if missing:
+            rows.append(Order.objects.filter(status='open', stock_id__in=missing))
+
+        for queryset in rows:
+            for pk, stock_id, side, order_type, price in queryset.values_list('pk', 'stock_id', 'side', 'order_type', 'price'):
+                if stock_id in self.books:
+                    self.books[stock_id].add(pk, side, order_type, price)
+
+
+    def add(self, order):
+        """
+            rest a new order on its book if the book is loaded (it is read with the book otherwise)
+        """
+        with self.lock:
+            book = self.books.get(order.stock_id)
+            if book is not None:
+                book.add(order.pk, order.side, order.order_type, order.price)
+
+
+    def discard(self, order):
+        """
+            take an order off its book
+        """
+        with self.lock:
+            book = self.books.get(order.stock_id)
+            if book is not None:
+                book.discard(order.pk)
+
+
+    def match(self, prices):
+        """
+            pop the orders triggered by the prices, `prices` maps stock ids to their new price
+        """
+        with self.lock:
+            self.load(list(prices))
+            return [order_id for stock_id, price in prices.items() for order_id in self.books[stock_id].match(price)]
+
+
+    def clear(self):
+        """
+            forget every book, they are loaded again on the next match
+        """
+        with self.lock:
+            self.books.clear()
+            self.loaded_at = self.synced_at = None
+
+
+books = OrderBooks()
+
+
+def place_order(user_profile, stock, side, order_type, price, shares):
+    """
+        rest a limit or stop order, returns the Order
+
+        an order the current price already triggers fills right after it's committed,
+        raises OrderError if the order is invalid
+    """
+    if side not in ('buy', 'sell'):
+        raise OrderError(f"Unknown side: {side}")
+    if order_type not in ('limit', 'stop'):
+        raise OrderError(f"Unknown order type: {order_type}")
+    if shares <= 0:
+        raise OrderError("The number of shares must be positive.")
+    if price is None or price <= 0:
+        raise OrderError(f"A {order_type} order needs a positive price.")
+
+    order = Order.objects.create(
+        user=user_profile, stock=stock, side=side, order_type=order_type, price=price, shares=shares,
+    )
+
+    def rest():
+        if is_triggered(side, order_type, order.price, stock.current_price):
+            fill_orders([order.pk])
+        else:
+            books.add(order)
+    transaction.on_commit(rest)
+    return order
+
+
+def cancel_order(user_profile, order_id):
+    """
+        cancel one of the user's open orders, returns it or None if it isn't open anymore
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(pk=order_id, user=user_profile, status='open').first()
+        if order is None:
+            return None
+        order.status = 'cancelled'
+        order.closed_at = timezone.now()
+        order.save(update_fields=['status', 'closed_at'])
+        transaction.on_commit(lambda: books.discard(order))
+    return order
+
+
+def match_orders(prices):
+    """
+        fill the resting orders triggered by new prices, `prices` maps stock ids to their new price
+
+        returns the filled, rejected and still open orders by id
+    """
+    matched = books.match(prices)
+    if not matched:
+        return {}
+    return fill_orders(matched)
+
+
+def fill_orders(order_ids):
+    """
+        fill the given orders at the current prices if they are still open and triggered
+
+        the orders of each account are filled as one batch in one database transaction,
+        returns {order id: "filled" | "rejected" | "open"}
+    """
+    by_user = collections.defaultdict(list)
+    for pk, user_id in Order.objects.filter(pk__in=order_ids, status='open').values_list('pk', 'user_id'):
+        by_user[user_id].append(pk)
+
+    outcome = {}
+    for user_id, pks in by_user.items():
+        with transaction.atomic():
+            user_profile = UserProfile.objects.select_for_update().get(pk=user_id)
+            orders = list(
+                Order.objects.select_for_update(of=('self',)).filter(pk__in=pks, status='open').select_related('stock')
+            )
+            # fill the oldest orders first, the ones the price moved away from again stay on the book
+            orders.sort(key=lambda order: order.pk)
+            triggered = []
+            for order in orders:
+                if is_triggered(order.side, order.order_type, order.price, order.stock.current_price):
+                    triggered.append(order)
+                else:
+                    outcome[order.pk] = 'open'
+                    transaction.on_commit(lambda order=order: books.add(order))
+            if not triggered:
+                continue
+
+            results = execute_orders(user_profile, [
+                {
+                    'ticker': order.stock.ticker,
+                    'action': order.side,
+                    'shares': order.shares,
+                    'idempotency_key': f"order-{order.pk}",
+                }
+                for order in triggered
+            ])
+            closed_at = timezone.now()
+            for order, result in zip(triggered, results):
+                order.closed_at = closed_at
+                if result['status'] == 'rejected':
+                    order.status = 'rejected'
+                    order.error = result['error'][:200]
+                else:
+                    order.status = 'filled'
+                    order.transaction_id = result['transaction_id']
+                outcome[order.pk] = order.status
+            Order.objects.bulk_update(triggered, ['status', 'closed_at', 'transaction', 'error'])
+            # the bulk update sends no signals, the user's pages show their open orders
+            transaction.on_commit(lambda user_id=user_id: bump_holdings_version(user_id))
+    return outcome
+
+
+def sweep(batch_size=500):
+    """
+        reload the books and match every stock with open orders at its current price, returns the outcome
+    """
+    books.clear()
+    stock_ids = Order.objects.filter(status='open').values_list('stock_id', flat=True).distinct()
+    prices = dict(Stock.objects.filter(pk__in=stock_ids).values_list('pk', 'current_price'))
+    outcome = {}
+    stock_ids = list(prices)
+    for start in range(0, len(stock_ids), batch_size):
+        outcome.update(match_orders({stock_id: prices[stock_id] for stock_id in stock_ids[start:start + batch_size]}))
+    return outcome
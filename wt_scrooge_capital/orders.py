@@ -0,0 +1,265 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/orders.py
+
+# Order execution for buying and selling stocks
+
+# Every order runs in one database transaction. The user's profile row is locked
+# first (select_for_update), which serializes the orders of a single account
+# while orders from different accounts run in parallel. Share counts are changed
+# with F() expressions, and a sell only succeeds if the conditional update finds
+# enough shares, so concurrent submissions can't lose updates or oversell.
+# Buys open tax lots and sells close them by the user's lot method, which also
+# decides the cost basis a sell removes and the P&L it realizes (see lots.py).
+# Each trade is added to the user's PortfolioValuation in the same transaction
+# (see valuations.py). The fill price is read again with the stock row locked,
+# so a stale Stock instance or a concurrent price update can't trade at an old
+# price.
+#
+# An order may carry an idempotency key. Re-submitting the same key (a double
+# click, a retried request) returns the original Transaction instead of
+# trading twice.
+
+
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .lots import LotBook
+from .models import Portfolio, Stock, Transaction, UserProfile
+from .profiling import profiled
+from .valuations import apply_trade
+from .versions import bump_holdings_version
+
+
+class OrderError(Exception):
+    """
+        Raised when an order can't be executed, e.g. selling more shares than are owned
+    """
+
+
+@profiled('order')
+def execute_order(user_profile, stock, action, shares, idempotency_key=None):
+    """
+        buy or sell shares of a stock at its current price for the user
+
+        returns the recorded Transaction, raises OrderError if the order is rejected
+    """
+    if action not in ('buy', 'sell'):
+        raise OrderError(f"Unknown action: {action}")
+    if shares <= 0:
+        raise OrderError("The number of shares must be positive.")
+
+    try:
+        with transaction.atomic():
+            # lock the account so its orders are applied one at a time
+            account = UserProfile.objects.select_for_update().only('pk', 'lot_method').get(pk=user_profile.pk)
+
+            if idempotency_key:
+                existing = Transaction.objects.filter(user=user_profile, idempotency_key=idempotency_key).first()
+                if existing:
+                    return existing
+
+            today = datetime.date.today()
+            # the caller's instance may be stale, fill at the price under a lock so a price update can't interleave
+            price = Stock.objects.select_for_update().only('current_price').get(pk=stock.pk).current_price
+            lots = LotBook(user_profile, [stock.pk], account.lot_method)
+            lot, pnl = None, None
+            if action == 'buy':
+                cost = shares * price
+                updated = Portfolio.objects.filter(user=user_profile, stock=stock).update(
+                    shares=F('shares') + shares,
+                    purchase_price=price,
+                    cost_basis=F('cost_basis') + cost,
+                )
+                if not updated:
+                    Portfolio.objects.create(
+                        user=user_profile,
+                        stock=stock,
+                        shares=shares,
+                        purchase_price=price,
+                        purchase_date=today,
+                        cost_basis=cost,
+                    )
+                lot = lots.buy(stock, shares, price, today)
+            else:
+                item = Portfolio.objects.filter(user=user_profile, stock=stock).only('pk', 'stock_id', 'shares', 'cost_basis').first()
+                if item is None or item.shares < shares:
+                    raise OrderError(f"Not enough shares of {stock.ticker} to sell {shares}.")
+
+                # the sold shares take the cost of the lots they close with them
+                cost, pnl = lots.sell(item, shares, price)
+                # only succeeds if the position still holds enough shares
+                updated = Portfolio.objects.filter(pk=item.pk, shares__gte=shares).update(
+                    shares=F('shares') - shares,
+                    cost_basis=F('cost_basis') - cost,
+                )
+                if not updated:
+                    raise OrderError(f"Not enough shares of {stock.ticker} to sell {shares}.")
+                Portfolio.objects.filter(pk=item.pk, shares=0).delete()
+
+            new_transaction = Transaction.objects.create(
+                user=user_profile,
+                stock=stock,
+                shares=shares,
+                purchase_price=price,
+                purchase_date=today,
+                transaction_type=action,
+                idempotency_key=idempotency_key or None,
+                realized_pnl=pnl,
+            )
+            if lot:
+                lot.transaction = new_transaction
+            realized = lots.save()
+            if action == 'buy':
+                apply_trade(user_profile, shares, shares * price, cost)
+            else:
+                apply_trade(user_profile, -shares, -shares * price, -cost, realized)
+            return new_transaction
+    except IntegrityError:
+        # a concurrent request with the same key won the race, return its result
+        if idempotency_key:
+            existing = Transaction.objects.filter(user=user_profile, idempotency_key=idempotency_key).first()
+            if existing:
+                return existing
+        raise
+
+
+@profiled('orders')
+def execute_orders(user_profile, orders):
+    """
+        execute a batch of orders for the user in one database transaction
+
+        `orders` is a list of dicts with "ticker", "action", "shares" and an optional "idempotency_key".
+        Orders are applied in the given order and each one is accepted or rejected on its own, so an
+        oversell later in the batch doesn't undo the orders before it. Returns one result dict per order:
+        {"status": "filled" | "duplicate" | "rejected", "transaction_id": ..., "error": ...}
+    """
+    results = [None] * len(orders)
+    valid = []
+
+    # validate the shape of every order before touching the database
+    for index, order in enumerate(orders):
+        try:
+            ticker = str(order['ticker']).upper()
+            action = order['action']
+            shares = order['shares']
+            key = order.get('idempotency_key') or None
+        except (KeyError, TypeError, AttributeError):
+            results[index] = {'status': 'rejected', 'error': "Orders need a ticker, an action and shares."}
+            continue
+        if action not in ('buy', 'sell'):
+            results[index] = {'status': 'rejected', 'error': f"Unknown action: {action}"}
+        elif not isinstance(shares, int) or isinstance(shares, bool) or shares <= 0:
+            results[index] = {'status': 'rejected', 'error': "The number of shares must be a positive integer."}
+        elif key is not None and (not isinstance(key, str) or len(key) > 64):
+            results[index] = {'status': 'rejected', 'error': "The idempotency key must be a string of at most 64 characters."}
+        else:
+            valid.append((index, ticker, action, shares, key))
+
+    if not valid:
+        return results
+
+    with transaction.atomic():
+        # lock the account so its orders are applied one at a time
+        account = UserProfile.objects.select_for_update().only('pk', 'lot_method').get(pk=user_profile.pk)
+
+        # one query each for the stocks, the positions they touch, their open lots and the already used keys,
+        # the stocks are locked so their prices stay the fill prices until the commit
+        stocks = Stock.objects.select_for_update().order_by('pk').in_bulk({ticker for _, ticker, _, _, _ in valid}, field_name='ticker')
+        positions = {
+            item.stock_id: item
+            for item in Portfolio.objects.select_for_update().filter(
+                user=user_profile, stock__in=[stock.pk for stock in stocks.values()]
+            )
+        }
+        keys = {key for *_, key in valid if key}
+        used_keys = dict(
+            Transaction.objects.filter(user=user_profile, idempotency_key__in=keys).values_list('idempotency_key', 'pk')
+        ) if keys else {}
+        lots = LotBook(user_profile, [stock.pk for stock in stocks.values()], account.lot_method)
+
+        today = datetime.date.today()
+        created, changed, new_transactions, batch_keys, batch_duplicates, new_lots = {}, {}, [], {}, [], []
+        shares_delta, value_delta, cost_delta = 0, 0, 0
+        for index, ticker, action, shares, key in valid:
+            stock = stocks.get(ticker)
+            if stock is None:
+                results[index] = {'status': 'rejected', 'error': f"Unknown ticker: {ticker}"}
+                continue
+            if key in used_keys:
+                results[index] = {'status': 'duplicate', 'transaction_id': used_keys[key]}
+                continue
+            if key in batch_keys:
+                # a repeat inside the batch is a duplicate of the order that used the key first
+                results[index] = {'status': 'duplicate'}
+                batch_duplicates.append((index, batch_keys[key]))
+                continue
+
+            item = positions.get(stock.pk)
+            lot, pnl = None, None
+            if action == 'buy':
+                if item is None:
+                    item = positions[stock.pk] = created[stock.pk] = Portfolio(
+                        user=user_profile, stock=stock, shares=0, purchase_date=today, cost_basis=0,
+                    )
+                cost = shares * stock.current_price
+                lot = lots.buy(stock, shares, stock.current_price, today)
+                item.shares += shares
+                item.purchase_price = stock.current_price
+                item.cost_basis += cost
+                shares_delta += shares
+                value_delta += shares * stock.current_price
+                cost_delta += cost
+            else:
+                if item is None or item.shares < shares:
+                    results[index] = {'status': 'rejected', 'error': f"Not enough shares of {ticker} to sell {shares}."}
+                    continue
+                cost, pnl = lots.sell(item, shares, stock.current_price)
+                item.shares -= shares
+                item.cost_basis -= cost
+                shares_delta -= shares
+                value_delta -= shares * stock.current_price
+                cost_delta -= cost
+            if item.pk:
+                changed[stock.pk] = item
+
+            new_transaction = Transaction(
+                user=user_profile,
+                stock=stock,
+                shares=shares,
+                purchase_price=stock.current_price,
+                purchase_date=today,
+                transaction_type=action,
+                idempotency_key=key,
+                realized_pnl=pnl,
+            )
+            if lot:
+                new_lots.append((lot, new_transaction))
+            if key:
+                batch_keys[key] = new_transaction
+            results[index] = {'status': 'filled'}
+            new_transactions.append((index, new_transaction))
+
+        # write the positions back in bulk, closed positions are deleted
+        Portfolio.objects.bulk_create([item for item in created.values() if item.shares > 0])
+        Portfolio.objects.bulk_update(
+            [item for item in changed.values() if item.shares > 0], ['shares', 'purchase_price', 'cost_basis']
+        )
+        Portfolio.objects.filter(pk__in=[item.pk for item in changed.values() if item.shares == 0]).delete()
+
+        Transaction.objects.bulk_create([new for _, new in new_transactions])
+        for index, new in new_transactions + batch_duplicates:
+            results[index]['transaction_id'] = new.pk
+
+        for lot, new in new_lots:
+            lot.transaction = new
+        realized = lots.save()
+        if new_transactions:
+            apply_trade(user_profile, shares_delta, value_delta, cost_delta, realized)
+
+        if new_transactions:
+            # the bulk writes send no signals, invalidate the user's cached pages here
+            transaction.on_commit(lambda: bump_holdings_version(user_profile.pk))
+
+    return results
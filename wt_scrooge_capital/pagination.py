@@ -0,0 +1,165 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/pagination.py
+
+# Keyset (cursor) pagination
+
+# Instead of OFFSET, a page starts right after the last row of the previous
+# page: with the ordering (-purchase_date, -id) the next page is
+#
+#     WHERE purchase_date < d OR (purchase_date = d AND id < i)
+#     ORDER BY purchase_date DESC, id DESC LIMIT n
+#
+# which an index on the ordering columns answers by seeking, however deep the
+# page. There is no COUNT either, one extra row is fetched to know whether
+# another page exists. The position is handed to the client as an opaque
+# cursor, the ordering values of the last row encoded in URL-safe base64.
+# A cursor coming back is checked against the ordering fields, a value of the
+# wrong type is an invalid cursor (404) like a cursor that doesn't decode.
+
+
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Q
+from django.http import Http404, JsonResponse
+
+
+def encode_cursor(values):
+    """
+        return the cursor pointing after a row with the given ordering values
+    """
+    raw = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+        return the ordering values in a cursor, raises ValueError if it isn't one
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
+
+
+def cursor_value(field, value):
+    """
+        return a decoded cursor value as a value of its ordering field, raises ValueError if it can't be one
+
+        integer fields take JSON integers, float fields numbers, and the others (text, dates) strings
+    """
+    if isinstance(field, models.IntegerField):
+        expected = (int,)
+    elif isinstance(field, models.FloatField):
+        expected = (int, float)
+    else:
+        expected = (str,)
+    if isinstance(value, bool) or not isinstance(value, expected):
+        raise ValueError(f"Invalid cursor value for {field.name}: {value!r}")
+    try:
+        return field.to_python(value)
+    except ValidationError as error:
+        raise ValueError(f"Invalid cursor value for {field.name}: {value!r}") from error
+
+
+def after(ordering, values):
+    """
+        return the filter selecting the rows that come after `values` in `ordering`
+    """
+    condition = Q()
+    for i in reversed(range(len(ordering))):
+        field = ordering[i].lstrip('-')
+        lookup = 'lt' if ordering[i].startswith('-') else 'gt'
+        equal = {ordering[j].lstrip('-'): values[j] for j in range(i)}
+        condition |= Q(**equal, **{f"{field}__{lookup}": values[i]})
+    return condition
+
+
+def keyset_page(queryset, ordering, cursor=None, size=25):
+    """
+        return (rows, next cursor) of the page starting after `cursor`, the next cursor is None on the last page
+
+        `ordering` must end with a unique field so every row has its own position
+    """
+    queryset = queryset.order_by(*ordering)
+    fields = [name.lstrip('-') for name in ordering]
+    if cursor:
+        values = decode_cursor(cursor, len(ordering))
+        values = [cursor_value(queryset.model._meta.get_field(field), value) for field, value in zip(fields, values)]
+        queryset = queryset.filter(after(ordering, values))
+
+    rows = list(queryset[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, encode_cursor([getattr(rows[-1], field) for field in fields])
+
+
+class KeysetPaginationMixin:
+    """
+        Paginates a ListView by cursor, ?cursor= picks the page and ?size= its length (up to max_page_size)
+
+        ?format=json answers with {"results": [...], "next": cursor} for infinite scrolling,
+        each row is turned into JSON by serialize(), its serialize_fields unless the view overrides it
+    """
+    keyset_ordering = ['-id']
+    page_size = 25
+    max_page_size = 100
+    serialize_fields = None  # the fields of a row in the JSON answer, every concrete field when None
+
+
+    def get_page_size(self):
+        """
+            return the requested page size, within the limits
+        """
+        try:
+            return max(1, min(int(self.request.GET['size']), self.max_page_size))
+        except (KeyError, ValueError):
+            return self.page_size
+
+
+    def paginate_keyset(self, queryset):
+        """
+            return the rows of the requested page and remember the next cursor
+        """
+        try:
+            rows, self.next_cursor = keyset_page(
+                queryset, self.keyset_ordering, self.request.GET.get('cursor'), self.get_page_size()
+            )
+        except (TypeError, ValueError, ValidationError):
+            raise Http404("Invalid page cursor.")
+        return rows
+
+
+    def get_context_data(self, **kwargs):
+        """
+            add the cursor of the next page
+        """
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = self.next_cursor
+        return context
+
+
+    def render_to_response(self, context, **response_kwargs):
+        """
+            answer with JSON when asked for it
+        """
+        if self.request.GET.get('format') == 'json':
+            return JsonResponse({
+                'results': [self.serialize(row) for row in self.object_list],
+                'next': self.next_cursor,
+            })
+        return super().render_to_response(context, **response_kwargs)
+
+
+    def serialize(self, row):
+        """
+            return the JSON form of a row, its serialize_fields (JsonResponse encodes the dates and decimals)
+        """
+        fields = self.serialize_fields or [field.attname for field in row._meta.concrete_fields]
+        return {name: getattr(row, name) for name in fields}
@@ -0,0 +1,76 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/prices.py
+
+# Price ingestion pipeline
+
+# update_prices() takes a batch of (ticker, price) updates and applies them with
+# a fixed number of statements however many rows depend on the stocks:
+#
+#   1. one SELECT for the stocks and their old prices
+#   2. bulk_update of Stock.current_price
+#   3. one set-based UPDATE refreshing WatchList.current_price for every row
+#      watching a changed stock
+#   4. one UPDATE per changed stock moving the holders' portfolio valuations
+#
+# and then sends the `prices_updated` signal, the change feed for downstream
+# caches. A single Stock.save() goes through the same fan-out (signals.py), with
+# the old price re-read under a row lock (Stock.save).
+
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.dispatch import Signal
+
+from .models import Stock, WatchList
+from .valuations import CENTS, apply_price_changes
+
+
+# sent after prices change, with `changes` mapping stock id to (ticker, old price, new price)
+prices_updated = Signal()
+
+
+def fan_out_price_changes(changes):
+    """
+        refresh everything that depends on the changed prices and send the change feed
+
+        `changes` maps stock ids to (ticker, old price, new price), the stocks are already saved
+    """
+    if not changes:
+        return
+
+    # copy the new prices onto every watchlist row of the changed stocks in one statement
+    WatchList.objects.filter(stock_id__in=list(changes)).update(
+        current_price=Subquery(Stock.objects.filter(pk=OuterRef('stock_id')).values('current_price')[:1])
+    )
+    apply_price_changes({stock_id: (old, new) for stock_id, (_, old, new) in changes.items()})
+
+    # receivers run after the commit so they never see prices that get rolled back
+    transaction.on_commit(lambda: prices_updated.send(sender=Stock, changes=changes))
+
+
+def update_prices(updates, batch_size=1000):
+    """
+        apply a batch of (ticker, price) updates, returns the changes as {stock id: (ticker, old, new)}
+
+        unknown tickers are ignored, the last update of a ticker in the batch wins
+    """
+    prices = {ticker.upper(): Decimal(str(price)).quantize(CENTS) for ticker, price in updates}
+    if not prices:
+        return {}
+
+    with transaction.atomic():
+        stocks = Stock.objects.select_for_update().filter(ticker__in=list(prices)).only('pk', 'ticker', 'current_price')
+        changes = {}
+        changed = []
+        for stock in stocks:
+            new_price = prices.get(stock.ticker.upper())
+            if new_price is not None and stock.current_price != new_price:
+                changes[stock.pk] = (stock.ticker, stock.current_price, new_price)
+                stock.current_price = new_price
+                changed.append(stock)
+
+        Stock.objects.bulk_update(changed, ['current_price'], batch_size=batch_size)
+        fan_out_price_changes(changes)
+    return changes
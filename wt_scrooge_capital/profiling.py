@@ -0,0 +1,296 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/profiling.py
+
+# Request profiling
+
+# ProfilingMiddleware times every request: the database (time and number of
+# queries), the template rendering and the named spans the code marks with
+# span() / @profiled (chart building, valuations, orders). The figures are
+# sent back in a Server-Timing header, which the browser's dev tools show
+# under the request's timing tab, and added to a rolling in-memory window
+# per view served as JSON by the staff-only `profiling/stats/` endpoint.
+# It is opt-in, add it after AuthenticationMiddleware:
+#
+#     MIDDLEWARE = [
+#         ...
+#         "django.contrib.auth.middleware.AuthenticationMiddleware",
+#         "wt_scrooge_capital.profiling.ProfilingMiddleware",
+#         ...
+#     ]
+#
+# Settings:
+#
+#   PROFILING_WINDOW       seconds of requests the stats cover (default 300)
+#   PROFILING_MAX_SAMPLES  requests kept per view at most (default 1000)
+#   PROFILING_SAMPLE_RATE  fraction of requests run under cProfile (default 0)
+#   PROFILING_DUMP_DIR     where the cProfile dumps are written
+#
+# A staff user can also profile a single request by adding ?_profile=1. The
+# dumps are regular pstats files (python -m pstats, snakeviz) and the latest
+# ones are listed by the stats endpoint. Without the middleware span() costs a
+# context variable lookup.
+
+
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import itertools
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+_current = contextvars.ContextVar('wt_scrooge_capital_profile', default=None)
+
+# only one cProfile profiler can be active per process (Python 3.12 raises ValueError on a second one),
+# a request sampled while another is being profiled simply runs without it
+_profiler_lock = threading.Lock()
+_dump_counter = itertools.count()
+
+
+def profiling_window():
+    """
+        return the number of seconds of requests the stats cover
+    """
+    return getattr(settings, 'PROFILING_WINDOW', 300)
+
+
+def profiling_dump_dir():
+    """
+        return the directory the cProfile dumps go to
+    """
+    return getattr(settings, 'PROFILING_DUMP_DIR', os.path.join(tempfile.gettempdir(), 'wt_scrooge_capital-profiles'))
+
+
+class RequestProfile:
+    """
+        the timings collected during one request
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.db_count = 0
+        self.spans = collections.defaultdict(float)
+
+
+    def add(self, name, seconds):
+        """
+            add time to a named span
+        """
+        self.spans[name] += seconds
+
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        """
+            connection.execute_wrapper hook timing every query
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.db_count += 1
+
+
+    def server_timing(self, total):
+        """
+            return the Server-Timing header value
+        """
+        metrics = [f'total;dur={total * 1000:.1f}', f'db;dur={self.db_time * 1000:.1f};desc="{self.db_count} queries"']
+        metrics += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans.items()]
+        return ', '.join(metrics)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+        time the block as a named span of the current request, if it is being profiled
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def profiled(name):
+    """
+        decorator timing every call of the function as a named span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RollingStats:
+    """
+        the timings of the recent requests of each view, thread-safe
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.dumps = collections.deque(maxlen=20)
+
+
+    def record(self, view, total, profile):
+        """
+            add a request to its view's window
+        """
+        sample = (time.monotonic(), total, profile.db_time, profile.db_count, dict(profile.spans))
+        with self.lock:
+            if view not in self.samples:
+                self.samples[view] = collections.deque(maxlen=getattr(settings, 'PROFILING_MAX_SAMPLES', 1000))
+            self.samples[view].append(sample)
+
+
+    def snapshot(self):
+        """
+            return the percentiles, histogram and average breakdown of each view over the window
+        """
+        cutoff = time.monotonic() - profiling_window()
+        with self.lock:
+            windows = {view: [sample for sample in samples if sample[0] >= cutoff] for view, samples in self.samples.items()}
+            dumps = list(self.dumps)
+
+        views = {}
+        for view, samples in windows.items():
+            if not samples:
+                continue
+            totals = sorted(sample[1] * 1000 for sample in samples)
+            spans = collections.defaultdict(float)
+            for sample in samples:
+                for name, seconds in sample[4].items():
+                    spans[name] += seconds * 1000
+            histogram = collections.Counter(
+                next((f"<={bound}ms" for bound in BUCKETS_MS if total <= bound), f">{BUCKETS_MS[-1]}ms") for total in totals
+            )
+            views[view] = {
+                'requests': len(samples),
+                'p50_ms': round(percentile(totals, 50), 2),
+                'p95_ms': round(percentile(totals, 95), 2),
+                'p99_ms': round(percentile(totals, 99), 2),
+                'max_ms': round(totals[-1], 2),
+                'mean_db_ms': round(sum(sample[2] for sample in samples) * 1000 / len(samples), 2),
+                'mean_queries': round(sum(sample[3] for sample in samples) / len(samples), 1),
+                'mean_spans_ms': {name: round(total / len(samples), 2) for name, total in spans.items()},
+                'histogram': dict(histogram),
+            }
+        return {'window_seconds': profiling_window(), 'views': views, 'profiles': dumps}
+
+
+    def clear(self):
+        """
+            forget every sample
+        """
+        with self.lock:
+            self.samples.clear()
+            self.dumps.clear()
+
+
+def percentile(ordered, q):
+    """
+        return the q-th percentile of an already sorted list (nearest rank)
+    """
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+stats = RollingStats()
+
+
+class ProfilingMiddleware:
+    """
+        Times each request and reports it in a Server-Timing header and the rolling stats
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+
+    def __call__(self, request):
+        """
+            run the request with its profile as the current one
+        """
+        profile = RequestProfile()
+        token = _current.set(profile)
+        profiler = cProfile.Profile() if self.should_sample(request) and _profiler_lock.acquire(blocking=False) else None
+        try:
+            with contextlib.ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(profile.db_wrapper))
+                if profiler:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            _current.reset(token)
+            if profiler:
+                _profiler_lock.release()
+
+        total = time.perf_counter() - profile.started
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        stats.record(view, total, profile)
+        if profiler:
+            self.dump(profiler, view)
+        response['Server-Timing'] = profile.server_timing(total)
+        return response
+
+
+    def process_template_response(self, request, response):
+        """
+            time the rendering, which happens right after this hook
+        """
+        profile = _current.get()
+        if profile is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: profile.add('template', time.perf_counter() - started))
+        return response
+
+
+    def should_sample(self, request):
+        """
+            return whether to run this request under cProfile
+        """
+        if request.GET.get('_profile') == '1':
+            user = getattr(request, 'user', None)
+            return bool(user is not None and user.is_staff)
+        rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        return rate > 0 and random.random() < rate
+
+
+    def dump(self, profiler, view):
+        """
+            write the profile of a request for pstats
+        """
+        directory = profiling_dump_dir()
+        os.makedirs(directory, exist_ok=True)
+        # the pid, thread and counter keep requests finishing in the same second from overwriting each other
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{view.replace(':', '_')}-{os.getpid()}-{threading.get_ident()}-{next(_dump_counter)}"
+        path = os.path.join(directory, f"{name}.prof")
+        profiler.dump_stats(path)
+        with stats.lock:
+            stats.dumps.append(path)
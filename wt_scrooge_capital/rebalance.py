@@ -0,0 +1,201 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/rebalance.py
+
+# Rebalancing accounts to target weights
+
+# A batch of accounts is solved at once as (accounts x stocks) matrices: the
+# shares held, the target weights and the cash each account may add, against
+# one price vector. For every account and stock the trade is the difference
+# between the target value and the held value, in shares, rounded to the
+# stock's lot size:
+#
+#   a stock whose weight is within `tolerance` of its target isn't traded
+#   a target weight of 0 sells the whole position, odd lot or not
+#   a stock held but missing from the targets is sold
+#   the sells are done first, and if their proceeds and the cash don't cover
+#   the buys, the buys of the account are scaled down and rounded down to
+#   whole lots, so an account never spends more than it has
+#
+# so the orders are the fewest trades that reach the targets within the
+# tolerance, and the whole batch costs a few array operations. Weights that
+# sum to less than 1 leave the rest in cash.
+#
+# The mean-variance mode picks the weights instead: the long-only, fully
+# invested portfolio maximizing  mean'w - risk_aversion / 2 * w'Cov w  over
+# each account's universe, with the means and covariance of the daily returns
+# from StockPriceHistory (risk.py). The accounts sharing a universe share the
+# solution, so advisors' model portfolios are solved once.
+
+
+import numpy as np
+
+from .models import Portfolio, Stock
+from .risk import aligned_returns, covariance
+
+
+class RebalanceError(Exception):
+    """
+        Raised when a rebalance can't be computed, e.g. weights above 1 or an unknown ticker
+    """
+
+
+def mean_variance_weights(means, cov, risk_aversion=3.0):
+    """
+        return the long-only weights summing to 1 maximizing means'w - risk_aversion / 2 * w'cov w,
+        by solving the equality-constrained problem and dropping the stocks it shorts until none is left
+    """
+    n = len(means)
+    free = np.ones(n, dtype=bool)
+    weights = np.zeros(n)
+    while free.any():
+        index = np.flatnonzero(free)
+        k = len(index)
+        # stationarity risk_aversion * cov w + lambda = means, with the weights summing to 1
+        system = np.zeros((k + 1, k + 1))
+        system[:k, :k] = risk_aversion * cov[np.ix_(index, index)] + 1e-10 * np.eye(k)
+        system[:k, k] = system[k, :k] = 1
+        solution = np.linalg.lstsq(system, np.append(means[index], 1.0), rcond=None)[0][:k]
+        if (solution >= -1e-12).all():
+            weights[index] = np.clip(solution, 0, None)
+            return weights / weights.sum()
+        free[index[np.argmin(solution)]] = False
+    return weights
+
+
+def solve(shares, prices, targets, cash=None, lots=None, tolerance=0.0):
+    """
+        return (buys, sells, cash left) of every account, buys and sells are (accounts x stocks) share counts
+
+        shares and targets are (accounts x stocks), prices and lots are per stock, cash is per account
+    """
+    shares = np.asarray(shares, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    cash = np.zeros(len(shares)) if cash is None else np.asarray(cash, dtype=np.float64)
+    lots = np.ones(len(prices), dtype=np.int64) if lots is None else np.asarray(lots, dtype=np.int64)
+
+    values = shares * prices
+    totals = values.sum(axis=1) + cash
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = np.where(totals[:, None] > 0, values / totals[:, None], 0.0)
+        wanted = (targets * totals[:, None] - values) / prices
+    # the trades in whole lots, a stock within the tolerance of its target stays as it is
+    delta = np.rint(wanted / lots).astype(np.int64) * lots
+    delta = np.where(np.abs(weights - targets) <= tolerance, 0, delta)
+    delta = np.where(targets == 0, -shares, delta)
+
+    sells = np.clip(-delta, 0, shares)
+    buys = np.clip(delta, 0, None)
+    available = cash + (sells * prices).sum(axis=1)
+    cost = (buys * prices).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(cost > available, available / cost, 1.0)
+    buys = np.where(
+        (scale < 1)[:, None], np.floor(buys * scale[:, None] / lots).astype(np.int64) * lots, buys,
+    )
+    return buys, sells, available - (buys * prices).sum(axis=1)
+
+
+def rebalance_accounts(accounts, mode='weights', lot_sizes=None, tolerance=0.0, risk_aversion=3.0):
+    """
+        return the orders rebalancing each account, in the order of the accounts
+
+        `accounts` is a list of {"user": UserProfile, "targets": {ticker: weight}, "cash": amount},
+        in mean-variance mode the targets only name the universe (the holdings when empty),
+        every result is {"user": pk, "orders": [...], "targets": {...}, "cash": left over}
+    """
+    lot_sizes = lot_sizes or {}
+    if any(size < 1 for size in lot_sizes.values()):
+        raise RebalanceError("The lot sizes must be at least 1 share.")
+    accounts = [{**account, 'targets': {str(ticker).upper(): weight for ticker, weight in account['targets'].items()}} for account in accounts]
+    held = {}
+    for user_id, ticker, count in Portfolio.objects.filter(
+        user__in=[account['user'] for account in accounts], shares__gt=0,
+    ).values_list('user_id', 'stock__ticker', 'shares'):
+        held.setdefault(user_id, {})[ticker] = count
+
+    tickers = sorted({ticker for account in accounts for ticker in account['targets']} | {
+        ticker for account in accounts for ticker in held.get(account['user'].pk, {})
+    })
+    stocks = {ticker: (pk, price) for pk, ticker, price in Stock.objects.filter(ticker__in=tickers).values_list('pk', 'ticker', 'current_price')}
+    unknown = sorted(set(tickers) - set(stocks))
+    if unknown:
+        raise RebalanceError(f"Unknown tickers: {', '.join(unknown)}")
+    column = {ticker: index for index, ticker in enumerate(tickers)}
+
+    shares = np.zeros((len(accounts), len(tickers)), dtype=np.int64)
+    targets = np.zeros((len(accounts), len(tickers)))
+    for row, account in enumerate(accounts):
+        for ticker, count in held.get(account['user'].pk, {}).items():
+            shares[row, column[ticker]] = count
+        for ticker, weight in account['targets'].items():
+            try:
+                weight = float(weight)
+            except (TypeError, ValueError):
+                raise RebalanceError(f"The weight of {ticker} must be a number.")
+            if not 0 <= weight <= 1:
+                raise RebalanceError(f"The weight of {ticker} must be between 0 and 1.")
+            targets[row, column[ticker]] = weight
+        if targets[row].sum() > 1 + 1e-9:
+            raise RebalanceError("The target weights of an account can't add up to more than 1.")
+
+    if mode == 'mean_variance':
+        targets = optimized_targets(accounts, shares, targets, tickers, stocks, risk_aversion)
+    elif mode != 'weights':
+        raise RebalanceError(f"Unknown mode: {mode}")
+
+    prices = np.array([float(stocks[ticker][1]) for ticker in tickers])
+    if (prices <= 0).any():
+        raise RebalanceError("Every stock needs a positive price to rebalance.")
+    lots = np.array([lot_sizes.get(ticker, 1) for ticker in tickers], dtype=np.int64)
+    cash = np.array([float(account.get('cash') or 0) for account in accounts])
+    buys, sells, left = solve(shares, prices, targets, cash, lots, tolerance)
+
+    results = []
+    for row, account in enumerate(accounts):
+        orders = [
+            {'ticker': tickers[index], 'action': 'sell', 'shares': int(sells[row, index])}
+            for index in np.flatnonzero(sells[row])
+        ] + [
+            {'ticker': tickers[index], 'action': 'buy', 'shares': int(buys[row, index])}
+            for index in np.flatnonzero(buys[row])
+        ]
+        results.append({
+            'user': account['user'].pk,
+            'orders': orders,
+            'targets': {tickers[index]: round(float(targets[row, index]), 6) for index in np.flatnonzero(targets[row])},
+            'cash': round(float(left[row]), 2),
+        })
+    return results
+
+
+def optimized_targets(accounts, shares, targets, tickers, stocks, risk_aversion):
+    """
+        return the mean-variance weights of every account over its universe, one solve per distinct universe
+    """
+    universes = (targets > 0) | np.array([[ticker in account['targets'] for ticker in tickers] for account in accounts], dtype=bool)
+    universes = np.where(universes.any(axis=1)[:, None], universes, shares > 0)
+    used = np.flatnonzero(universes.any(axis=0))
+    _, stock_ids, returns = aligned_returns([stocks[tickers[index]][0] for index in used], dtype=np.float64)
+    if len(returns) < 2:
+        raise RebalanceError("Not enough price history for the mean-variance mode.")
+    # the returns come back in stock id order, put them in ticker order
+    order = {stock_id: position for position, stock_id in enumerate(stock_ids)}
+    missing = [tickers[index] for index in used if stocks[tickers[index]][0] not in order]
+    if missing:
+        raise RebalanceError(f"No price history for: {', '.join(missing)}")
+    position = np.array([order[stocks[tickers[index]][0]] for index in used])
+    means = returns.mean(axis=0)[position]
+    cov = covariance(returns)[np.ix_(position, position)]
+
+    out = np.zeros(targets.shape)
+    solved = {}
+    local = {index: offset for offset, index in enumerate(used)}
+    for row, universe in enumerate(universes):
+        columns = np.flatnonzero(universe)
+        key = columns.tobytes()
+        if key not in solved:
+            subset = [local[index] for index in columns]
+            solved[key] = mean_variance_weights(means[subset], cov[np.ix_(subset, subset)], risk_aversion)
+        out[row, columns] = solved[key]
+    return out
@@ -0,0 +1,257 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/risk.py
+
+# Portfolio risk analytics
+
+# The daily closes of a user's holdings over the lookback are loaded from
+# StockPriceHistory (backtest.load_closes) and turned into one aligned return
+# matrix, days x holdings. From it come
+#
+#   covariance and correlation matrices of the holdings
+#   beta of every holding against the market
+#   parametric (variance-covariance) and historical value at risk
+#
+# The matrices only depend on which stocks are held and on their price
+# histories, so they are cached under the user's holdings version and the
+# price versions of the held stocks (versions.py). The VaR figures depend on
+# the current weights as well and are computed from the cached matrices on
+# every call, which costs a matrix-vector product.
+#
+# The covariance is accumulated over blocks of RISK_CHUNK_ROWS days, so the
+# temporary products stay small for portfolios with hundreds of positions,
+# and RISK_DTYPE = "float32" halves the memory of the return matrix and the
+# blocks (the sums are still accumulated in float64). The market is
+# RISK_BENCHMARK if it names a stock, or else the equal-weighted average of
+# every stock, computed a block of stocks at a time and cached for the day.
+
+
+import datetime
+import hashlib
+import math
+from statistics import NormalDist
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+import numpy as np
+
+from .backtest import load_closes
+from .models import Portfolio, Stock
+from .versions import get_holdings_version, get_price_versions
+
+
+def risk_lookback():
+    """
+        return the number of daily returns the risk figures are computed over
+    """
+    return getattr(settings, 'RISK_LOOKBACK_DAYS', 252)
+
+
+def risk_dtype():
+    """
+        return the float type of the return matrices, float64 or float32
+    """
+    return np.dtype(getattr(settings, 'RISK_DTYPE', 'float64'))
+
+
+def risk_chunk_rows():
+    """
+        return the number of days multiplied at a time when accumulating the covariance
+    """
+    return getattr(settings, 'RISK_CHUNK_ROWS', 256)
+
+
+def risk_cache_timeout():
+    """
+        return how long the risk matrices are cached, in seconds
+    """
+    return getattr(settings, 'RISK_CACHE_TIMEOUT', 3600)
+
+
+def lookback_start(lookback):
+    """
+        return the first calendar day needed for `lookback` daily returns, with room for weekends and holidays
+    """
+    return datetime.date.today() - datetime.timedelta(days=math.ceil((lookback + 1) * 7 / 5) + 10)
+
+
+def aligned_returns(stock_ids, lookback=None, dtype=None):
+    """
+        return (dates, stock ids, returns) with the daily returns of the stocks over the same days,
+        the days before every stock has a price are dropped
+    """
+    lookback = lookback or risk_lookback()
+    dates, stock_ids, closes = load_closes(stock_ids, start=lookback_start(lookback))
+    if len(dates) < 2:
+        return dates[:0], stock_ids, np.empty((0, len(stock_ids)), dtype=dtype or risk_dtype())
+    complete = ~np.isnan(closes).any(axis=1)
+    first = int(np.argmax(complete)) if complete.any() else len(closes)
+    closes = closes[first:][-(lookback + 1):]
+    returns = (closes[1:] / closes[:-1] - 1).astype(dtype or risk_dtype())
+    return dates[first:][-(lookback + 1):][1:], stock_ids, returns
+
+
+def covariance(returns, chunk_rows=None):
+    """
+        return the sample covariance matrix of the columns, accumulated in float64 a block of days at a time
+    """
+    days, columns = returns.shape
+    if days < 2:
+        return np.full((columns, columns), np.nan)
+    chunk_rows = chunk_rows or risk_chunk_rows()
+    means = returns.mean(axis=0, dtype=np.float64)
+    total = np.zeros((columns, columns))
+    for start in range(0, days, chunk_rows):
+        block = returns[start:start + chunk_rows] - means.astype(returns.dtype)
+        total += (block.T @ block).astype(np.float64)
+    return total / (days - 1)
+
+
+def correlation(cov):
+    """
+        return the correlation matrix of a covariance matrix, NaN for columns that never moved
+    """
+    deviation = np.sqrt(np.diag(cov))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cov / np.outer(deviation, deviation)
+
+
+def market_returns(lookback=None, block=500):
+    """
+        return (dates, returns) of the market: the RISK_BENCHMARK stock, or the equal-weighted average of all
+        stocks computed `block` stocks at a time, cached for the day
+    """
+    lookback = lookback or risk_lookback()
+    benchmark = getattr(settings, 'RISK_BENCHMARK', None)
+    key = f"wt_scrooge_capital:market-returns:{benchmark}:{lookback}:{datetime.date.today()}"
+    market = cache.get(key)
+    if market is not None:
+        return market
+
+    benchmark_id = Stock.objects.filter(ticker=benchmark).values_list('pk', flat=True).first() if benchmark else None
+    if benchmark_id:
+        dates, _, returns = aligned_returns([benchmark_id], lookback, np.float64)
+        market = (dates, returns[:, 0])
+    else:
+        totals, counts = {}, {}
+        stock_ids = list(Stock.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(stock_ids), block):
+            dates, _, closes = load_closes(stock_ids[start:start + block], start=lookback_start(lookback))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                returns = closes[1:] / closes[:-1] - 1
+            for date, total, count in zip(dates[1:], np.nansum(returns, axis=1), (~np.isnan(returns)).sum(axis=1)):
+                totals[date] = totals.get(date, 0.0) + total
+                counts[date] = counts.get(date, 0) + count
+        dates = np.array(sorted(date for date in totals if counts[date]), dtype='datetime64[D]')[-lookback:]
+        market = (dates, np.array([totals[date] / counts[date] for date in dates]))
+    cache.set(key, market, risk_cache_timeout())
+    return market
+
+
+def betas(dates, returns, market):
+    """
+        return the beta of every column against the market over the days they share
+    """
+    market_dates, market_values = market
+    _, ours, theirs = np.intersect1d(dates, market_dates, return_indices=True)
+    if len(ours) < 2:
+        return np.full(returns.shape[1], np.nan)
+    x = returns[ours].astype(np.float64)
+    m = market_values[theirs]
+    m = m - m.mean()
+    variance = m @ m
+    if variance == 0:
+        return np.full(returns.shape[1], np.nan)
+    return (x - x.mean(axis=0)).T @ m / variance
+
+
+def risk_matrices(user_profile, stock_ids):
+    """
+        return the cached return, covariance, correlation and beta figures of the held stocks,
+        keyed by the holdings version and the price versions of the stocks
+    """
+    versions = get_price_versions(stock_ids)
+    digest = hashlib.md5(repr(sorted(versions.items())).encode(), usedforsecurity=False).hexdigest()
+    key = (
+        f"wt_scrooge_capital:risk:{user_profile.pk}:{get_holdings_version(user_profile.pk)}:{digest}:"
+        f"{risk_lookback()}:{risk_dtype().name}:{datetime.date.today()}"
+    )
+    matrices = cache.get(key)
+    if matrices is None:
+        dates, stock_ids, returns = aligned_returns(stock_ids)
+        cov = covariance(returns)
+        matrices = {
+            'dates': dates,
+            'stock_ids': stock_ids,
+            'returns': returns,
+            'covariance': cov,
+            'correlation': correlation(cov),
+            'betas': betas(dates, returns, market_returns()),
+        }
+        cache.set(key, matrices, risk_cache_timeout())
+    return matrices
+
+
+def value_at_risk(weights, value, matrices, confidence=0.95, horizon=1):
+    """
+        return the parametric and historical VaR of the portfolio over `horizon` days, as positive amounts
+    """
+    returns, cov = matrices['returns'], matrices['covariance']
+    if len(returns) < 2:
+        return {'parametric': None, 'historical': None}
+    z = NormalDist().inv_cdf(confidence)
+    mean = float(returns.mean(axis=0, dtype=np.float64) @ weights)
+    sigma = math.sqrt(max(float(weights @ cov @ weights), 0.0))
+    portfolio = returns.astype(np.float64) @ weights
+    scale = math.sqrt(horizon)
+    return {
+        'parametric': round(max(z * sigma * scale - mean * horizon, 0.0) * value, 2),
+        'historical': round(max(-float(np.percentile(portfolio, (1 - confidence) * 100)) * scale, 0.0) * value, 2),
+    }
+
+
+def portfolio_risk(user_profile, confidence=0.95, horizon=1, include_matrices=False):
+    """
+        return the risk figures of the user's portfolio at the current prices
+    """
+    positions = list(
+        Portfolio.objects.filter(user=user_profile)
+        .annotate(value=F('shares') * F('stock__current_price'))
+        .order_by('stock_id')
+        .values_list('stock_id', 'stock__ticker', 'value')
+    )
+    if not positions:
+        return {'positions': [], 'value': 0, 'var': {'parametric': None, 'historical': None}, 'beta': None}
+
+    matrices = risk_matrices(user_profile, [stock_id for stock_id, _, _ in positions])
+    values = {stock_id: float(value) for stock_id, _, value in positions}
+    tickers = {stock_id: ticker for stock_id, ticker, _ in positions}
+    # the stocks without history have no column, they don't add to the risk figures
+    value = sum(values[stock_id] for stock_id in matrices['stock_ids'])
+    weights = np.array([values[stock_id] / value if value else 0.0 for stock_id in matrices['stock_ids']])
+    betas_ = matrices['betas']
+    deviation = np.sqrt(np.diag(matrices['covariance']))
+
+    report = {
+        'days': len(matrices['returns']),
+        'value': round(value, 2),
+        'confidence': confidence,
+        'horizon': horizon,
+        'var': value_at_risk(weights, value, matrices, confidence, horizon),
+        'beta': None if np.isnan(betas_).any() or not len(betas_) else round(float(weights @ betas_), 4),
+        'positions': [
+            {
+                'ticker': tickers[stock_id],
+                'weight': round(float(weights[index]), 6),
+                'volatility': None if np.isnan(deviation[index]) else round(float(deviation[index]), 6),
+                'beta': None if np.isnan(betas_[index]) else round(float(betas_[index]), 4),
+            }
+            for index, stock_id in enumerate(matrices['stock_ids'])
+        ],
+        'no_history': sorted(tickers[stock_id] for stock_id in values if stock_id not in set(matrices['stock_ids'])),
+    }
+    if include_matrices:
+        report['tickers'] = [tickers[stock_id] for stock_id in matrices['stock_ids']]
+        report['covariance'] = np.round(matrices['covariance'], 8).tolist()
+        report['correlation'] = np.round(np.nan_to_num(matrices['correlation']), 4).tolist()
+    return report
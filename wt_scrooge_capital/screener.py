@@ -0,0 +1,268 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/screener.py
+
+# Market screener over an in-memory columnar snapshot
+
+# The latest metrics of every stock are kept in one NumPy array per column:
+#
+#   price          current price
+#   last_close     close of the latest daily StockPriceHistory record
+#   change         price / last_close - 1
+#   region, type   of the latest daily record, as integer codes
+#   volatility, rsi, sma, max_drawdown   from StockIndicators
+#
+# A screen is a set of predicates (`price__gte=10`, `region=United States`,
+# `type__in=Equity,ETF`) combined into one boolean mask, and an optional top-K
+# sort done with argpartition, so it costs a few vectorized passes over the
+# columns whatever the number of predicates, with no query at all.
+#
+# Each process builds its snapshot on first use (three queries). Committed
+# price changes of this process are written into the price column in place
+# (signals.py). On every screen the stock list version (versions.py) tells
+# whether another process changed prices or stocks since, and then only the
+# prices are reloaded (the whole snapshot if stocks were added or removed).
+# The history and indicator columns are rebuilt once the snapshot is older
+# than SCREENER_MAX_AGE seconds (default 300).
+
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+import numpy as np
+
+from .models import Stock, StockIndicators, StockPriceHistory
+from .versions import get_stock_list_version
+
+
+NUMERIC_COLUMNS = ['price', 'last_close', 'change', 'volatility', 'rsi', 'sma', 'max_drawdown']
+CATEGORY_COLUMNS = ['region', 'type']
+OPERATORS = {
+    'eq': np.equal,
+    'ne': np.not_equal,
+    'lt': np.less,
+    'lte': np.less_equal,
+    'gt': np.greater,
+    'gte': np.greater_equal,
+}
+
+
+class ScreenError(Exception):
+    """
+        Raised when a screen can't be run, e.g. an unknown column or a value that isn't a number
+    """
+
+
+def screener_max_age():
+    """
+        return how many seconds the history and indicator columns are used before a rebuild
+    """
+    return getattr(settings, 'SCREENER_MAX_AGE', 300)
+
+
+class Snapshot:
+    """
+        the latest metrics of every stock, one NumPy array per column
+    """
+
+    def __init__(self):
+        latest = StockPriceHistory.objects.filter(stock=OuterRef('pk')).order_by('-date')
+        rows = list(
+            Stock.objects.order_by('pk').annotate(
+                last_close=Subquery(latest.values('close_price')[:1]),
+                region=Subquery(latest.values('region')[:1]),
+                type=Subquery(latest.values('type')[:1]),
+            ).values_list('pk', 'ticker', 'company_name', 'current_price', 'last_close', 'region', 'type')
+        )
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.tickers = np.array([row[1] for row in rows], dtype=object)
+        self.names = np.array([row[2] for row in rows], dtype=object)
+        self.rows = {stock_id: index for index, stock_id in enumerate(self.ids.tolist())}
+        self.columns = {
+            'price': np.array([row[3] for row in rows], dtype=np.float64),
+            'last_close': np.array([np.nan if row[4] is None else row[4] for row in rows], dtype=np.float64),
+        }
+        self.categories = {}
+        for offset, name in ((5, 'region'), (6, 'type')):
+            labels, codes = np.unique(np.array([row[offset] or '' for row in rows], dtype=object), return_inverse=True)
+            self.categories[name] = (labels.tolist(), codes.astype(np.int32))
+
+        for name in ('volatility', 'rsi', 'sma', 'max_drawdown'):
+            self.columns[name] = np.full(len(rows), np.nan)
+        for stock_id, *values in StockIndicators.objects.values_list('stock_id', 'volatility', 'rsi', 'sma', 'max_drawdown'):
+            index = self.rows.get(stock_id)
+            if index is not None:
+                for name, value in zip(('volatility', 'rsi', 'sma', 'max_drawdown'), values):
+                    self.columns[name][index] = np.nan if value is None else value
+
+        self.update_change()
+        self.built_at = time.monotonic()
+        self.version = None
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def update_change(self, index=slice(None)):
+        """
+            recompute the change since the last close of some rows
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.columns.setdefault('change', np.full(len(self.ids), np.nan))[index] = (
+                self.columns['price'][index] / self.columns['last_close'][index] - 1
+            )
+
+
+    def apply_prices(self, prices):
+        """
+            write new prices into the price column, `prices` maps stock ids to prices,
+            returns False if a stock isn't in the snapshot
+        """
+        known = [(self.rows[stock_id], float(price)) for stock_id, price in prices.items() if stock_id in self.rows]
+        if known:
+            index, values = np.array([row for row, _ in known]), np.array([value for _, value in known])
+            self.columns['price'][index] = values
+            self.update_change(index)
+        return len(known) == len(prices)
+
+
+    def mask(self, filters):
+        """
+            return the boolean mask of the rows matching every (column, operator, value) filter
+        """
+        mask = np.ones(len(self.ids), dtype=bool)
+        for column, operator, value in filters:
+            if column in self.categories:
+                labels, codes = self.categories[column]
+                wanted = value.split(',') if operator == 'in' else [value]
+                matched = np.isin(codes, [labels.index(label) for label in wanted if label in labels])
+                if operator == 'ne':
+                    matched = ~matched
+                elif operator not in ('eq', 'in'):
+                    raise ScreenError(f"{column} only supports equality filters.")
+                mask &= matched
+            elif column in self.columns:
+                try:
+                    if operator == 'in':
+                        mask &= np.isin(self.columns[column], [float(part) for part in value.split(',')])
+                    else:
+                        mask &= OPERATORS[operator](self.columns[column], float(value))
+                except (KeyError, ValueError):
+                    raise ScreenError(f"Bad filter: {column}__{operator}={value}")
+            else:
+                raise ScreenError(f"Unknown column: {column}")
+        return mask
+
+
+    def top(self, mask, sort=None, limit=50):
+        """
+            return the indexes of the matching rows, the first `limit` by the sort column ("-" for descending)
+        """
+        matching = np.flatnonzero(mask)
+        if not sort:
+            return matching[:limit]
+        descending = sort.startswith('-')
+        column = sort.lstrip('-')
+        if column not in self.columns:
+            raise ScreenError(f"Can't sort by {column}.")
+
+        # NaNs sort last either way
+        keys = self.columns[column][matching]
+        keys = np.where(np.isnan(keys), np.inf, -keys if descending else keys)
+        if limit < len(matching):
+            partition = np.argpartition(keys, limit)[:limit]
+            return matching[partition[np.argsort(keys[partition], kind='stable')]]
+        return matching[np.argsort(keys, kind='stable')]
+
+
+    def row(self, index):
+        """
+            return the JSON form of one row
+        """
+        row = {'id': int(self.ids[index]), 'ticker': self.tickers[index], 'company_name': self.names[index]}
+        for name, (labels, codes) in self.categories.items():
+            row[name] = labels[codes[index]] or None
+        for name in NUMERIC_COLUMNS:
+            value = self.columns[name][index]
+            row[name] = None if np.isnan(value) else round(float(value), 6)
+        return row
+
+
+class Screener:
+    """
+        the snapshot of this process, built on first use and kept up to date, thread-safe
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+
+    def current(self):
+        """
+            return an up-to-date snapshot, call it with the lock held
+        """
+        version = get_stock_list_version()
+        snapshot = self.snapshot
+        if snapshot is None or time.monotonic() - snapshot.built_at > screener_max_age():
+            snapshot = Snapshot()
+        elif snapshot.version != version:
+            # prices or stocks changed in another process, reload the prices and see if the stocks are the same
+            prices = dict(Stock.objects.values_list('pk', 'current_price'))
+            if len(prices) != len(snapshot) or not snapshot.apply_prices(prices):
+                snapshot = Snapshot()
+        snapshot.version = version
+        self.snapshot = snapshot
+        return snapshot
+
+
+    def apply_prices(self, prices):
+        """
+            write committed price changes of this process into the snapshot, if there is one
+        """
+        with self.lock:
+            if self.snapshot is not None:
+                if self.snapshot.apply_prices(prices):
+                    self.snapshot.version = get_stock_list_version()
+                else:
+                    self.snapshot = None
+
+
+    def screen(self, filters, sort=None, limit=50):
+        """
+            return (the number of matching stocks, the first `limit` rows)
+        """
+        with self.lock:
+            snapshot = self.current()
+            mask = snapshot.mask(filters)
+            return int(mask.sum()), [snapshot.row(index) for index in snapshot.top(mask, sort, limit)]
+
+
+    def clear(self):
+        """
+            drop the snapshot, it is built again on the next screen
+        """
+        with self.lock:
+            self.snapshot = None
+
+
+screener = Screener()
+
+
+def parse_filters(params):
+    """
+        return the (column, operator, value) filters of query parameters like price__gte=10,
+        the sort and limit parameters are skipped
+    """
+    filters = []
+    for key, value in params.items():
+        if key in ('sort', 'limit', 'format'):
+            continue
+        column, _, operator = key.partition('__')
+        operator = operator or 'eq'
+        if operator not in OPERATORS and operator != 'in':
+            raise ScreenError(f"Unknown operator: {operator}")
+        filters.append((column, operator, value))
+    return filters
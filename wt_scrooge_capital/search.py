@@ -0,0 +1,123 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/search.py
+
+# Typeahead search over tickers and company names
+
+# The index keeps every searchable key in a sorted list: the tickers, the
+# company names and every word of the company names, lowercased. The keys
+# starting with a prefix are one contiguous range of that list, found with two
+# binary searches, so a lookup costs O(log n) plus the matches it looks at,
+# like walking a prefix trie but in a few flat lists instead of a node per
+# character. Matches are ranked
+#
+#   0  the ticker is the query
+#   1  the ticker starts with the query
+#   2  the company name starts with the query
+#   3  a word of the company name starts with the query
+#
+# then by ticker length and ticker, and each stock is listed once.
+#
+# Each process builds its index on first use with one query. Adding,
+# removing, renaming or re-ticking a stock bumps the search version
+# (versions.py, signals.py), and every process rebuilds its index on its next
+# search after that. Price changes don't touch the index.
+
+
+import bisect
+import re
+import threading
+
+from .models import Stock
+from .versions import get_search_version
+
+
+RANK_TICKER, RANK_TICKER_PREFIX, RANK_NAME_PREFIX, RANK_WORD_PREFIX = range(4)
+
+# the most keys looked at per range, a one-letter query doesn't rank the whole listing
+SCAN_LIMIT = 2000
+
+
+class SearchIndex:
+    """
+        the sorted prefix keys of every stock
+    """
+
+    def __init__(self):
+        self.stocks = list(Stock.objects.order_by('ticker').values_list('pk', 'ticker', 'company_name'))
+        tickers, names, words = [], [], []
+        for index, (_, ticker, company_name) in enumerate(self.stocks):
+            tickers.append((ticker.lower(), index))
+            names.append((company_name.lower(), index))
+            words.extend((word, index) for word in set(re.findall(r"\w+", company_name.lower())))
+        self.keys = {
+            RANK_TICKER_PREFIX: sorted(tickers),
+            RANK_NAME_PREFIX: sorted(names),
+            RANK_WORD_PREFIX: sorted(words),
+        }
+        self.version = None
+
+
+    def prefix_range(self, keys, prefix):
+        """
+            return the (key, stock index) pairs of a sorted key list starting with the prefix
+        """
+        start = bisect.bisect_left(keys, (prefix,))
+        end = bisect.bisect_left(keys, (prefix + '\U0010ffff',), lo=start)
+        return keys[start:min(end, start + SCAN_LIMIT)]
+
+
+    def search(self, query, limit=10):
+        """
+            return the best `limit` stocks for the query as dicts, best first
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        best = {}
+        for rank, keys in self.keys.items():
+            for key, index in self.prefix_range(keys, query):
+                if rank == RANK_TICKER_PREFIX and key == query:
+                    best[index] = RANK_TICKER
+                elif best.get(index, rank + 1) > rank:
+                    best[index] = rank
+
+        ranked = sorted(best, key=lambda index: (best[index], len(self.stocks[index][1]), self.stocks[index][1]))
+        return [
+            {'id': self.stocks[index][0], 'ticker': self.stocks[index][1], 'company_name': self.stocks[index][2]}
+            for index in ranked[:limit]
+        ]
+
+
+class StockSearch:
+    """
+        the search index of this process, rebuilt when the search version moves, thread-safe
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+
+
+    def search(self, query, limit=10):
+        """
+            return the best `limit` stocks for the query
+        """
+        version = get_search_version()
+        with self.lock:
+            if self.index is None or self.index.version != version:
+                self.index = SearchIndex()
+                self.index.version = version
+            index = self.index
+        return index.search(query, limit)
+
+
+    def clear(self):
+        """
+            drop the index, it is built again on the next search
+        """
+        with self.lock:
+            self.index = None
+
+
+stock_search = StockSearch()
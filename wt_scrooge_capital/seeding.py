@@ -0,0 +1,184 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/seeding.py
+
+# Synthetic data for benchmarks
+
+# seed_data() fills the database with a reproducible market and user base:
+# stocks with a daily StockPriceHistory record each and optionally a long run
+# of hourly PriceBars, and users who hold (with one open tax lot per
+# position), watch and have traded some of them. Everything is written with
+# bulk_create, rows are tagged with a prefix (tickers, usernames) so they
+# never collide with real data and can be deleted again with
+# clear_seed_data().
+
+
+import datetime
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+import numpy as np
+
+from .models import Portfolio, PriceBar, Stock, StockPriceHistory, TaxLot, Transaction, UserProfile, WatchList
+from .valuations import rebuild_valuation
+from .versions import bump_price_version, bump_stock_versions
+
+
+def seed_data(users=1000, stocks=500, positions=20, watched=20, transactions=50, history_days=30, bars=0,
+              prefix="B", batch_size=5000, seed=0):
+    """
+        create the synthetic data, returns the number of rows created per model
+    """
+    rng = np.random.default_rng(seed)
+    positions = min(positions, stocks)
+    watched = min(watched, stocks)
+    today = datetime.date.today()
+
+    with transaction.atomic():
+        prices = np.round(rng.uniform(5, 500, size=stocks), 2)
+        stock_rows = Stock.objects.bulk_create(
+            [
+                Stock(ticker=f"{prefix}{i:05d}", company_name=f"Bench Company {i}", current_price=float(prices[i]))
+                for i in range(stocks)
+            ],
+            batch_size=batch_size,
+        )
+
+        history = []
+        for i, stock in enumerate(stock_rows):
+            walk = prices[i] * np.exp(np.cumsum(rng.normal(0, 0.01, size=(history_days, 24)), axis=1))
+            for day in range(history_days):
+                history.append(StockPriceHistory(
+                    stock=stock,
+                    date=today - datetime.timedelta(days=history_days - day),
+                    open_price=round(float(walk[day, 0]), 2),
+                    close_price=round(float(walk[day, -1]), 2),
+                    region="United States",
+                    type="Equity",
+                    price_history=walk[day].tolist(),
+                ))
+        StockPriceHistory.objects.bulk_create(history, batch_size=batch_size)
+        # bulk_create sends no signals, invalidate what is cached against the stocks once they're committed
+        stock_ids = [stock.pk for stock in stock_rows]
+        transaction.on_commit(lambda: (bump_stock_versions(*stock_ids), bump_price_version(*stock_ids)))
+        bar_count = seed_bars(stock_rows, bars, rng, batch_size) if bars else 0
+
+        password = make_password(None)
+        user_rows = User.objects.bulk_create(
+            [User(username=f"{prefix.lower()}-user-{i}", password=password) for i in range(users)],
+            batch_size=batch_size,
+        )
+        profiles = UserProfile.objects.bulk_create(
+            [
+                UserProfile(user=user, first_name="Bench", last_name=str(i), email=f"{prefix.lower()}-user-{i}@example.com")
+                for i, user in enumerate(user_rows)
+            ],
+            batch_size=batch_size,
+        )
+
+        held, watching, trades = [], [], []
+        for profile in profiles:
+            for index in rng.choice(stocks, size=positions, replace=False):
+                stock = stock_rows[index]
+                shares = int(rng.integers(1, 100))
+                held.append(Portfolio(
+                    user=profile,
+                    stock=stock,
+                    shares=shares,
+                    purchase_price=stock.current_price,
+                    purchase_date=today,
+                    cost_basis=round(shares * stock.current_price, 2),
+                ))
+            for index in rng.choice(stocks, size=watched, replace=False):
+                stock = stock_rows[index]
+                watching.append(WatchList(
+                    user=profile, stock=stock, added_price=stock.current_price, current_price=stock.current_price
+                ))
+            days = rng.integers(0, 365, size=transactions)
+            for index, day in zip(rng.integers(0, stocks, size=transactions), days):
+                stock = stock_rows[index]
+                trades.append(Transaction(
+                    user=profile,
+                    stock=stock,
+                    shares=int(rng.integers(1, 100)),
+                    purchase_price=stock.current_price,
+                    purchase_date=today - datetime.timedelta(days=int(day)),
+                    transaction_type='buy' if rng.random() < 0.7 else 'sell',
+                ))
+        Portfolio.objects.bulk_create(held, batch_size=batch_size)
+        TaxLot.objects.bulk_create(
+            [
+                TaxLot(
+                    user=item.user,
+                    stock=item.stock,
+                    opened_on=item.purchase_date,
+                    shares=item.shares,
+                    remaining_shares=item.shares,
+                    price=item.stock.current_price,
+                )
+                for item in held
+            ],
+            batch_size=batch_size,
+        )
+        WatchList.objects.bulk_create(watching, batch_size=batch_size)
+        Transaction.objects.bulk_create(trades, batch_size=batch_size)
+
+        for profile in profiles:
+            rebuild_valuation(profile)
+
+    return {
+        'stocks': len(stock_rows),
+        'price history': len(history),
+        'price bars': bar_count,
+        'users': len(profiles),
+        'positions': len(held),
+        'tax lots': len(held),
+        'watchlist': len(watching),
+        'transactions': len(trades),
+    }
+
+
+def seed_bars(stock_rows, bars, rng, batch_size=5000):
+    """
+        create `bars` hourly OHLCV bars ending now for every stock, one stock at a time
+
+        returns the number of bars created
+    """
+    end = timezone.now().replace(minute=0, second=0, microsecond=0)
+    timestamps = [end - datetime.timedelta(hours=hour) for hour in range(bars - 1, -1, -1)]
+    for stock in stock_rows:
+        # a random walk ending at the stock's current price
+        walk = np.cumsum(rng.normal(0, 0.005, size=bars))
+        close = float(stock.current_price) * np.exp(walk - walk[-1])
+        open_ = np.concatenate(([close[0]], close[:-1]))
+        spread = np.abs(rng.normal(0, 0.003, size=bars)) * close
+        high = np.maximum(open_, close) + spread
+        low = np.maximum(np.minimum(open_, close) - spread, 0.01)
+        volume = rng.integers(1_000, 1_000_000, size=bars)
+        PriceBar.objects.ingest(
+            [
+                PriceBar(
+                    stock=stock,
+                    timestamp=timestamps[i],
+                    open_price=round(float(open_[i]), 2),
+                    high_price=round(float(high[i]), 2),
+                    low_price=round(float(low[i]), 2),
+                    close_price=round(float(close[i]), 2),
+                    volume=int(volume[i]),
+                )
+                for i in range(bars)
+            ],
+            batch_size=batch_size,
+        )
+    return bars * len(stock_rows)
+
+
+def clear_seed_data(prefix="B"):
+    """
+        delete the data created by seed_data() with the same prefix, the rest cascades
+    """
+    with transaction.atomic():
+        users, _ = User.objects.filter(username__startswith=f"{prefix.lower()}-user-").delete()
+        stocks, _ = Stock.objects.filter(ticker__regex=rf"^{prefix}[0-9]{{5}}$").delete()
+    return users + stocks
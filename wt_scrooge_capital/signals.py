@@ -0,0 +1,139 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/signals.py
+
+# Signal handlers of the app, connected in WtScroogeCapitalConfig.ready()
+
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .middleware import invalidate_user_profile
+from .models import Order, Portfolio, PriceBar, Stock, StockPriceHistory, Transaction, UserProfile, WatchList
+from .orderbook import match_orders, matching_enabled
+from .prices import fan_out_price_changes, prices_updated
+from .screener import screener
+from .streams import publish_price_changes
+from .versions import bump_holdings_version, bump_price_version, bump_quote_version, bump_search_version, bump_stock_list_version
+
+
+@receiver(post_save, sender=PriceBar)
+@receiver(post_delete, sender=PriceBar)
+@receiver(post_save, sender=StockPriceHistory)
+@receiver(post_delete, sender=StockPriceHistory)
+def price_history_changed(sender, instance, **kwargs):
+    """
+        new or edited prices invalidate the stock's cached charts once they are committed
+
+        bumping after the commit keeps a concurrent request from caching the old bars under the new version
+    """
+    transaction.on_commit(lambda: bump_price_version(instance.stock_id))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def user_profile_changed(sender, instance, **kwargs):
+    """
+        an edited profile must not be served from the cache
+    """
+    invalidate_user_profile(instance.user_id)
+
+
+@receiver(post_init, sender=Stock)
+def remember_stock_price(sender, instance, **kwargs):
+    """
+        keep the loaded price so a save can tell whether it changed (deferred prices are skipped)
+    """
+    instance._loaded_current_price = instance.__dict__.get('current_price')
+    instance._loaded_names = (instance.__dict__.get('ticker'), instance.__dict__.get('company_name'))
+
+
+@receiver(post_save, sender=Stock)
+def stock_price_changed(sender, instance, created, update_fields=None, **kwargs):
+    """
+        a new current price refreshes the watchlists and portfolio values holding the stock
+        (batches of prices go through prices.update_prices instead)
+
+        Stock.save() re-reads the old price under a row lock, so concurrent saves apply their deltas in turn
+    """
+    if update_fields is not None and 'current_price' not in update_fields:
+        return
+    old_price = instance._loaded_current_price
+    new_price = instance.__dict__.get('current_price')
+    if not created and old_price is not None and new_price is not None and old_price != new_price:
+        fan_out_price_changes({instance.pk: (instance.ticker, old_price, new_price)})
+    instance._loaded_current_price = new_price
+
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def stock_names_changed(sender, instance, created=False, **kwargs):
+    """
+        a new, removed, renamed or re-ticked stock makes every process rebuild its search index
+    """
+    names = (instance.__dict__.get('ticker'), instance.__dict__.get('company_name'))
+    if created or kwargs.get('signal') is post_delete or names != instance._loaded_names:
+        transaction.on_commit(bump_search_version)
+    instance._loaded_names = names
+
+
+@receiver(prices_updated)
+def push_price_changes(sender, changes, **kwargs):
+    """
+        committed price changes are pushed to the clients streaming those stocks
+    """
+    publish_price_changes(changes)
+
+
+@receiver(prices_updated)
+def fill_resting_orders(sender, changes, **kwargs):
+    """
+        committed price changes fill the limit and stop orders they trigger
+    """
+    if matching_enabled():
+        match_orders({stock_id: new_price for stock_id, (_, _, new_price) in changes.items()})
+
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def stock_changed(sender, instance, **kwargs):
+    """
+        fragments showing the stock are re-rendered once the change is committed
+    """
+    transaction.on_commit(lambda: (bump_quote_version(instance.pk), bump_stock_list_version()))
+
+
+@receiver(prices_updated)
+def quotes_changed(sender, changes, **kwargs):
+    """
+        batches of new prices (sent after the commit) invalidate the fragments showing those stocks
+    """
+    bump_quote_version(*changes)
+    bump_stock_list_version()
+
+
+@receiver(prices_updated)
+def update_screener(sender, changes, **kwargs):
+    """
+        committed price changes are written into this process's screener snapshot
+
+        connected after quotes_changed, so the snapshot records the version that includes them
+    """
+    screener.apply_prices({stock_id: new_price for stock_id, (_, _, new_price) in changes.items()})
+
+
+@receiver(post_save, sender=Portfolio)
+@receiver(post_delete, sender=Portfolio)
+@receiver(post_save, sender=WatchList)
+@receiver(post_delete, sender=WatchList)
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def holdings_changed(sender, instance, **kwargs):
+    """
+        a user's pages are re-rendered once a change to their holdings is committed
+
+        bumping after the commit keeps a concurrent request from caching the old rows under the new version
+    """
+    transaction.on_commit(lambda: bump_holdings_version(instance.user_id))
@@ -0,0 +1,335 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/streams.py
+
+# Live price push
+
+# Pages subscribe to the prices of the stocks in the user's watchlist and
+# portfolio through a Server-Sent Events stream (PriceStreamView) instead of
+# being refreshed. Every committed price change (the `prices_updated` signal)
+# is published to a broker, which hands it to the hub of each process, and the
+# hub fans it out to the subscriptions watching those stocks only. A
+# subscription coalesces the changes it receives: a stock that moves several
+# times within PRICE_STREAM_INTERVAL seconds (default 1) is pushed once, with
+# its latest price.
+#
+# The stream needs the ASGI deployment to stay open, which is what the
+# Procfile runs (uvicorn workers under gunicorn, from uvicorn-worker):
+#
+#     web: gunicorn cs412.asgi -k uvicorn_worker.UvicornWorker --log-file -
+#
+# Under WSGI (runserver, a plain gunicorn cs412.wsgi) the view answers with
+# the current prices and a `retry` hint instead of holding a worker, so the
+# browser's EventSource polls every PRICE_STREAM_RETRY seconds.
+#
+# PRICE_STREAM_BROKER picks how changes reach the hubs:
+#
+#   "local"  in-process only, for a single ASGI process (the default)
+#   "cache"  through the Django cache, for several processes sharing a cache
+#            backend (redis, memcached, database), each process polls it every
+#            PRICE_STREAM_POLL_INTERVAL seconds (default 0.5)
+
+
+import asyncio
+from decimal import Decimal
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+
+def stream_interval():
+    """
+        return the minimum number of seconds between two pushes to a subscriber
+    """
+    return getattr(settings, 'PRICE_STREAM_INTERVAL', 1.0)
+
+
+def stream_heartbeat():
+    """
+        return the seconds of silence after which a keep-alive comment is sent
+    """
+    return getattr(settings, 'PRICE_STREAM_HEARTBEAT', 15.0)
+
+
+def stream_retry():
+    """
+        return the seconds the browser waits before reconnecting (or polling, under WSGI)
+    """
+    return getattr(settings, 'PRICE_STREAM_RETRY', 5.0)
+
+
+def price_delta(ticker, old_price, new_price):
+    """
+        return the JSON form of a price change
+    """
+    return {'ticker': ticker, 'price': str(new_price), 'change': str(new_price - old_price)}
+
+
+class Subscription:
+    """
+        the stocks one client listens to and the changes waiting to be pushed to it
+    """
+
+    def __init__(self, hub, stock_ids):
+        self.hub = hub
+        self.stock_ids = frozenset(stock_ids)
+        self.loop = asyncio.get_running_loop()
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.last_push = 0.0
+
+
+    def push(self, deltas):
+        """
+            merge new deltas into the pending ones, runs on the subscriber's event loop
+        """
+        for stock_id, (ticker, old_price, new_price) in deltas.items():
+            if stock_id in self.pending:
+                # keep the price the client last saw as the base of the change
+                old_price = self.pending[stock_id][1]
+            self.pending[stock_id] = (ticker, old_price, new_price)
+        self.ready.set()
+
+
+    async def next_batch(self, timeout):
+        """
+            wait for changes and return them coalesced, or {} after `timeout` seconds without any
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+
+        # let changes arriving within the interval join this push
+        wait = self.last_push + stream_interval() - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        batch, self.pending = self.pending, {}
+        self.ready.clear()
+        self.last_push = time.monotonic()
+        return batch
+
+
+    def close(self):
+        """
+            stop receiving changes
+        """
+        self.hub.unsubscribe(self)
+
+
+class PriceHub:
+    """
+        fans price changes out to the subscriptions of this process, indexed by stock
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_stock = {}
+
+
+    def subscribe(self, stock_ids):
+        """
+            return a new subscription to the given stocks, call from the event loop
+        """
+        subscription = Subscription(self, stock_ids)
+        with self.lock:
+            for stock_id in subscription.stock_ids:
+                self.by_stock.setdefault(stock_id, set()).add(subscription)
+        get_broker().start()
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        """
+            drop a subscription from the index
+        """
+        with self.lock:
+            for stock_id in subscription.stock_ids:
+                subscribers = self.by_stock.get(stock_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.by_stock[stock_id]
+
+
+    def subscriber_count(self):
+        """
+            return the number of open subscriptions
+        """
+        with self.lock:
+            return len(set().union(*self.by_stock.values())) if self.by_stock else 0
+
+
+    def deliver(self, changes):
+        """
+            hand each subscription the changes of its stocks, safe to call from any thread
+
+            `changes` maps stock ids to (ticker, old price, new price)
+        """
+        targets = {}
+        with self.lock:
+            for stock_id, change in changes.items():
+                for subscription in self.by_stock.get(stock_id, ()):
+                    targets.setdefault(subscription, {})[stock_id] = change
+
+        for subscription, deltas in targets.items():
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, deltas)
+            except RuntimeError:
+                # the subscriber's loop is closed, it is going away
+                self.unsubscribe(subscription)
+
+
+hub = PriceHub()
+
+
+class LocalBroker:
+    """
+        delivers published changes straight to this process's hub
+    """
+
+    def publish(self, changes):
+        """
+            deliver the changes now
+        """
+        hub.deliver(changes)
+
+
+    def start(self):
+        """
+            nothing to poll
+        """
+
+
+class CacheBroker:
+    """
+        passes changes between processes through a sequence of cache entries
+
+        stands in for a real message broker: publishers append an entry under an
+        increasing sequence number, every process polls for the entries it hasn't seen
+    """
+    sequence_key = "wt_scrooge_capital:price-stream:sequence"
+    entry_timeout = 60
+
+
+    def __init__(self):
+        self.poller = None
+        self.seen = None
+
+
+    def entry_key(self, sequence):
+        """
+            return the cache key of a published entry
+        """
+        return f"wt_scrooge_capital:price-stream:{sequence}"
+
+
+    def publish(self, changes):
+        """
+            append the changes as the next entry
+        """
+        cache.add(self.sequence_key, 0, timeout=None)
+        sequence = cache.incr(self.sequence_key)
+        payload = {stock_id: (ticker, str(old), str(new)) for stock_id, (ticker, old, new) in changes.items()}
+        cache.set(self.entry_key(sequence), json.dumps(payload), timeout=self.entry_timeout)
+
+
+    def start(self):
+        """
+            start polling on the running event loop, once per loop
+        """
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.get_running_loop().create_task(self.poll())
+
+
+    def read(self):
+        """
+            return the changes published since the last read, merged, as {stock id: (ticker, old, new)}
+        """
+        latest = cache.get(self.sequence_key, 0)
+        if self.seen is None or latest < self.seen:
+            # first read or the counter was reset, start from now
+            self.seen = latest
+            return {}
+        keys = [self.entry_key(sequence) for sequence in range(self.seen + 1, latest + 1)]
+        self.seen = latest
+
+        changes = {}
+        entries = cache.get_many(keys)
+        for key in keys:
+            if key not in entries:
+                continue
+            for stock_id, (ticker, old, new) in json.loads(entries[key]).items():
+                stock_id = int(stock_id)
+                old = changes[stock_id][1] if stock_id in changes else Decimal(old)
+                changes[stock_id] = (ticker, old, Decimal(new))
+        return changes
+
+
+    async def poll(self):
+        """
+            deliver new entries to the hub until nobody is subscribed
+        """
+        interval = getattr(settings, 'PRICE_STREAM_POLL_INTERVAL', 0.5)
+        while hub.subscriber_count():
+            changes = await sync_to_async(self.read, thread_sensitive=False)()
+            if changes:
+                hub.deliver(changes)
+            await asyncio.sleep(interval)
+        self.seen = None
+
+
+BROKERS = {
+    'local': LocalBroker,
+    'cache': CacheBroker,
+}
+_broker = None
+
+
+def get_broker():
+    """
+        return the broker picked by PRICE_STREAM_BROKER
+    """
+    global _broker
+    name = getattr(settings, 'PRICE_STREAM_BROKER', 'local')
+    if _broker is None or not isinstance(_broker, BROKERS[name]):
+        _broker = BROKERS[name]()
+    return _broker
+
+
+def publish_price_changes(changes):
+    """
+        send committed price changes to every subscribed client
+
+        `changes` maps stock ids to (ticker, old price, new price)
+    """
+    if changes:
+        get_broker().publish(changes)
+
+
+def sse_event(event, data):
+    """
+        return one Server-Sent Events message
+    """
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+async def price_events(subscription, snapshot):
+    """
+        yield the current prices, then the coalesced changes as they happen, until the client leaves
+    """
+    try:
+        yield f"retry: {int(stream_retry() * 1000)}\n\n"
+        yield sse_event('prices', snapshot)
+        while True:
+            batch = await subscription.next_batch(stream_heartbeat())
+            if batch:
+                yield sse_event('prices', [price_delta(*change) for change in batch.values()])
+            else:
+                yield ": keep-alive\n\n"
+    finally:
+        subscription.close()
@@ -1,3 +1,1444 @@
-from django.test import TestCase
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/tests.py
 
-# Create your tests here.
+# Tests for the wt_scrooge_capital app
+
+
+import base64
+from contextlib import contextmanager
+import datetime
+from decimal import Decimal
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .backtest import load_closes, param_grid, run_backtest, simulate, sweep
+from .charts import get_price_chart, lttb_indices, window_bars
+from .fields import decode_prices, encode_prices, prices_as_numpy
+from .forms import BuySellForm
+from .indicators import bollinger_bands, max_drawdown, rsi, sma
+from .middleware import get_user_profile
+from .lots import position_pnl
+from .orderbook import OrderBook, books, cancel_order, place_order
+from .orders import OrderError, execute_order, execute_orders
+from .prices import prices_updated, update_prices
+from .profiling import _profiler_lock as profiling_lock, stats as profiling_stats
+from .rebalance import mean_variance_weights, solve
+from .risk import covariance
+from .screener import ScreenError, screener
+from .search import stock_search
+from .streams import PriceHub
+from .valuations import get_valuation, rebuild_valuation
+from .versions import get_price_version, get_search_version
+from .models import Order, Portfolio, PriceBar, RealizedPnL, Stock, StockIndicators, StockPriceHistory, TaxLot, Transaction, UserProfile, WatchList
+
+
+class QueryBudgetMixin:
+    """
+        Adds assertMaxQueries, which fails when the block runs more queries than its budget
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, budget, using=DEFAULT_DB_ALIAS):
+        """
+            fail if the block executes more than `budget` queries, listing the queries that ran
+        """
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = "\n".join(
+                f"{number}. {query['sql']}" for number, query in enumerate(context.captured_queries, start=1)
+            )
+            self.fail(f"{executed} queries executed, budget is {budget}\n{queries}")
+
+
+class ListViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+        The list pages have to run a fixed number of queries however many rows the user has
+    """
+    rows = 25
+
+    # query budgets per page, including the session and auth user lookups
+    budgets = {
+        'portfolio': 8,  # the first view also looks up the stocks the cached fragments are keyed by and the open orders
+        'watchlist': 4,
+        'transactions': 4,
+        'profile': 5,
+        'stock_list': 3,
+    }
+
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user holding, watching and trading every stock
+        """
+        cls.user = User.objects.create_user(username='trader', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=cls.user, first_name='Test', last_name='Trader', email='trader@example.com'
+        )
+        stocks = Stock.objects.bulk_create(
+            Stock(ticker=f"T{i}", company_name=f"Company {i}", current_price=10 + i) for i in range(cls.rows)
+        )
+        today = datetime.date.today()
+        Portfolio.objects.bulk_create(
+            Portfolio(user=cls.profile, stock=stock, shares=5, purchase_price=stock.current_price, purchase_date=today)
+            for stock in stocks
+        )
+        WatchList.objects.bulk_create(
+            WatchList(user=cls.profile, stock=stock, added_price=stock.current_price, current_price=stock.current_price)
+            for stock in stocks
+        )
+        Transaction.objects.bulk_create(
+            Transaction(
+                user=cls.profile,
+                stock=stock,
+                shares=5,
+                purchase_price=stock.current_price,
+                purchase_date=today,
+                transaction_type='buy',
+            )
+            for stock in stocks
+        )
+        rebuild_valuation(cls.profile)
+
+
+    def setUp(self):
+        """
+            log the user in, with nothing cached yet
+        """
+        cache.clear()
+        self.client.force_login(self.user)
+
+
+    def test_list_views_stay_within_query_budget(self):
+        """
+            each list page stays within its budget with many rows
+        """
+        for url_name, budget in self.budgets.items():
+            with self.subTest(url_name=url_name):
+                with self.assertMaxQueries(budget):
+                    response = self.client.get(reverse(url_name))
+                self.assertEqual(response.status_code, 200)
+
+
+    def test_keyset_pages_cover_history_once(self):
+        """
+            following the cursors visits every transaction once, newest first, ties broken by id
+        """
+        ids = []
+        cursor = ''
+        while True:
+            with self.assertMaxQueries(4):
+                response = self.client.get(reverse('transactions'), {'format': 'json', 'size': 7, 'cursor': cursor})
+            page = response.json()
+            ids.extend(row['id'] for row in page['results'])
+            if not page['next']:
+                break
+            cursor = page['next']
+
+        expected = list(Transaction.objects.filter(user=self.profile).order_by('-purchase_date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(self.client.get(reverse('stock_list'), {'cursor': 'not-a-cursor'}).status_code, 404)
+        # cursors that decode but hold values of the wrong type for the ordering fields
+        for url_name, values in (
+            ('transactions', ['notadate', 1]),
+            ('transactions', [{'a': 1}, 1]),
+            ('transactions', [[1], [2]]),
+            ('transactions', ['2024-01-01', True]),
+            ('stock_list', [{'a': 1}]),
+        ):
+            with self.subTest(url_name=url_name, values=values):
+                cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+                response = self.client.get(reverse(url_name), {'format': 'json', 'cursor': cursor})
+                self.assertEqual(response.status_code, 404)
+
+        page = self.client.get(reverse('stock_list'), {'format': 'json', 'size': 2}).json()
+        self.assertEqual(set(page['results'][0]), {'id', 'ticker', 'company_name', 'current_price'})
+        self.assertEqual(self.client.get(reverse('stock_list'), {'format': 'json', 'cursor': page['next']}).status_code, 200)
+
+
+    def test_adding_a_watched_stock_keeps_one_row(self):
+        """
+            a stock already on the watchlist isn't added twice
+        """
+        stock = Stock.objects.get(ticker='T0')
+        self.client.post(reverse('add_to_watchlist', args=[stock.pk]))
+        self.assertEqual(WatchList.objects.filter(user=self.profile, stock=stock).count(), 1)
+
+
+    def test_portfolio_totals(self):
+        """
+            the single-pass totals match the rows
+        """
+        response = self.client.get(reverse('portfolio'))
+        self.assertEqual(response.context['portfolio_total_shares'], 5 * self.rows)
+        self.assertEqual(
+            response.context['portfolio_total_value'],
+            sum(5 * (10 + i) for i in range(self.rows)),
+        )
+
+
+@override_settings(USER_PROFILE_CACHE_TIMEOUT=60)
+class UserProfileCacheTests(TestCase):
+    """
+        The profile is loaded once per request and, when enabled, cached across requests
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user with a profile
+        """
+        cls.user = User.objects.create_user(username='cached', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=cls.user, first_name='Cached', last_name='User', email='cached@example.com'
+        )
+
+
+    def setUp(self):
+        """
+            start every test with an empty cache
+        """
+        cache.clear()
+
+
+    def make_request(self):
+        """
+            return a request made by the test user
+        """
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return request
+
+
+    def test_profile_resolved_once_per_request_and_cached(self):
+        """
+            repeated lookups reuse the request's profile, the next request reads the cache
+        """
+        request = self.make_request()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_profile(request), self.profile)
+            self.assertIs(get_user_profile(request), get_user_profile(request))
+        with self.assertNumQueries(0):
+            get_user_profile(self.make_request())
+
+
+    def test_saving_profile_invalidates_cache(self):
+        """
+            an updated profile is not served stale
+        """
+        get_user_profile(self.make_request())
+        self.profile.first_name = 'Renamed'
+        self.profile.save()
+        self.assertEqual(get_user_profile(self.make_request()).first_name, 'Renamed')
+
+
+class PriceSeriesFieldTests(TestCase):
+    """
+        The packed price series round-trips through the codec, the field and the database
+    """
+
+    def test_codec_round_trip(self):
+        """
+            float64 and int-cents series decode to the prices they were packed from
+        """
+        prices = [10.5, 11.25, 9.0]
+        self.assertEqual(list(decode_prices(encode_prices(prices))), prices)
+        self.assertEqual(list(decode_prices(encode_prices(prices, 'q'))), prices)
+        np.testing.assert_array_equal(prices_as_numpy(encode_prices(prices)), prices)
+        with self.assertRaises(ValueError):
+            decode_prices(encode_prices(prices)[:-1])
+
+
+    def test_price_array_saved_and_unsaved(self):
+        """
+            get_price_array works on a fresh instance holding a list and on a row read back
+        """
+        stock = Stock.objects.create(ticker='PACK', company_name='Pack', current_price=10)
+        record = StockPriceHistory(
+            stock=stock, date=datetime.date(2024, 1, 2), open_price=10, close_price=11,
+            region="United States", type="Equity", price_history=[10, 10.5, 11],
+        )
+        np.testing.assert_array_equal(record.get_price_array(), [10, 10.5, 11])
+        record.save()
+        np.testing.assert_array_equal(StockPriceHistory.objects.get(pk=record.pk).get_price_array(), [10, 10.5, 11])
+
+
+class PriceSeriesMigrationTests(TransactionTestCase):
+    """
+        Migration 0007 packs the legacy text column and unpacks it again on the way back
+    """
+    app = 'wt_scrooge_capital'
+
+
+    def migrate(self, target):
+        """
+            migrate the app to a migration and return the historical apps at that point
+        """
+        executor = MigrationExecutor(connection)
+        executor.migrate([(self.app, target)])
+        executor.loader.build_graph()
+        return executor.loader.project_state([(self.app, target)]).apps
+
+
+    def tearDown(self):
+        """
+            put the schema back at the latest migration for the other tests
+        """
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+
+    def test_pack_and_unpack(self):
+        """
+            "[1.5, 2.25]" text becomes a packed series and comes back as text
+        """
+        apps = self.migrate('0006_stockpricehistory_price_history')
+        stock = apps.get_model(self.app, 'Stock').objects.create(ticker='OLD', company_name='Old', current_price=2)
+        apps.get_model(self.app, 'StockPriceHistory').objects.create(
+            stock=stock, date=datetime.date(2024, 1, 2), open_price=1, close_price=2,
+            region="United States", type="Equity", price_history="[1.5, 2.25]",
+        )
+
+        apps = self.migrate('0007_pack_stockpricehistory_price_history')
+        record = apps.get_model(self.app, 'StockPriceHistory').objects.get()
+        self.assertEqual(list(record.price_history), [1.5, 2.25])
+
+        apps = self.migrate('0006_stockpricehistory_price_history')
+        self.assertEqual(apps.get_model(self.app, 'StockPriceHistory').objects.get().price_history, "1.5,2.25")
+
+
+class PriceBarTests(TestCase):
+    """
+        The bar queryset answers range, last-N and downsampled reads, and ingests idempotently
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            a day of hourly bars for one stock
+        """
+        cls.stock = Stock.objects.create(ticker='BARS', company_name='Bars', current_price=10)
+        cls.midnight = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+        PriceBar.objects.ingest([
+            PriceBar(
+                stock=cls.stock, timestamp=cls.midnight + datetime.timedelta(hours=hour),
+                open_price=10 + hour, high_price=11 + hour, low_price=9 + hour, close_price=10 + hour, volume=100,
+            )
+            for hour in range(24)
+        ])
+
+
+    def test_range_and_last_n(self):
+        """
+            between is half-open, last_n returns the latest bars oldest first
+        """
+        bars = PriceBar.objects.for_stock(self.stock)
+        window = bars.between(self.midnight + datetime.timedelta(hours=10), self.midnight + datetime.timedelta(hours=14))
+        self.assertEqual([bar.timestamp.hour for bar in window], [10, 11, 12, 13])
+        self.assertEqual([bar.timestamp.hour for bar in bars.last_n(3)], [21, 22, 23])
+        self.assertEqual(len(window_bars(self.stock)), 12)  # (11:00, 23:00], not 13 bars
+
+
+    def test_downsample_and_reingest(self):
+        """
+            6-hour buckets aggregate OHLCV, ingesting a bar again overwrites it
+        """
+        buckets = PriceBar.objects.for_stock(self.stock).downsample(datetime.timedelta(hours=6))
+        self.assertEqual(len(buckets), 4)
+        self.assertEqual(
+            (buckets[1]['open_price'], buckets[1]['high_price'], buckets[1]['low_price'], buckets[1]['close_price'], buckets[1]['volume']),
+            (16, 22, 15, 21, 600),
+        )
+        with self.assertRaises(ValueError):
+            PriceBar.objects.downsample(datetime.timedelta(0))
+
+        PriceBar.objects.ingest([PriceBar(
+            stock=self.stock, timestamp=self.midnight, open_price=1, high_price=1, low_price=1, close_price=1, volume=5,
+        )])
+        self.assertEqual(PriceBar.objects.filter(stock=self.stock).count(), 24)
+        self.assertEqual(PriceBar.objects.get(stock=self.stock, timestamp=self.midnight).close_price, 1)
+
+
+    def test_daily_history_is_read_only_in_the_admin(self):
+        """
+            the daily records can be browsed but not added or edited, the charts would never see them
+        """
+        self.client.force_login(User.objects.create_superuser(username='admin', password='pw'))
+        self.assertEqual(self.client.get(reverse('admin:wt_scrooge_capital_stockpricehistory_changelist')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('admin:wt_scrooge_capital_stockpricehistory_add')).status_code, 403)
+
+
+    def test_price_version_moves_on_commit(self):
+        """
+            ingested, saved and deleted bars bump the price version only once they are committed
+        """
+        bar = PriceBar(stock=self.stock, timestamp=self.midnight, open_price=2, high_price=2, low_price=2, close_price=2)
+        writes = [
+            lambda: PriceBar.objects.ingest([bar]),
+            lambda: PriceBar.objects.filter(stock=self.stock, timestamp=self.midnight).get().save(),
+            lambda: PriceBar.objects.filter(stock=self.stock, timestamp=self.midnight).get().delete(),
+        ]
+        for write in writes:
+            version = get_price_version(self.stock.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+                self.assertEqual(get_price_version(self.stock.pk), version)
+            self.assertNotEqual(get_price_version(self.stock.pk), version)
+
+
+class PriceChartTests(TestCase):
+    """
+        Charts are downsampled with LTTB and cached until the prices or the names change
+    """
+
+    def test_lttb_keeps_endpoints_and_point_count(self):
+        """
+            the first and last points survive and exactly `threshold` points are kept
+        """
+        x = list(range(1000))
+        y = [(i * 37) % 101 for i in x]
+        indices = lttb_indices(x, y, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertEqual(indices, sorted(set(indices)))
+        self.assertEqual(lttb_indices(x[:10], y[:10], 50), list(range(10)))
+
+
+    def test_chart_cache_follows_prices_and_names(self):
+        """
+            a hit runs no query, a new bar and a rename both build the chart again
+        """
+        cache.clear()
+        stock = Stock.objects.create(ticker='CHRT', company_name='Chart Co', current_price=10)
+        start = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+
+        def add_bar(hour, price):
+            with self.captureOnCommitCallbacks(execute=True):
+                PriceBar.objects.create(
+                    stock=stock, timestamp=start + datetime.timedelta(hours=hour),
+                    open_price=price, high_price=price, low_price=price, close_price=price,
+                )
+
+        for hour in range(5):
+            add_bar(hour, 10 + hour)
+        self.assertEqual(get_price_chart(stock)['max_price'], 14)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_price_chart(stock)['max_price'], 14)
+
+        add_bar(5, 30)
+        self.assertEqual(get_price_chart(stock)['max_price'], 30)
+
+        stock.company_name = 'Renamed Co'
+        self.assertIn('Renamed Co', get_price_chart(stock)['html'])
+
+
+    def test_series_conditional_get(self):
+        """
+            a repeat with the ETag gets a 304, a new bar gives a 200 with a new ETag
+        """
+        cache.clear()
+        stock = Stock.objects.create(ticker='SERS', company_name='Series Co', current_price=10)
+        start = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+
+        def ingest(hour):
+            with self.captureOnCommitCallbacks(execute=True):
+                PriceBar.objects.ingest([PriceBar(
+                    stock=stock, timestamp=start + datetime.timedelta(hours=hour),
+                    open_price=10, high_price=10, low_price=10, close_price=10,
+                )])
+
+        ingest(0)
+        url = reverse('stock_series', args=[stock.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        ingest(1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()['t']), 2)
+
+
+class OrderExecutionTests(TestCase):
+    """
+        Buy and sell orders keep positions and the transaction history consistent
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user and a stock
+        """
+        user = User.objects.create_user(username='investor', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=user, first_name='Test', last_name='Investor', email='investor@example.com'
+        )
+        cls.stock = Stock.objects.create(ticker='ACME', company_name='Acme', current_price=10)
+
+
+    def shares_owned(self):
+        """
+            return the shares of the stock the user holds
+        """
+        item = Portfolio.objects.filter(user=self.profile, stock=self.stock).first()
+        return item.shares if item else 0
+
+
+    def test_buy_then_sell_everything(self):
+        """
+            selling the whole position removes it and still records the sell
+        """
+        execute_order(self.profile, self.stock, 'buy', 5)
+        execute_order(self.profile, self.stock, 'buy', 3)
+        self.assertEqual(self.shares_owned(), 8)
+
+        execute_order(self.profile, self.stock, 'sell', 8)
+        self.assertFalse(Portfolio.objects.filter(user=self.profile, stock=self.stock).exists())
+        self.assertEqual(
+            list(Transaction.objects.filter(user=self.profile).order_by('pk').values_list('transaction_type', 'shares')),
+            [('buy', 5), ('buy', 3), ('sell', 8)],
+        )
+
+
+    def test_oversell_is_rejected(self):
+        """
+            selling more than is owned changes nothing
+        """
+        execute_order(self.profile, self.stock, 'buy', 2)
+        with self.assertRaises(OrderError):
+            execute_order(self.profile, self.stock, 'sell', 3)
+        self.assertEqual(self.shares_owned(), 2)
+        self.assertEqual(Transaction.objects.filter(user=self.profile).count(), 1)
+
+
+    def test_valuation_follows_trades_and_prices(self):
+        """
+            the incremental valuation matches a full recomputation
+        """
+        execute_order(self.profile, self.stock, 'buy', 10)
+        self.stock.current_price = 12
+        self.stock.save()
+        execute_order(self.profile, self.stock, 'sell', 4)
+
+        valuation = get_valuation(self.profile)
+        self.assertEqual(valuation.total_shares, 6)
+        self.assertEqual(valuation.market_value, 72)
+        self.assertEqual(valuation.cost_basis, 60)
+        self.assertEqual(valuation.unrealized_pnl, 12)
+
+        rebuilt = rebuild_valuation(self.profile)
+        self.assertEqual(
+            (rebuilt.total_shares, rebuilt.market_value, rebuilt.cost_basis),
+            (valuation.total_shares, valuation.market_value, valuation.cost_basis),
+        )
+
+
+    def test_stale_stock_fills_at_the_current_price(self):
+        """
+            an order placed with an outdated Stock instance trades at the price in the database
+        """
+        stale = Stock.objects.get(pk=self.stock.pk)
+        update_prices([('ACME', 15)])
+        self.assertEqual(execute_order(self.profile, stale, 'buy', 2).purchase_price, 15)
+        execute_orders(self.profile, [{'ticker': 'ACME', 'action': 'buy', 'shares': 2}])
+
+        valuation = get_valuation(self.profile)
+        self.assertEqual((valuation.total_shares, valuation.market_value, valuation.cost_basis), (4, 60, 60))
+        self.assertEqual(Portfolio.objects.get(user=self.profile, stock=self.stock).purchase_price, 15)
+
+
+    def test_idempotency_key_trades_once(self):
+        """
+            resubmitting an order with the same key returns the first transaction
+        """
+        first = execute_order(self.profile, self.stock, 'buy', 4, idempotency_key='abc')
+        second = execute_order(self.profile, self.stock, 'buy', 4, idempotency_key='abc')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(self.shares_owned(), 4)
+
+
+class TaxLotTests(TestCase):
+    """
+        Sells close lots by the user's lot method and keep the realized P&L
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user and a stock
+        """
+        user = User.objects.create_user(username='taxpayer', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=user, first_name='Test', last_name='Taxpayer', email='taxpayer@example.com'
+        )
+        cls.stock = Stock.objects.create(ticker='LOTS', company_name='Lots', current_price=10)
+
+
+    def trade(self, action, shares, price):
+        """
+            trade at the given price
+        """
+        self.stock.current_price = price
+        self.stock.save()
+        return execute_order(self.profile, self.stock, action, shares)
+
+
+    def test_lot_methods(self):
+        """
+            buy 10 at $10 and 10 at $20, then sell 15 at $30 with each method
+        """
+        expected = {'fifo': (250, 100), 'lifo': (200, 50), 'average': (225, 75)}
+        for method, (realized, remaining_cost) in expected.items():
+            with self.subTest(method=method):
+                Portfolio.objects.filter(user=self.profile).delete()
+                TaxLot.objects.filter(user=self.profile).delete()
+                RealizedPnL.objects.filter(user=self.profile).delete()
+                self.profile.lot_method = method
+                self.profile.save()
+
+                self.trade('buy', 10, 10)
+                self.trade('buy', 10, 20)
+                sell = self.trade('sell', 15, 30)
+
+                self.assertEqual(sell.realized_pnl, realized)
+                self.assertEqual(Portfolio.objects.get(user=self.profile).cost_basis, remaining_cost)
+                self.assertEqual(RealizedPnL.objects.get(user=self.profile).realized_pnl, realized)
+                self.assertEqual(
+                    sum(TaxLot.objects.filter(user=self.profile).values_list('remaining_shares', flat=True)), 5
+                )
+
+
+    def test_batch_matches_single_orders_and_report(self):
+        """
+            a batch realizes the same P&L as the orders one by one, and the report reads it back
+        """
+        self.profile.lot_method = 'fifo'
+        self.profile.save()
+        self.trade('buy', 10, 10)
+        results = execute_orders(self.profile, [
+            {'ticker': 'LOTS', 'action': 'buy', 'shares': 10},
+            {'ticker': 'LOTS', 'action': 'sell', 'shares': 12},
+        ])
+        self.assertEqual([result['status'] for result in results], ['filled', 'filled'])
+        # 10 shares at $10 and 2 at $10 again, all sold at $10
+        self.assertEqual(Transaction.objects.get(pk=results[1]['transaction_id']).realized_pnl, 0)
+
+        self.trade('sell', 8, 15)
+        self.trade('buy', 1, 15)
+        valuation = get_valuation(self.profile)
+        self.assertEqual(valuation.realized_pnl, 40)
+        self.assertEqual(rebuild_valuation(self.profile).realized_pnl, 40)
+        self.assertEqual(TaxLot.objects.filter(user=self.profile, remaining_shares__gt=0).count(), 1)
+
+        [position] = position_pnl(self.profile)
+        self.assertEqual(
+            (position['shares'], position['cost_basis'], position['realized_pnl'], position['unrealized_pnl']),
+            (1, 15, 40, 0),
+        )
+
+
+class OrderBookTests(TestCase):
+    """
+        Resting limit and stop orders fill when a price update reaches them
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user holding some shares of a stock
+        """
+        user = User.objects.create_user(username='patient', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=user, first_name='Test', last_name='Patient', email='patient@example.com'
+        )
+        cls.stock = Stock.objects.create(ticker='BOOK', company_name='Book', current_price=10)
+        execute_order(cls.profile, cls.stock, 'buy', 10)
+
+
+    def setUp(self):
+        """
+            start from empty books, they live as long as the process
+        """
+        books.clear()
+
+
+    def test_book_priority(self):
+        """
+            the best priced orders come first, then the oldest, cancelled ones never come up
+        """
+        book = OrderBook()
+        for order_id, price in enumerate([9, 10, 8, 10, 7], start=1):
+            book.add(order_id, 'buy', 'limit', Decimal(price))
+        book.add(6, 'sell', 'stop', Decimal('9.50'))
+        book.add(7, 'sell', 'limit', Decimal(12))
+        book.discard(4)
+
+        self.assertEqual(book.match(Decimal(11)), [])
+        self.assertEqual(book.match(Decimal('9.50')), [2, 6])
+        self.assertEqual(book.match(Decimal(13)), [7])
+        self.assertEqual(book.match(Decimal(1)), [1, 3, 5])
+        self.assertEqual(len(book), 0)
+
+
+    def test_price_updates_fill_resting_orders(self):
+        """
+            each tick fills the orders it triggers and leaves the rest open
+        """
+        limit_buy = place_order(self.profile, self.stock, 'buy', 'limit', Decimal(9), 5)
+        stop_sell = place_order(self.profile, self.stock, 'sell', 'stop', Decimal(8), 10)
+        cancelled = place_order(self.profile, self.stock, 'buy', 'limit', Decimal(9), 1)
+        self.assertEqual(cancel_order(self.profile, cancelled.pk).status, 'cancelled')
+        with self.assertRaises(OrderError):
+            place_order(self.profile, self.stock, 'buy', 'limit', None, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            update_prices([('BOOK', '8.50')])
+        limit_buy.refresh_from_db()
+        stop_sell.refresh_from_db()
+        self.assertEqual((limit_buy.status, stop_sell.status), ('filled', 'open'))
+        self.assertEqual(limit_buy.transaction.purchase_price, Decimal('8.50'))
+        self.assertEqual(Portfolio.objects.get(user=self.profile).shares, 15)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            update_prices([('BOOK', '7.50')])
+        stop_sell.refresh_from_db()
+        self.assertEqual(stop_sell.status, 'filled')
+        self.assertEqual(Portfolio.objects.get(user=self.profile).shares, 5)
+        self.assertEqual(Order.objects.get(pk=cancelled.pk).status, 'cancelled')
+
+
+    def test_late_commit_of_an_older_order(self):
+        """
+            a loaded book costs no query per tick, the catch-up finds an order committed after a newer one
+        """
+        fields = dict(user=self.profile, stock=self.stock, side='sell', order_type='limit', price=12, shares=1)
+        older = Order.objects.create(**fields, status='cancelled')
+        newer = Order.objects.create(**fields)
+        self.assertEqual(books.match({self.stock.pk: Decimal(11)}), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(books.match({self.stock.pk: Decimal(11)}), [])
+
+        Order.objects.filter(pk=older.pk).update(status='open')  # as if its transaction committed just now
+        with self.settings(ORDER_BOOK_SYNC_INTERVAL=0), self.assertNumQueries(1):
+            self.assertEqual(books.match({self.stock.pk: Decimal(12)}), [older.pk, newer.pk])
+
+
+class BatchOrderTests(QueryBudgetMixin, TestCase):
+    """
+        The batch endpoint applies many orders with a fixed number of queries
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create a user and some stocks
+        """
+        cls.user = User.objects.create_user(username='rebalancer', password='password')
+        cls.profile = UserProfile.objects.create(
+            user=cls.user, first_name='Test', last_name='Rebalancer', email='rebalancer@example.com'
+        )
+        Stock.objects.bulk_create(
+            Stock(ticker=f"B{i}", company_name=f"Company {i}", current_price=10) for i in range(20)
+        )
+
+
+    def post_orders(self, orders):
+        """
+            post a batch of orders as JSON
+        """
+        return self.client.post(reverse('batch_orders'), data=json.dumps(orders), content_type='application/json')
+
+
+    def test_batch_results(self):
+        """
+            every order gets its own result and only accepted orders trade
+        """
+        self.client.force_login(self.user)
+        orders = [{'ticker': f"B{i}", 'action': 'buy', 'shares': 10} for i in range(20)]
+        orders += [
+            {'ticker': 'B0', 'action': 'sell', 'shares': 10},
+            {'ticker': 'B1', 'action': 'sell', 'shares': 11},
+            {'ticker': 'NOPE', 'action': 'buy', 'shares': 1},
+            {'ticker': 'B2', 'action': 'buy', 'shares': 1, 'idempotency_key': 'k'},
+            {'ticker': 'B2', 'action': 'buy', 'shares': 1, 'idempotency_key': 'k'},
+        ]
+        # the tax lots and the realized P&L add a read and a bulk write each, whatever the size of the batch
+        with self.assertMaxQueries(24):
+            response = self.post_orders(orders)
+
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['filled'] * 21 + ['rejected', 'rejected', 'filled', 'duplicate'])
+        self.assertFalse(Portfolio.objects.filter(user=self.profile, stock__ticker='B0').exists())
+        self.assertEqual(Portfolio.objects.get(user=self.profile, stock__ticker='B2').shares, 11)
+        self.assertEqual(Transaction.objects.filter(user=self.profile).count(), 22)
+
+
+    def test_rejects_non_list_body(self):
+        """
+            the body has to be a JSON list
+        """
+        self.client.force_login(self.user)
+        self.assertEqual(self.post_orders({'ticker': 'B0'}).status_code, 400)
+
+
+class PriceUpdateTests(QueryBudgetMixin, TestCase):
+    """
+        A batch of prices refreshes the stocks, watchlists and valuations with set-based statements
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create users watching and holding the same stocks
+        """
+        cls.stocks = Stock.objects.bulk_create(
+            Stock(ticker=f"P{i}", company_name=f"Company {i}", current_price=10) for i in range(10)
+        )
+        today = datetime.date.today()
+        cls.profiles = []
+        for i in range(10):
+            user = User.objects.create_user(username=f"watcher{i}")
+            profile = UserProfile.objects.create(
+                user=user, first_name='Test', last_name=f"Watcher {i}", email=f"watcher{i}@example.com"
+            )
+            WatchList.objects.bulk_create(
+                WatchList(user=profile, stock=stock, added_price=10, current_price=10) for stock in cls.stocks
+            )
+            Portfolio.objects.bulk_create(
+                Portfolio(user=profile, stock=stock, shares=1, purchase_price=10, purchase_date=today, cost_basis=10)
+                for stock in cls.stocks
+            )
+            rebuild_valuation(profile)
+            cls.profiles.append(profile)
+
+
+    def test_update_prices_fans_out(self):
+        """
+            watchlists and valuations follow the new prices and the change feed is sent
+        """
+        received = []
+        def receiver(sender, changes, **kwargs):
+            received.append(changes)
+        prices_updated.connect(receiver)
+        self.addCleanup(prices_updated.disconnect, receiver)
+
+        updates = [(f"P{i}", 12) for i in range(5)] + [('P5', 10), ('UNKNOWN', 1)]
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertMaxQueries(12):
+                changes = update_prices(updates)
+
+        self.assertEqual(sorted(ticker for ticker, _, _ in changes.values()), [f"P{i}" for i in range(5)])
+        self.assertEqual(WatchList.objects.filter(current_price=12).count(), 5 * len(self.profiles))
+        self.assertEqual(get_valuation(self.profiles[0]).market_value, 110)
+        self.assertEqual(received, [changes])
+
+
+    def test_stale_stock_saves_apply_their_own_deltas(self):
+        """
+            two instances loaded at the same price both save, the valuation ends at the last price
+        """
+        first = Stock.objects.get(ticker='P0')
+        second = Stock.objects.get(ticker='P0')
+        first.current_price = 12
+        first.save()
+        second.current_price = 15
+        second.save()
+        self.assertEqual(get_valuation(self.profiles[0]).market_value, 105)  # 9 x 10 + 15
+
+
+class IndicatorTests(TestCase):
+    """
+        The vectorized indicators agree with the straightforward pandas versions
+    """
+
+    def test_rolling_indicators_match_pandas(self):
+        """
+            sma and bollinger bands match pandas' rolling windows, rsi stays within 0-100
+        """
+        close = 100 + np.cumsum(np.random.default_rng(0).normal(size=500))
+        rolling = pd.Series(close).rolling(20)
+
+        np.testing.assert_allclose(sma(close, 20), rolling.mean().to_numpy(), equal_nan=True)
+        _, upper, lower = bollinger_bands(close, 20)
+        np.testing.assert_allclose(upper, (rolling.mean() + 2 * rolling.std(ddof=0)).to_numpy(), equal_nan=True)
+        np.testing.assert_allclose(lower, (rolling.mean() - 2 * rolling.std(ddof=0)).to_numpy(), equal_nan=True)
+
+        values = rsi(close, 14)
+        self.assertTrue(np.isnan(values[:14]).all())
+        self.assertTrue(((values[14:] >= 0) & (values[14:] <= 100)).all())
+        self.assertAlmostEqual(max_drawdown([10, 12, 6, 11, 9]), 0.5)
+
+
+class BacktestTests(TestCase):
+    """
+        The backtest agrees with replaying the orders of every stock one at a time
+    """
+
+    def test_simulation_matches_order_by_order_replay(self):
+        """
+            whole shares paid from each stock's part of the cash, the leftover cash carried along
+        """
+        rng = np.random.default_rng(1)
+        close = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, size=(120, 4)), axis=0))
+        close[:30, 3] = np.nan  # listed later
+        positions = rng.random(close.shape) > 0.5
+
+        expected = np.zeros(len(close))
+        for column in range(close.shape[1]):
+            cash, shares = 250.0, 0
+            for day, price in enumerate(close[:, column]):
+                if not np.isnan(price):
+                    if shares and not positions[day, column]:
+                        cash, shares = cash + shares * price, 0
+                    elif not shares and positions[day, column]:
+                        shares = int(cash // price)
+                        cash -= shares * price
+                expected[day] += cash + (shares * price if shares else 0)
+        equity = simulate(close, positions, 1000.0)
+        np.testing.assert_allclose(equity, expected)
+        self.assertEqual(equity[0], 1000.0)
+
+
+    def test_backtest_sweep_and_endpoint(self):
+        """
+            a sweep ranks the valid parameter sets, the endpoint backtests the user's holdings
+        """
+        user = User.objects.create_user(username='quant', password='password')
+        profile = UserProfile.objects.create(user=user, first_name='Test', last_name='Quant', email='quant@example.com')
+        stock = Stock.objects.create(ticker='TRND', company_name='Trend', current_price=10)
+        Portfolio.objects.create(user=profile, stock=stock, shares=1, purchase_price=10, purchase_date=datetime.date.today())
+        start = datetime.date(2024, 1, 1)
+        StockPriceHistory.objects.bulk_create(
+            StockPriceHistory(
+                stock=stock, date=start + datetime.timedelta(days=day), open_price=10 + day, close_price=10 + day,
+                region="United States", type="Equity", price_history=[10 + day],
+            )
+            for day in range(60)
+        )
+
+        dates, stock_ids, close = load_closes()
+        self.assertEqual((len(dates), stock_ids), (60, [stock.pk]))
+        result = run_backtest(close, 'sma_crossover', {'fast': 3, 'slow': 10})
+        self.assertGreater(result['total_return'], 0)
+        self.assertEqual(result['max_drawdown'], 0)
+
+        results = sweep(close, 'sma_crossover', param_grid({'fast': [3, 5, 20], 'slow': [10, 20]}))
+        self.assertEqual(len(results), 4)  # fast must be below slow
+        self.assertEqual(results, sorted(results, key=lambda result: -result['sharpe']))
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('backtest'), {'strategy': 'momentum', 'lookback': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['equity']['values']), 60)
+        self.assertEqual(self.client.get(reverse('backtest'), {'strategy': 'nope'}).status_code, 400)
+        for bad in ({'start': 'notadate'}, {'end': '2024-02-30'}):
+            with self.subTest(bad=bad):
+                self.assertEqual(self.client.get(reverse('backtest'), {'tickers': 'TRND', **bad}).status_code, 400)
+        response = self.client.get(reverse('backtest'), {'tickers': 'TRND', 'strategy': 'momentum', 'lookback': 5, 'start': '2024-01-31'})
+        self.assertEqual(len(response.json()['equity']['values']), 30)
+        with self.settings(BACKTEST_MAX_TICKERS=2):
+            self.assertEqual(self.client.get(reverse('backtest'), {'tickers': 'A,B,C'}).status_code, 400)
+
+
+class RiskTests(TestCase):
+    """
+        The risk figures agree with NumPy and are cached until the holdings or the history change
+    """
+
+    def test_chunked_covariance_matches_numpy(self):
+        """
+            in float64 and within float32 precision
+        """
+        returns = np.random.default_rng(2).normal(0, 0.02, size=(300, 5))
+        np.testing.assert_allclose(covariance(returns, chunk_rows=64), np.cov(returns, rowvar=False))
+        np.testing.assert_allclose(
+            covariance(returns.astype(np.float32), chunk_rows=7), np.cov(returns, rowvar=False), rtol=1e-3, atol=1e-9,
+        )
+
+
+    def test_portfolio_risk_endpoint(self):
+        """
+            VaR and beta of two stocks (the closes are stored rounded), the second run is served from the cache
+        """
+        cache.clear()
+        user = User.objects.create_user(username='risky', password='password')
+        profile = UserProfile.objects.create(user=user, first_name='Test', last_name='Risky', email='risky@example.com')
+        rng = np.random.default_rng(3)
+        market = rng.normal(0, 0.01, size=80)
+        stocks = []
+        for ticker, beta in (('LOWB', 0.5), ('HIGB', 2.0)):
+            stock = Stock.objects.create(ticker=ticker, company_name=ticker, current_price=100)
+            closes = 100 * np.cumprod(1 + beta * market)
+            start = datetime.date.today() - datetime.timedelta(days=80)
+            StockPriceHistory.objects.bulk_create(
+                StockPriceHistory(
+                    stock=stock, date=start + datetime.timedelta(days=day), open_price=close, close_price=close,
+                    region="United States", type="Equity", price_history=[close],
+                )
+                for day, close in enumerate(closes)
+            )
+            Portfolio.objects.create(user=profile, stock=stock, shares=10, purchase_price=100, purchase_date=datetime.date.today())
+            stocks.append(stock)
+
+        self.client.force_login(user)
+        with self.settings(RISK_BENCHMARK='LOWB'):
+            report = self.client.get(reverse('portfolio_risk'), {'matrix': '1'}).json()
+            self.assertEqual(report['days'], 79)
+            self.assertAlmostEqual(report['positions'][1]['beta'], 4.0, places=2)  # 2.0 against a 0.5 benchmark
+            self.assertAlmostEqual(report['beta'], 2.5, places=2)
+            np.testing.assert_allclose(report['correlation'], [[1, 1], [1, 1]], atol=1e-3)
+
+            returns = np.diff(100 * np.cumprod(1 + np.outer(market, [0.5, 2.0]), axis=0), axis=0)
+            returns /= 100 * np.cumprod(1 + np.outer(market, [0.5, 2.0]), axis=0)[:-1]
+            portfolio = returns.mean(axis=1)
+            self.assertAlmostEqual(report['var']['historical'], -np.percentile(portfolio, 5) * 2000, places=1)
+            self.assertGreater(report['var']['parametric'], 0)
+
+            with self.assertNumQueries(4):  # session, user, profile and the positions, the matrices come from the cache
+                self.client.get(reverse('portfolio_risk'))
+        self.assertEqual(self.client.get(reverse('portfolio_risk'), {'confidence': 'x'}).status_code, 400)
+
+
+class RebalanceTests(TestCase):
+    """
+        The solver trades whole lots within the cash, batches accounts and executes the orders
+    """
+
+    def test_solver_respects_lots_cash_and_tolerance(self):
+        """
+            no overspending, no trades inside the band, full exits for a zero weight
+        """
+        shares = np.array([[10, 0, 7], [0, 0, 0]])
+        prices = np.array([10.0, 20.0, 5.0])
+        targets = np.array([[0.5, 0.5, 0.0], [0.5, 0.5, 0.0]])
+        buys, sells, left = solve(shares, prices, targets, cash=[35.0, 1000.0], lots=[1, 5, 1])
+        # 170 in all, 85 each: sell 1.5 -> 2 ALPH, BETA rounds to one lot of 5 costing 100 > 90 available, so none
+        np.testing.assert_array_equal(sells, [[2, 0, 7], [0, 0, 0]])
+        np.testing.assert_array_equal(buys, [[0, 0, 0], [50, 25, 0]])
+        np.testing.assert_allclose(left, [90.0, 0.0])
+        self.assertTrue((left >= 0).all())
+
+        buys, sells, _ = solve([[10, 10]], [10.0, 10.0], [[0.52, 0.48]], tolerance=0.05)
+        self.assertFalse(buys.any() or sells.any())
+
+
+    def test_mean_variance_weights(self):
+        """
+            the long-only optimum of two uncorrelated stocks, and no shorting of a dominated one
+        """
+        weights = mean_variance_weights(np.array([0.01, 0.01]), np.diag([0.0004, 0.0001]), 3.0)
+        np.testing.assert_allclose(weights, [0.2, 0.8], atol=1e-6)
+        weights = mean_variance_weights(np.array([0.02, -0.05]), np.diag([0.0001, 0.0001]), 3.0)
+        np.testing.assert_allclose(weights, [1.0, 0.0], atol=1e-6)
+
+
+    def test_batch_endpoint(self):
+        """
+            staff rebalance several accounts in one call, the orders are executed when asked
+        """
+        staff = User.objects.create_user(username='advisor', password='password', is_staff=True)
+        UserProfile.objects.create(user=staff, first_name='Test', last_name='Advisor', email='advisor@example.com')
+        alpha = Stock.objects.create(ticker='ALPH', company_name='Alpha', current_price=10)
+        Stock.objects.create(ticker='BETA', company_name='Beta', current_price=20)
+        profiles = []
+        for name in ('client1', 'client2'):
+            user = User.objects.create_user(username=name, password='password')
+            profile = UserProfile.objects.create(user=user, first_name='Test', last_name=name, email=f"{name}@example.com")
+            execute_order(profile, alpha, 'buy', 40)
+            profiles.append(profile)
+
+        self.client.force_login(staff)
+        body = {
+            'targets': {'alph': 0.5, 'BETA': 0.5},
+            'accounts': [{'username': 'client1'}, {'username': 'client2', 'cash': 400}],
+            'execute': True,
+        }
+        response = self.client.post(reverse('rebalance'), json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        first, second = response.json()['accounts']
+        self.assertEqual(first['orders'], [
+            {'ticker': 'ALPH', 'action': 'sell', 'shares': 20}, {'ticker': 'BETA', 'action': 'buy', 'shares': 10},
+        ])
+        self.assertEqual(second['orders'], [{'ticker': 'BETA', 'action': 'buy', 'shares': 20}])  # the cash pays for it
+        self.assertEqual(dict(Portfolio.objects.filter(user=profiles[0]).values_list('stock__ticker', 'shares')), {'ALPH': 20, 'BETA': 10})
+
+        # missing or empty targets would sell everything, they are refused before anything trades
+        for body in (
+            {'targets': {'ALPH': 0.7, 'BETA': 0.7}},
+            {'targets': {}, 'execute': True},
+            {'accounts': [{'username': 'client1'}], 'execute': True},
+            {'targets': {'ALPH': 1}, 'accounts': [{'username': 'client1', 'targets': {}}], 'execute': True},
+            {'targets': {'ALPH': 1}, 'cash': -100, 'execute': True},
+        ):
+            with self.subTest(body=body):
+                self.assertEqual(self.client.post(reverse('rebalance'), json.dumps(body), content_type='application/json').status_code, 400)
+        self.assertEqual(dict(Portfolio.objects.filter(user=profiles[0]).values_list('stock__ticker', 'shares')), {'ALPH': 20, 'BETA': 10})
+
+        # in the mean-variance mode the targets may be left out, the holdings are the universe
+        rng = np.random.default_rng(5)
+        start = datetime.date.today() - datetime.timedelta(days=40)
+        for stock in Stock.objects.filter(ticker__in=['ALPH', 'BETA']):
+            StockPriceHistory.objects.bulk_create(
+                StockPriceHistory(
+                    stock=stock, date=start + datetime.timedelta(days=day), open_price=close, close_price=close,
+                    region="United States", type="Equity", price_history=[close],
+                )
+                for day, close in enumerate(10 * np.cumprod(1 + rng.normal(0.001, 0.01, size=40)))
+            )
+        body = {'mode': 'mean_variance', 'accounts': [{'username': 'client1'}]}
+        response = self.client.post(reverse('rebalance'), json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        targets = response.json()['accounts'][0]['targets']
+        self.assertTrue(targets)
+        self.assertLessEqual(set(targets), {'ALPH', 'BETA'})
+        self.client.force_login(profiles[0].user)
+        body = {'accounts': [{'username': 'client2'}]}
+        self.assertEqual(self.client.post(reverse('rebalance'), json.dumps(body), content_type='application/json').status_code, 403)
+
+
+class StockSearchTests(TestCase):
+    """
+        The typeahead ranks tickers before names and follows renamed stocks
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create stocks whose tickers and names share prefixes
+        """
+        for ticker, company_name in [('AP', 'Apex Partners'), ('APPL', 'Applied Logic'), ('MAP', 'Mapleton Apparel'),
+                                     ('APP', 'Software Co'), ('ZZZ', 'Sleep Inc')]:
+            Stock.objects.create(ticker=ticker, company_name=company_name, current_price=1)
+
+
+    def setUp(self):
+        """
+            every test builds its own index
+        """
+        cache.clear()
+        stock_search.clear()
+
+
+    def test_ranking_and_refresh(self):
+        """
+            exact ticker, ticker prefixes, name prefixes, then word prefixes
+        """
+        tickers = [stock['ticker'] for stock in stock_search.search('app')]
+        self.assertEqual(tickers, ['APP', 'APPL', 'MAP'])
+        self.assertEqual([stock['ticker'] for stock in stock_search.search('ap', limit=2)], ['AP', 'APP'])
+        self.assertEqual(stock_search.search('  '), [])
+
+        stock = Stock.objects.get(ticker='ZZZ')
+        stock.company_name = 'Apparatus Inc'
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.save()
+        response = self.client.get(reverse('stock_search'), {'q': 'appar'})
+        self.assertEqual([stock['ticker'] for stock in response.json()['results']], ['ZZZ', 'MAP'])
+
+
+    def test_buy_sell_form_takes_a_ticker(self):
+        """
+            the form renders no options and accepts a ticker in any case
+        """
+        self.assertNotIn('<option', BuySellForm().as_p().split('<datalist')[0])
+        form = BuySellForm({'stock': ' appl ', 'action': 'buy', 'shares': 1, 'order_type': 'market'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['stock'].company_name, 'Applied Logic')
+
+
+class ScreenerTests(TestCase):
+    """
+        Screens run over the in-memory snapshot, which follows price changes without a rebuild
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+            create stocks with a daily record and indicators each
+        """
+        cls.user = User.objects.create_user(username='screener', password='password')
+        today = datetime.date.today()
+        for i, (price, close, region) in enumerate([(10, 10, 'US'), (22, 20, 'US'), (33, 30, 'EU'), (5, 4, 'EU')]):
+            stock = Stock.objects.create(ticker=f"S{i}", company_name=f"Screened {i}", current_price=price)
+            StockPriceHistory.objects.create(
+                stock=stock, date=today, open_price=close, close_price=close, region=region, type="Equity",
+                price_history=[close],
+            )
+            StockIndicators.objects.create(stock=stock, computed_at=timezone.now(), volatility=0.01 * (i + 1))
+
+
+    def setUp(self):
+        """
+            every test builds its own snapshot
+        """
+        cache.clear()
+        screener.clear()
+
+
+    def tickers(self, filters, sort=None, limit=50):
+        """
+            return the number of matches and the tickers of the screen
+        """
+        count, rows = screener.screen(filters, sort, limit)
+        return count, [row['ticker'] for row in rows]
+
+
+    def test_filters_and_top_k(self):
+        """
+            predicates combine, the top-K sort puts the biggest movers first
+        """
+        self.assertEqual(self.tickers([], '-change', 2), (4, ['S3', 'S1']))
+        self.assertEqual(self.tickers([('region', 'eq', 'EU'), ('volatility', 'lt', '0.035')]), (1, ['S2']))
+        self.assertEqual(self.tickers([('price', 'gte', '10'), ('region', 'in', 'US,XX')], 'price'), (2, ['S0', 'S1']))
+        with self.assertRaises(ScreenError):
+            screener.screen([('nope', 'eq', '1')])
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('screener'), {'change__gt': '0.05', 'sort': '-change', 'limit': 1})
+        self.assertEqual(response.json()['count'], 3)
+        self.assertEqual(response.json()['results'][0]['ticker'], 'S3')
+        self.assertEqual(self.client.get(reverse('screener'), {'price__about': '1'}).status_code, 400)
+
+
+    def test_price_updates_reach_the_snapshot(self):
+        """
+            this process's price changes are applied in place, the screen runs no query
+        """
+        screener.screen([])
+        with self.captureOnCommitCallbacks(execute=True):
+            update_prices([('S0', 15)])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.tickers([('change', 'gt', '0.4')]), (1, ['S0']))
+
+        # a new stock moves the stock list version, the next screen sees it
+        with self.captureOnCommitCallbacks(execute=True):
+            Stock.objects.create(ticker='S9', company_name='Late', current_price=1)
+        self.assertEqual(self.tickers([], 'price', 1), (5, ['S9']))
+
+
+class PriceStreamTests(TestCase):
+    """
+        Price changes reach the stream subscribers of the changed stocks, coalesced
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='streamer', password='pw')
+        profile = UserProfile.objects.create(user=cls.user, first_name='S', last_name='T', email='s@example.com')
+        cls.watched = Stock.objects.create(ticker='WAT', company_name='Watched', current_price=10)
+        cls.other = Stock.objects.create(ticker='OTH', company_name='Other', current_price=20)
+        WatchList.objects.create(user=profile, stock=cls.watched, added_price=10, current_price=10)
+
+
+    def test_wsgi_stream_sends_snapshot(self):
+        """
+            without ASGI the stream answers once with the prices of the user's stocks
+        """
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('price_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn(b'retry: ', response.content)
+        self.assertIn(b'data: [{"ticker":"WAT","price":"10.00"}]', response.content)
+
+
+    async def test_hub_coalesces_changes(self):
+        """
+            several changes of a stock within the interval are pushed once, other stocks not at all
+        """
+        hub = PriceHub()
+        subscription = hub.subscribe([self.watched.pk])
+        hub.deliver({self.watched.pk: ('WAT', 10, 11), self.other.pk: ('OTH', 20, 21)})
+        hub.deliver({self.watched.pk: ('WAT', 11, 12)})
+
+        batch = await subscription.next_batch(timeout=1)
+        self.assertEqual(batch, {self.watched.pk: ('WAT', 10, 12)})
+        self.assertEqual(await subscription.next_batch(timeout=0.01), {})
+
+        subscription.close()
+        self.assertEqual(hub.subscriber_count(), 0)
+
+
+class ImportPricesTests(TestCase):
+    """
+        import_prices upserts stocks and bars and tells the caches about the new stocks
+    """
+
+    def test_import_csv(self):
+        """
+            a small CSV creates its stocks and bars, and the typeahead finds them once committed
+        """
+        cache.clear()
+        stock_search.clear()
+        stock_search.search('anything')  # build the index before the import
+        Stock.objects.create(ticker='OLDI', company_name='Old Import', current_price=5)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv:
+            csv.write("ticker,timestamp,open,high,low,close,volume,company_name\n")
+            csv.write("newi,2024-01-02T10:00:00Z,10,11,9,10.5,100,New Import\n")
+            csv.write("NEWI,2024-01-02T11:00:00Z,10.5,12,10,11.5,200,New Import\n")
+            csv.write("OLDI,2024-01-02T10:00:00Z,5,5,5,5,0,Old Import Renamed\n")
+        self.addCleanup(os.remove, csv.name)
+
+        search_version = get_search_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_prices', csv.name, stdout=io.StringIO())
+
+        stock = Stock.objects.get(ticker='NEWI')
+        self.assertEqual(stock.company_name, 'New Import')
+        self.assertEqual(list(stock.bars.order_by('timestamp').values_list('close_price', 'volume')), [(Decimal('10.50'), 100), (Decimal('11.50'), 200)])
+        self.assertEqual(Stock.objects.get(ticker='OLDI').company_name, 'Old Import Renamed')
+        self.assertNotEqual(get_search_version(), search_version)
+        self.assertEqual([row['ticker'] for row in stock_search.search('NEWI')], ['NEWI'])
+
+        # a day continued in another file still ends up as one daily record, read by the backtests
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv:
+            csv.write("ticker,timestamp,open,high,low,close\n")
+            csv.write("NEWI,2024-01-02T12:00:00Z,11.5,13,11,12.5\n")
+            csv.write("NEWI,2024-01-03T10:00:00Z,12.5,13,12,13\n")
+        self.addCleanup(os.remove, csv.name)
+        call_command('import_prices', csv.name, stdout=io.StringIO())
+        record = StockPriceHistory.objects.get(stock=stock, date=datetime.date(2024, 1, 2))
+        self.assertEqual((record.open_price, record.close_price), (Decimal('10.00'), Decimal('12.50')))
+        self.assertEqual(list(record.get_price_array()), [10.5, 11.5, 12.5])
+        dates, stock_ids, close = load_closes([stock.pk])
+        self.assertEqual((len(dates), close[:, 0].tolist()), (2, [12.5, 13.0]))
+
+
+class SeedBenchTests(TestCase):
+    """
+        seed_bench creates the requested amount of data and --clear removes it
+    """
+
+    def test_seed_and_clear(self):
+        """
+            every user gets their positions, watchlist and transactions, every stock its bars
+        """
+        options = {'users': 3, 'stocks': 5, 'positions': 2, 'watched': 2, 'transactions': 4, 'history_days': 2, 'bars': 6}
+        call_command('seed_bench', prefix='ST', stdout=io.StringIO(), **options)
+
+        self.assertEqual(Stock.objects.filter(ticker__startswith='ST').count(), 5)
+        self.assertEqual(PriceBar.objects.count(), 30)
+        self.assertEqual(Portfolio.objects.filter(user__user__username='st-user-0').count(), 2)
+        self.assertEqual(Transaction.objects.count(), 12)
+
+        call_command('seed_bench', prefix='ST', clear=True, stdout=io.StringIO())
+        self.assertFalse(Stock.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+
+PROFILED_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'wt_scrooge_capital.profiling.ProfilingMiddleware',
+]
+
+
+@override_settings(MIDDLEWARE=PROFILED_MIDDLEWARE)
+class ProfilingMiddlewareTests(TestCase):
+    """
+        Profiled requests report their timings in Server-Timing and the staff-only stats
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='viewer', password='pw')
+        UserProfile.objects.create(user=cls.user, first_name='V', last_name='W', email='v@example.com')
+        cls.staff = User.objects.create_user(username='staff', password='pw', is_staff=True)
+
+
+    def setUp(self):
+        profiling_stats.clear()
+
+
+    def test_server_timing_and_stats(self):
+        """
+            the header breaks the request down, the stats collect it per view
+        """
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('watchlist'))
+        timing = response['Server-Timing']
+        for metric in ('total;dur=', 'db;dur=', 'template;dur='):
+            self.assertIn(metric, timing)
+
+        self.assertEqual(self.client.get(reverse('profiling_stats')).status_code, 403)
+        self.client.force_login(self.staff)
+        views = self.client.get(reverse('profiling_stats')).json()['views']
+        self.assertEqual(views['watchlist']['requests'], 1)
+        self.assertGreater(views['watchlist']['mean_queries'], 0)
+
+
+    def test_one_profiler_at_a_time(self):
+        """
+            a request sampled while another is profiled runs without cProfile, every dump gets its own file
+        """
+        self.client.force_login(self.staff)
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROFILING_DUMP_DIR=directory):
+            with profiling_lock:
+                self.client.get(reverse('stock_list'), {'_profile': '1'})
+            self.assertEqual(os.listdir(directory), [])
+
+            self.client.get(reverse('stock_list'), {'_profile': '1'})
+            self.client.get(reverse('stock_list'), {'_profile': '1'})
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(len(set(profiling_stats.snapshot()['profiles'])), 2)
+
+
+class FragmentCacheTests(QueryBudgetMixin, TestCase):
+    """
+        Cached page fragments are reused until the user trades or their stocks' prices move
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='cached', password='pw')
+        cls.profile = UserProfile.objects.create(user=cls.user, first_name='C', last_name='D', email='c@example.com')
+        cls.stock = Stock.objects.create(ticker='FRG', company_name='Fragment', current_price=10)
+        execute_order(cls.profile, cls.stock, 'buy', 3)
+
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+
+    def test_repeat_view_reuses_fragment_until_data_changes(self):
+        """
+            a repeat view skips the fragment's queries, trades and price changes show up at once
+        """
+        first = self.client.get(reverse('portfolio'))
+        with self.assertMaxQueries(4):
+            second = self.client.get(reverse('portfolio'))
+        self.assertContains(second, 'Total Shares : 3')
+        self.assertEqual(first.content.count(b'FRG'), second.content.count(b'FRG'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            execute_order(self.profile, Stock.objects.get(pk=self.stock.pk), 'buy', 2)
+        self.assertContains(self.client.get(reverse('portfolio')), 'Total Shares : 5')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            update_prices([('FRG', 12)])
+        self.assertContains(self.client.get(reverse('portfolio')), 'Total Value : $60.00')
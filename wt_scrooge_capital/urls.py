@@ -7,17 +7,28 @@
 from django.urls import path
 from . import views
 from django.contrib.auth import views as auth_views
-from .views import AddToWatchlistView, CustomLoginView, HomeView, PortfolioView, RemoveFromWatchlistView, SignupView, \
-                   StockDetailView, StockListView, WatchlistView, TransactionsView, ProfileView
+from .views import AddToWatchlistView, BacktestView, BatchOrderView, CancelOrderView, CustomLoginView, HomeView, PortfolioRiskView, PortfolioView, PositionPnLView, PriceStreamView, ProfilingStatsView, RebalanceView, RemoveFromWatchlistView, ScreenerView, SignupView, StockSearchView, \
+                   StockDetailView, StockListView, StockSeriesView, WatchlistView, TransactionsView, ProfileView
 
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
     path('portfolio/', PortfolioView.as_view(), name='portfolio'),
+    path('portfolio/pnl/', PositionPnLView.as_view(), name='portfolio_pnl'),
+    path('portfolio/risk/', PortfolioRiskView.as_view(), name='portfolio_risk'),
+    path('portfolio/rebalance/', RebalanceView.as_view(), name='rebalance'),
+    path('orders/<int:pk>/cancel/', CancelOrderView.as_view(), name='cancel_order'),
+    path('orders/batch/', BatchOrderView.as_view(), name='batch_orders'),
+    path('backtest/', BacktestView.as_view(), name='backtest'),
     path('watchlist/', WatchlistView.as_view(), name='watchlist'),
     path('transactions/', TransactionsView.as_view(), name='transactions'),
     path('profile/', ProfileView.as_view(), name='profile'),
     path('stock/<int:pk>/graphs/', StockDetailView.as_view(), name='stock_detail'),
+    path('stock/<int:pk>/series/', StockSeriesView.as_view(), name='stock_series'),
+    path('prices/stream/', PriceStreamView.as_view(), name='price_stream'),
+    path('profiling/stats/', ProfilingStatsView.as_view(), name='profiling_stats'),
     path('stocks/', StockListView.as_view(), name='stock_list'),
+    path('stocks/screen/', ScreenerView.as_view(), name='screener'),
+    path('stocks/search/', StockSearchView.as_view(), name='stock_search'),
     path('watchlist/remove/<int:pk>/', RemoveFromWatchlistView.as_view(), name='remove_from_watchlist'),
     path('add-to-watchlist/<int:stock_id>/', AddToWatchlistView.as_view(), name='add_to_watchlist'),
     path('login/', CustomLoginView.as_view(), name='login'),
@@ -0,0 +1,129 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/valuations.py
+
+# Incrementally maintained portfolio valuations
+
+# Every user has one PortfolioValuation row with the running total shares,
+# market value, cost basis and realized P&L of their portfolio. The order service adds the
+# effect of each trade (apply_trade) and price changes are pushed to every
+# holder with one UPDATE per stock (apply_price_changes), so reading a
+# portfolio's value never scans its positions. A valuation that doesn't exist
+# yet is built from the positions on first read.
+#
+# take_snapshots() copies every valuation into PortfolioSnapshot for
+# time-series charts, run it periodically with `manage.py snapshot_portfolios`.
+
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Portfolio, PortfolioSnapshot, PortfolioValuation, RealizedPnL
+from .profiling import profiled
+
+
+CENTS = Decimal("0.01")
+MONEY = DecimalField(max_digits=16, decimal_places=2)
+
+
+def rebuild_valuation(user_profile):
+    """
+        recompute a user's valuation from their positions and store it
+    """
+    totals = Portfolio.objects.filter(user=user_profile).aggregate(
+        total_shares=Coalesce(Sum('shares'), 0),
+        market_value=Coalesce(Sum(F('shares') * F('stock__current_price'), output_field=MONEY), Value(Decimal(0))),
+        cost_basis=Coalesce(Sum('cost_basis'), Value(Decimal(0))),
+    )
+    realized = RealizedPnL.objects.filter(user=user_profile).aggregate(
+        realized_pnl=Coalesce(Sum('realized_pnl'), Value(Decimal(0))),
+    )
+    valuation, _ = PortfolioValuation.objects.update_or_create(
+        user=user_profile,
+        defaults={
+            'total_shares': totals['total_shares'],
+            'market_value': Decimal(totals['market_value']).quantize(CENTS),
+            'cost_basis': Decimal(totals['cost_basis']).quantize(CENTS),
+            'realized_pnl': Decimal(realized['realized_pnl']).quantize(CENTS),
+        },
+    )
+    return valuation
+
+
+@profiled('valuation')
+def get_valuation(user_profile):
+    """
+        return the user's valuation, building it if it doesn't exist yet
+    """
+    valuation = PortfolioValuation.objects.filter(user=user_profile).first()
+    if valuation is None:
+        with transaction.atomic():
+            valuation = rebuild_valuation(user_profile)
+    return valuation
+
+
+def apply_trade(user_profile, shares, market_value, cost_basis, realized_pnl=0):
+    """
+        add the effect of a trade (or a batch of trades) to the user's valuation
+
+        call it after the positions and the realized P&L are written and inside the same transaction
+    """
+    updated = PortfolioValuation.objects.filter(user=user_profile).update(
+        total_shares=F('total_shares') + shares,
+        market_value=F('market_value') + Decimal(market_value).quantize(CENTS),
+        cost_basis=F('cost_basis') + Decimal(cost_basis).quantize(CENTS),
+        realized_pnl=F('realized_pnl') + Decimal(realized_pnl).quantize(CENTS),
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        # the first trade of this user, the new positions already include it
+        rebuild_valuation(user_profile)
+
+
+def apply_price_changes(changes):
+    """
+        move the market value of every holder of the changed stocks, one UPDATE per stock
+
+        `changes` maps stock ids to (old price, new price)
+    """
+    for stock_id, (old_price, new_price) in changes.items():
+        delta = Decimal(new_price) - Decimal(old_price)
+        if not delta:
+            continue
+
+        held = Portfolio.objects.filter(user=OuterRef('user'), stock_id=stock_id).values('shares')[:1]
+        PortfolioValuation.objects.filter(user__portfolio__stock_id=stock_id).update(
+            market_value=ExpressionWrapper(
+                F('market_value') + Subquery(held) * Value(delta, output_field=MONEY),
+                output_field=MONEY,
+            ),
+            updated_at=timezone.now(),
+        )
+
+
+def take_snapshots(taken_at=None, batch_size=1000):
+    """
+        store the current valuation of every user as a PortfolioSnapshot, returns the number stored
+    """
+    taken_at = taken_at or timezone.now()
+    rows = PortfolioValuation.objects.values_list('user_id', 'total_shares', 'market_value', 'cost_basis')
+
+    count = 0
+    batch = []
+    for user_id, total_shares, market_value, cost_basis in rows.iterator(chunk_size=batch_size):
+        batch.append(PortfolioSnapshot(
+            user_id=user_id,
+            taken_at=taken_at,
+            total_shares=total_shares,
+            market_value=market_value,
+            cost_basis=cost_basis,
+        ))
+        if len(batch) >= batch_size:
+            PortfolioSnapshot.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    PortfolioSnapshot.objects.bulk_create(batch)
+    return count + len(batch)
@@ -0,0 +1,204 @@
+# By: Tsz Kit Wong
+# File: wt_scrooge_capital/versions.py
+
+# Cache version counters of the app
+
+# Cached fragments include a data version in their key instead of being deleted
+# one by one. Bumping the version makes every key built from the old version
+# unreachable, and the stale entries simply expire. Versions start from the
+# current time in milliseconds so a counter that was evicted from the cache
+# never restarts at a value some old fragment was cached under.
+#
+# The counters are
+#
+#   price version     per stock, its price history (bars, charts)
+#   quote version     per stock, its current price and name
+#   stock list        the list of stocks as a whole
+#   holdings version  per user, their positions, watchlist and transactions
+#   search version    the tickers and company names of the stocks
+
+
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+
+
+def _new_version():
+    """
+        return a starting version that no earlier counter of the same key can have reached
+    """
+    return time.time_ns() // 1_000_000
+
+
+def _get_version(key):
+    """
+        return the version counter stored under a key, creating it if needed
+    """
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        cache.add(key, version, timeout=None)
+        version = cache.get(key, version)
+    return version
+
+
+def _bump_version(key):
+    """
+        move the version counter stored under a key forward
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the counter was never read or has been evicted, a fresh start is already a new version
+        cache.add(key, _new_version(), timeout=None)
+
+
+def _price_version_key(stock_id):
+    """
+        return the cache key holding a stock's price-history version
+    """
+    return f"wt_scrooge_capital:price-version:{stock_id}"
+
+
+def _price_modified_key(stock_id):
+    """
+        return the cache key holding when a stock's price history last changed
+    """
+    return f"wt_scrooge_capital:price-modified:{stock_id}"
+
+
+def _quote_version_key(stock_id):
+    """
+        return the cache key holding a stock's quote version
+    """
+    return f"wt_scrooge_capital:quote-version:{stock_id}"
+
+
+def _holdings_version_key(user_profile_id):
+    """
+        return the cache key holding a user's holdings version
+    """
+    return f"wt_scrooge_capital:holdings-version:{user_profile_id}"
+
+
+STOCK_LIST_VERSION_KEY = "wt_scrooge_capital:stock-list-version"
+SEARCH_VERSION_KEY = "wt_scrooge_capital:search-version"
+
+
+def get_price_version(stock_id):
+    """
+        return the current price-history version of a stock
+    """
+    return _get_version(_price_version_key(stock_id))
+
+
+def get_price_versions(stock_ids):
+    """
+        return {stock id: version} of the price histories of the given stocks, in one cache read
+    """
+    keys = {_price_version_key(stock_id): stock_id for stock_id in stock_ids}
+    found = cache.get_many(list(keys))
+    versions = {keys[key]: version for key, version in found.items()}
+    for key, stock_id in keys.items():
+        if stock_id not in versions:
+            versions[stock_id] = _get_version(key)
+    return versions
+
+
+def bump_price_version(*stock_ids):
+    """
+        invalidate everything cached against the price history of the given stocks
+    """
+    for stock_id in set(stock_ids):
+        _bump_version(_price_version_key(stock_id))
+        cache.set(_price_modified_key(stock_id), timezone.now(), timeout=None)
+
+
+def get_quote_versions(stock_ids):
+    """
+        return {stock id: version} of the current quotes (price, name) of the given stocks, in one cache read
+    """
+    keys = {_quote_version_key(stock_id): stock_id for stock_id in stock_ids}
+    found = cache.get_many(list(keys))
+    versions = {keys[key]: version for key, version in found.items()}
+    for key, stock_id in keys.items():
+        if stock_id not in versions:
+            versions[stock_id] = _get_version(key)
+    return versions
+
+
+def bump_quote_version(*stock_ids):
+    """
+        invalidate everything cached against the current quotes of the given stocks
+    """
+    for stock_id in set(stock_ids):
+        _bump_version(_quote_version_key(stock_id))
+
+
+def bump_stock_versions(*stock_ids):
+    """
+        invalidate everything cached against the given stocks, their quotes, the stock list and the
+        search index, for bulk writes that skip the post_save signals
+    """
+    bump_quote_version(*stock_ids)
+    bump_stock_list_version()
+    bump_search_version()
+
+
+def get_stock_list_version():
+    """
+        return the version of the list of stocks as a whole, which moves with any stock's quote
+    """
+    return _get_version(STOCK_LIST_VERSION_KEY)
+
+
+def bump_stock_list_version():
+    """
+        invalidate everything cached against the list of stocks
+    """
+    _bump_version(STOCK_LIST_VERSION_KEY)
+
+
+def get_search_version():
+    """
+        return the version of the tickers and company names the search index is built from
+    """
+    return _get_version(SEARCH_VERSION_KEY)
+
+
+def bump_search_version():
+    """
+        make every process rebuild its search index
+    """
+    _bump_version(SEARCH_VERSION_KEY)
+
+
+def get_holdings_version(user_profile_id):
+    """
+        return the version of a user's positions, watchlist and transactions
+    """
+    return _get_version(_holdings_version_key(user_profile_id))
+
+
+def bump_holdings_version(*user_profile_ids):
+    """
+        invalidate everything cached against the holdings of the given users
+    """
+    for user_profile_id in set(user_profile_ids):
+        _bump_version(_holdings_version_key(user_profile_id))
+
+
+def get_price_last_modified(stock_id):
+    """
+        return when the price history of a stock last changed, as far as this cache has seen
+
+        a stock that has not changed since the counter was created reports the creation time
+    """
+    key = _price_modified_key(stock_id)
+    modified = cache.get(key)
+    if modified is None:
+        modified = timezone.now()
+        cache.add(key, modified, timeout=None)
+        modified = cache.get(key, modified)
+    return modified
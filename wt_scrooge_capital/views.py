@@ -4,21 +4,49 @@
 # views for the wt_scrooge_capital app
 
 
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
 from django.db import IntegrityError
-from django.http import HttpResponseRedirect
+from django.db.models import ExpressionWrapper, F
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
 from django.views import View
-from .models import Transaction, UserProfile, Portfolio, WatchList, Stock, StockPriceHistory
+from django.views.decorators.http import condition
+from .models import Order, Transaction, UserProfile, Portfolio, WatchList, Stock, StockIndicators, StockPriceHistory
 from django.views.generic import ListView, CreateView, DetailView
-from django.contrib.auth.mixins import LoginRequiredMixin 
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth import login
 from django.contrib.auth import views as auth_views
 from .forms import BuySellForm, CustomAuthenticationForm, SignupForm
 from django.views.generic.edit import FormView
-import plotly.express as px
-from plotly.io import to_html
+from .fragments import form_fragment_version, fragment_timeout, stock_list_fragment_version, user_fragment_version
+from .backtest import STRATEGIES, load_closes, run_backtest
+from .charts import chart_max_points, chart_render_mode, get_price_chart, get_price_series
+from .versions import get_price_last_modified, get_price_version, get_search_version
+from .middleware import get_user_profile
+from .lots import position_pnl
+from .orderbook import cancel_order, place_order
+from .orders import OrderError, execute_order, execute_orders
+from .pagination import KeysetPaginationMixin, keyset_page
+from .profiling import stats as profiling_stats
+from .rebalance import RebalanceError, rebalance_accounts
+from .risk import portfolio_risk
+from .valuations import MONEY, get_valuation
+from .screener import ScreenError, parse_filters, screener
+from .search import stock_search
+from .streams import hub, price_events, sse_event, stream_retry
 import datetime
+import json
+
+
+# newest first, the id breaks ties between transactions of the same day
+TRANSACTION_ORDERING = ['-purchase_date', '-id']
 
 
 class CustomLoginView(auth_views.LoginView):
@@ -43,9 +71,11 @@ class HomeView(LoginRequiredMixin, ListView):
             get the context data for the home page
         """
         context = super().get_context_data(**kwargs)
-        user_profile = UserProfile.objects.get(user=self.request.user)
+        user_profile = get_user_profile(self.request)
         context['profile'] = user_profile
         context['stocks'] = Stock.objects.all()
+        context['fragment_timeout'] = fragment_timeout()
+        context['fragment_version'] = stock_list_fragment_version()
         return context
      
 
@@ -62,8 +92,13 @@ class PortfolioView(LoginRequiredMixin, ListView):
         """
             gets the queryset for the portfolio
         """
-        user_profile = UserProfile.objects.get(user=self.request.user)
-        return Portfolio.objects.filter(user=user_profile)
+        user_profile = get_user_profile(self.request)
+        # the value of each stock in the portfolio is calculated by the database
+        return (
+            Portfolio.objects.filter(user=user_profile)
+            .select_related('stock')
+            .annotate(total_value=ExpressionWrapper(F('shares') * F('stock__current_price'), output_field=MONEY))
+        )
 
 
     def get_context_data(self, **kwargs):
@@ -71,18 +106,18 @@ class PortfolioView(LoginRequiredMixin, ListView):
             gets the context data for the portfolio
         """
         context = super().get_context_data(**kwargs)
-        user_profile = UserProfile.objects.get(user=self.request.user)
-        portfolio_items = Portfolio.objects.filter(user=user_profile)
-
-        # calculate the total value of each stock in the portfolio
-        for item in portfolio_items:
-            item.total_value = item.shares * item.stock.current_price
-        
-        context['portfolio'] = portfolio_items
-
-        # calculate the total value of the portfolio based on the current price of the stocks and the number of shares
-        context['portfolio_total_shares'] = sum(item.shares for item in portfolio_items)
-        context['portfolio_total_value'] = sum(item.shares * item.stock.current_price for item in portfolio_items)
+        user_profile = get_user_profile(self.request)
+
+        # the portfolio totals are maintained incrementally, reading them doesn't scan the rows,
+        # and they are only read at all when the cached fragment has to be rendered again
+        valuation = SimpleLazyObject(lambda: get_valuation(user_profile))
+        context['valuation'] = valuation
+        context['portfolio_total_shares'] = SimpleLazyObject(lambda: valuation.total_shares)
+        context['portfolio_total_value'] = SimpleLazyObject(lambda: valuation.market_value)
+        context['fragment_timeout'] = fragment_timeout()
+        context['fragment_version'] = user_fragment_version(user_profile.pk)
+        context['form_version'] = form_fragment_version(self.request)
+        context['open_orders'] = Order.objects.filter(user=user_profile, status='open').select_related('stock').order_by('-created_at')
         context['buy_sell_form'] = BuySellForm()
         return context
     
@@ -92,66 +127,255 @@ class PortfolioView(LoginRequiredMixin, ListView):
             handles the buy/sell form submission
         """
         form = BuySellForm(request.POST)
-        user_profile = UserProfile.objects.get(user=request.user)
+        user_profile = get_user_profile(request)
         
         if form.is_valid():
-            stock = form.cleaned_data['stock']
-            action = form.cleaned_data['action']
-            shares = form.cleaned_data['shares']
-
-            # get the portfolio item for the stock if it exists, otherwise create a new one
-            portfolio_item, created = Portfolio.objects.get_or_create(user=user_profile, stock=stock, defaults={
-                'shares': 0,
-                'purchase_price': stock.current_price,
-                'purchase_date': datetime.date.today(),
-            })
-
-            # check if the user has enough shares to sell, if not, redirect to the portfolio page
-            if action == 'buy':
-                portfolio_item.shares += shares
-                portfolio_item.purchase_price = stock.current_price
-
-                # update the transaction history
-                Transaction.objects.create(
-                    user=user_profile,
-                    stock=stock,
-                    shares=shares,
-                    purchase_price=stock.current_price,
-                    purchase_date=datetime.date.today(),
-                    transaction_type='buy',
-                )
-            elif action == 'sell':
-                if portfolio_item.shares == 0:
-                    portfolio_item.delete()
-
-                    return redirect(reverse('portfolio'))
-                
-                if portfolio_item.shares >= shares:
-                    portfolio_item.shares -= shares
-
-                    if portfolio_item.shares == 0:
-                        portfolio_item.delete()
-                        return redirect(reverse('portfolio'))
-                    
-                    # update the transaction history   
-                    Transaction.objects.create(
-                        user=user_profile,
-                        stock=stock,
-                        shares=shares,
-                        purchase_price=stock.current_price,
-                        purchase_date=datetime.date.today(),
-                        transaction_type='sell',
+            # the order service applies the trade atomically, rejected orders just return to the portfolio page
+            order_type = form.cleaned_data['order_type'] or 'market'
+            try:
+                if order_type == 'market':
+                    execute_order(
+                        user_profile,
+                        form.cleaned_data['stock'],
+                        form.cleaned_data['action'],
+                        form.cleaned_data['shares'],
+                        idempotency_key=form.cleaned_data['idempotency_key'],
                     )
-                    
                 else:
-                    return redirect(reverse('portfolio'))
-
-            portfolio_item.save()
-            return redirect(reverse('portfolio'))
+                    # limit and stop orders rest on the order book until the price reaches them
+                    place_order(
+                        user_profile,
+                        form.cleaned_data['stock'],
+                        form.cleaned_data['action'],
+                        order_type,
+                        form.cleaned_data['price'],
+                        form.cleaned_data['shares'],
+                    )
+            except OrderError:
+                pass
 
         return redirect(reverse('portfolio'))
 
 
+class BatchOrderView(LoginRequiredMixin, View):
+    """
+        Accepts a JSON list of orders and executes them in one transaction
+    """
+    raise_exception = True  # API clients get a 403 instead of a redirect to the login page
+
+
+    def post(self, request, *args, **kwargs):
+        """
+            execute the posted orders, the body is a JSON list of
+            {"ticker": ..., "action": "buy" | "sell", "shares": ..., "idempotency_key": ...}
+        """
+        try:
+            orders = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': "The request body must be JSON."}, status=400)
+
+        if not isinstance(orders, list):
+            return JsonResponse({'error': "The request body must be a list of orders."}, status=400)
+        max_orders = getattr(settings, 'MAX_BATCH_ORDERS', 1000)
+        if len(orders) > max_orders:
+            return JsonResponse({'error': f"A batch can hold at most {max_orders} orders."}, status=400)
+
+        results = execute_orders(get_user_profile(request), orders)
+        return JsonResponse({'results': results})
+
+
+class CancelOrderView(LoginRequiredMixin, View):
+    """
+        Handles cancelling one of the user's resting orders
+    """
+    def post(self, request, pk):
+        """
+            cancel the order if it's still open
+        """
+        cancel_order(get_user_profile(request), pk)
+        return HttpResponseRedirect(reverse('portfolio'))
+
+
+class PositionPnLView(LoginRequiredMixin, View):
+    """
+        JSON realized and unrealized P&L of each of the user's positions, from their lots
+    """
+    raise_exception = True
+
+
+    def get(self, request, *args, **kwargs):
+        """
+            return the P&L per position and the totals of the portfolio
+        """
+        user_profile = get_user_profile(request)
+        valuation = get_valuation(user_profile)
+        return JsonResponse({
+            'lot_method': user_profile.lot_method,
+            'positions': position_pnl(user_profile),
+            'unrealized_pnl': valuation.unrealized_pnl,
+            'realized_pnl': valuation.realized_pnl,
+        })
+
+
+class PortfolioRiskView(LoginRequiredMixin, View):
+    """
+        JSON risk figures of the user's portfolio: VaR, beta, volatilities and optionally the matrices
+    """
+    raise_exception = True
+
+
+    def get(self, request, *args, **kwargs):
+        """
+            ?confidence=0.95&horizon=1&matrix=1
+        """
+        try:
+            confidence = float(request.GET.get('confidence', 0.95))
+            horizon = int(request.GET.get('horizon', 1))
+        except ValueError:
+            return JsonResponse({'error': "The confidence and horizon must be numbers."}, status=400)
+        if not 0.5 <= confidence < 1 or not 1 <= horizon <= 252:
+            return JsonResponse({'error': "The confidence must be in [0.5, 1) and the horizon in 1-252 days."}, status=400)
+        report = portfolio_risk(get_user_profile(request), confidence, horizon, request.GET.get('matrix') == '1')
+        return JsonResponse(report)
+
+
+class RebalanceView(LoginRequiredMixin, View):
+    """
+        Computes, and optionally executes, the orders rebalancing accounts to target weights
+    """
+    raise_exception = True
+
+
+    def post(self, request, *args, **kwargs):
+        """
+            the body is JSON {"targets": {ticker: weight}, "cash": ..., "mode": "weights" | "mean_variance",
+            "lot_sizes": {ticker: shares}, "tolerance": ..., "risk_aversion": ..., "execute": false},
+            staff can rebalance other accounts with "accounts": [{"username": ..., "targets": ..., "cash": ...}]
+
+            in the weights mode every account needs targets, empty ones would sell the whole account,
+            in the mean-variance mode they only name the universe, the holdings when left out
+        """
+        try:
+            body = json.loads(request.body)
+            if not isinstance(body, dict):
+                raise ValueError
+        except ValueError:
+            return JsonResponse({'error': "The request body must be a JSON object."}, status=400)
+
+        entries = body.get('accounts')
+        if entries is None:
+            accounts = [{'user': get_user_profile(request), 'targets': body.get('targets'), 'cash': body.get('cash')}]
+        else:
+            if not request.user.is_staff:
+                raise PermissionDenied
+            max_accounts = getattr(settings, 'MAX_REBALANCE_ACCOUNTS', 5000)
+            if not isinstance(entries, list) or len(entries) > max_accounts:
+                return JsonResponse({'error': f"The accounts must be a list of at most {max_accounts} accounts."}, status=400)
+            try:
+                usernames = [entry['username'] for entry in entries]
+                profiles = {
+                    profile.user.username: profile
+                    for profile in UserProfile.objects.filter(user__username__in=usernames).select_related('user')
+                }
+            except (KeyError, TypeError):
+                return JsonResponse({'error': "Every account needs a username."}, status=400)
+            unknown = sorted(set(usernames) - set(profiles))
+            if unknown:
+                return JsonResponse({'error': f"Unknown users: {', '.join(unknown)}"}, status=400)
+            accounts = [
+                {
+                    'user': profiles[entry['username']],
+                    'targets': entry.get('targets', body.get('targets')),
+                    'cash': entry.get('cash', body.get('cash')),
+                }
+                for entry in entries
+            ]
+
+        mode = body.get('mode', 'weights')
+        for account in accounts:
+            if mode == 'mean_variance' and account['targets'] is None:
+                account['targets'] = {}
+            if not isinstance(account['targets'], dict) or mode == 'weights' and not account['targets']:
+                return JsonResponse({'error': "Every account needs its target weights."}, status=400)
+            try:
+                if account['cash'] is not None and float(account['cash']) < 0:
+                    return JsonResponse({'error': "The cash can't be negative."}, status=400)
+            except (TypeError, ValueError):
+                return JsonResponse({'error': "The cash must be a number."}, status=400)
+
+        try:
+            results = rebalance_accounts(
+                accounts,
+                mode=mode,
+                lot_sizes={ticker.upper(): int(size) for ticker, size in (body.get('lot_sizes') or {}).items()},
+                tolerance=float(body.get('tolerance', 0)),
+                risk_aversion=float(body.get('risk_aversion', 3)),
+            )
+        except (AttributeError, TypeError, ValueError):
+            return JsonResponse({'error': "The cash, lot sizes, tolerance and risk aversion must be numbers."}, status=400)
+        except RebalanceError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+
+        if body.get('execute'):
+            # the sells come first in each account's orders, so their proceeds are there for the buys
+            for account, result in zip(accounts, results):
+                if result['orders']:
+                    result['results'] = execute_orders(account['user'], result['orders'])
+        return JsonResponse({'accounts': results})
+
+
+class BacktestView(LoginRequiredMixin, View):
+    """
+        JSON backtest of a strategy over the stored daily history of some stocks
+
+        the fills follow the order rules, whole shares paid from each stock's equal part of the cash
+    """
+    raise_exception = True
+
+
+    def get(self, request, *args, **kwargs):
+        """
+            ?strategy=sma_crossover&fast=10&slow=30&tickers=AAPL,MSFT&start=2024-01-01&end=2024-12-31,
+            the user's holdings when no tickers are given
+        """
+        strategy = request.GET.get('strategy', 'sma_crossover')
+        if strategy not in STRATEGIES:
+            return JsonResponse({'error': f"Unknown strategy: {strategy}", 'strategies': sorted(STRATEGIES)}, status=400)
+        defaults = STRATEGIES[strategy][1]
+        try:
+            params = {name: type(default)(request.GET[name]) for name, default in defaults.items() if name in request.GET}
+        except ValueError:
+            return JsonResponse({'error': "The strategy parameters must be numbers."}, status=400)
+        bounds = []
+        for name in ('start', 'end'):
+            value = request.GET.get(name)
+            try:
+                # None for a malformed date, ValueError for an impossible one like 2024-02-30
+                bounds.append(parse_date(value) if value else None)
+            except ValueError:
+                bounds.append(None)
+            if value and bounds[-1] is None:
+                return JsonResponse({'error': f"The {name} must be a date (YYYY-MM-DD)."}, status=400)
+        start, end = bounds
+
+        tickers = [ticker.strip().upper() for ticker in request.GET.get('tickers', '').split(',') if ticker.strip()]
+        max_tickers = getattr(settings, 'BACKTEST_MAX_TICKERS', 50)
+        if len(tickers) > max_tickers:
+            return JsonResponse({'error': f"A backtest can cover at most {max_tickers} stocks."}, status=400)
+        stocks = Stock.objects.filter(ticker__in=tickers) if tickers else Stock.objects.filter(portfolio__user=get_user_profile(request))
+        dates, stock_ids, close = load_closes(stocks.values_list('pk', flat=True), start, end)
+        if len(dates) < 2:
+            return JsonResponse({'error': "Not enough price history to backtest."}, status=400)
+
+        try:
+            result = run_backtest(close, strategy, params)
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        result['equity'] = {'dates': [str(date) for date in dates], 'values': result['equity'].round(2).tolist()}
+        result['stocks'] = len(stock_ids)
+        return JsonResponse(result)
+
+
 class WatchlistView(LoginRequiredMixin, ListView):
     """
         Displays the user's watchlist
@@ -165,8 +389,8 @@ class WatchlistView(LoginRequiredMixin, ListView):
         """
             gets the queryset for the watchlist
         """
-        user_profile = UserProfile.objects.get(user=self.request.user)
-        return WatchList.objects.filter(user=user_profile)
+        user_profile = get_user_profile(self.request)
+        return WatchList.objects.filter(user=user_profile).select_related('stock')
 
 
     def get_context_data(self, **kwargs):
@@ -174,26 +398,45 @@ class WatchlistView(LoginRequiredMixin, ListView):
             gets the context data for the watchlist
         """
         context = super().get_context_data(**kwargs)
-        user_profile = UserProfile.objects.get(user=self.request.user)
+        user_profile = get_user_profile(self.request)
         context['profile'] = user_profile
+        context['fragment_timeout'] = fragment_timeout()
+        context['fragment_version'] = user_fragment_version(user_profile.pk)
+        context['form_version'] = form_fragment_version(self.request)
         return context
 
     
-class TransactionsView(LoginRequiredMixin, ListView):
+class TransactionsView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     """
-        Displays the transaction history for the logged-in user.
+        Displays the transaction history for the logged-in user, a page at a time (newest first).
     """
     model = Transaction
     template_name = 'wt_scrooge_capital/transactions_list.html'
     context_object_name = 'transactions'
+    keyset_ordering = TRANSACTION_ORDERING
 
 
     def get_queryset(self):
         """
-            gets the queryset for the transaction history
+            gets the requested page of the transaction history
         """
-        user_profile = UserProfile.objects.get(user=self.request.user)
-        return Transaction.objects.filter(user=user_profile)
+        user_profile = get_user_profile(self.request)
+        return self.paginate_keyset(Transaction.objects.filter(user=user_profile).select_related('stock'))
+
+
+    def serialize(self, transaction):
+        """
+            return the JSON form of a transaction
+        """
+        return {
+            'id': transaction.id,
+            'ticker': transaction.stock.ticker,
+            'company_name': transaction.stock.company_name,
+            'shares': transaction.shares,
+            'purchase_price': str(transaction.purchase_price),
+            'purchase_date': transaction.purchase_date.isoformat(),
+            'transaction_type': transaction.get_transaction_type_display(),
+        }
 
 
     def get_context_data(self, **kwargs):
@@ -201,7 +444,7 @@ class TransactionsView(LoginRequiredMixin, ListView):
             gets the context data for the transaction history
         """
         context = super().get_context_data(**kwargs)
-        user_profile = UserProfile.objects.get(user=self.request.user)
+        user_profile = get_user_profile(self.request)
         context['profile'] = user_profile
         return context
 
@@ -227,10 +470,15 @@ class ProfileView(LoginRequiredMixin, ListView):
             gets the context data for the profile
         """
         context = super().get_context_data(**kwargs)
-        user_profile = UserProfile.objects.get(user=self.request.user)
+        user_profile = get_user_profile(self.request)
         context['profile'] = user_profile
         context['stocks'] = Stock.objects.all()
-        context['transactions'] = Transaction.objects.filter(user=user_profile)
+        # the first page of the history, the rest is loaded from TransactionsView as the user scrolls
+        context['transactions'], context['next_cursor'] = keyset_page(
+            Transaction.objects.filter(user=user_profile).select_related('stock'),
+            TRANSACTION_ORDERING,
+            size=KeysetPaginationMixin.page_size,
+        )
         return context
 
 
@@ -267,47 +515,31 @@ class StockDetailView(LoginRequiredMixin, DetailView):
         """
         context = super().get_context_data(**kwargs)
         stock = self.object
-        price_history_record = StockPriceHistory.objects.filter(stock=stock).first()
-
-        # get the fields from the StockPriceHistory model to display on the stock detail page's graphs
-        if price_history_record and price_history_record.price_history:
-            price_history = [
-                float(price.strip()) for price in price_history_record.price_history.strip("[]").split(",")
-            ]
-            hours = [f"{hour}:00" for hour in range(1, len(price_history) + 1)]
-            line_color = 'rgb(0, 200, 5)' if price_history[-1] > price_history[0] else 'rgb(255, 80, 0)'
-
-            price_chart = px.line(
-                x=hours,
-                y=price_history,
-                labels={"x": "Hour", "y": "Price ($)"},
-                title=f"{stock.company_name} ({stock.ticker}) - 12-Hour Price History",
-            )
-            price_chart.update_traces(
-                mode="lines+markers",
-                line=dict(color=line_color),
-            )
-            price_chart.update_layout(
-                width=900,
-                height=600,
-                # plot_bgcolor="rgba(30, 30, 30, 1)",
-                title_font=dict(size=18),
-                xaxis_title_font=dict(size=14),
-                yaxis_title_font=dict(size=14),
-            )
+        price_history_record = StockPriceHistory.objects.filter(stock=stock).order_by('-date').first()
 
-            # add the fields to the context
+        # the day's summary fields come from the StockPriceHistory record
+        if price_history_record:
             context['open_price'] = price_history_record.open_price
             context['close_price'] = price_history_record.close_price
             context['region'] = price_history_record.region
             context['type'] = price_history_record.type
-            context['price_chart'] = to_html(price_chart, full_html=False)
-            context['max_price'] = max(price_history)
-            context['min_price'] = min(price_history)
             context['diff'] = context['close_price'] - context['open_price']
 
+        # in client mode the page fetches the series endpoint and draws the graph itself
+        context['chart_mode'] = self.request.GET.get('chart') or chart_render_mode()
+        if context['chart_mode'] != 'client':
+            # the graph is built from the latest bars, downsampled and cached until new prices land
+            price_chart = get_price_chart(stock)
+            if price_chart:
+                context['price_chart'] = price_chart['html']
+                context['max_price'] = price_chart['max_price']
+                context['min_price'] = price_chart['min_price']
+
+        # indicators are precomputed by the compute_indicators command, this is a single row read
+        context['indicators'] = StockIndicators.objects.filter(stock=stock).first()
+
         if self.request.user.is_authenticated:
-            user_profile = UserProfile.objects.get(user=self.request.user)
+            user_profile = get_user_profile(self.request)
             portfolio_item = Portfolio.objects.filter(user=user_profile, stock=stock).first()
             context['shares_owned'] = portfolio_item.shares if portfolio_item else 0
         else:
@@ -316,14 +548,180 @@ class StockDetailView(LoginRequiredMixin, DetailView):
         return context
 
 
-class StockListView(LoginRequiredMixin, ListView):
+def _series_points(request):
+    """
+        return the number of points requested with ?points=, capped at CHART_MAX_POINTS
+    """
+    try:
+        return max(3, min(int(request.GET['points']), chart_max_points()))
+    except (KeyError, ValueError):
+        return chart_max_points()
+
+
+def _series_etag(request, pk):
+    """
+        the series only changes with the stock's price version and names, so no query is needed
+    """
+    return f'"{pk}-{get_price_version(pk)}-{get_search_version()}-{_series_points(request)}"'
+
+
+def _series_last_modified(request, pk):
+    """
+        return when the stock's prices last changed
+    """
+    return get_price_last_modified(pk)
+
+
+@method_decorator(condition(etag_func=_series_etag, last_modified_func=_series_last_modified), name='get')
+class StockSeriesView(View):
+    """
+        JSON chart data for a stock, conditional GETs are answered with 304 without touching the database
+
+        prices are public market data, so the endpoint is open and may be cached by browsers and CDNs
+    """
+    def get(self, request, pk):
+        """
+            return the compact price series of the stock
+        """
+        series = get_price_series(pk, _series_points(request))
+        if series is None:
+            raise Http404("No stock matches the given query.")
+
+        response = JsonResponse(series, json_dumps_params={'separators': (',', ':')})
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'CHART_SERIES_MAX_AGE', 5))
+        return response
+
+
+class PriceStreamView(View):
+    """
+        Server-Sent Events stream of the prices of the stocks in the user's watchlist and portfolio
+
+        ?source=watchlist or ?source=portfolio limits it to one of them, ?tickers=A,B to some tickers
+    """
+    async def get(self, request):
+        """
+            send the current prices, then keep the connection open and push the changes (ASGI only)
+        """
+        user = await request.auser()
+        if not user.is_authenticated:
+            raise PermissionDenied
+
+        source = request.GET.get('source', 'all')
+        stock_ids = set()
+        if source in ('all', 'watchlist'):
+            stock_ids.update([pk async for pk in WatchList.objects.filter(user__user=user).values_list('stock_id', flat=True)])
+        if source in ('all', 'portfolio'):
+            stock_ids.update([pk async for pk in Portfolio.objects.filter(user__user=user).values_list('stock_id', flat=True)])
+
+        stocks = Stock.objects.filter(pk__in=stock_ids)
+        if request.GET.get('tickers'):
+            stocks = stocks.filter(ticker__in=[ticker.strip().upper() for ticker in request.GET['tickers'].split(',')])
+        rows = [row async for row in stocks.values_list('pk', 'ticker', 'current_price')]
+        snapshot = [{'ticker': ticker, 'price': str(price)} for _, ticker, price in rows]
+
+        if not isinstance(request, ASGIRequest):
+            # a WSGI worker can't hold the connection, the browser polls again after the retry delay
+            body = f"retry: {int(stream_retry() * 1000)}\n\n" + sse_event('prices', snapshot)
+            response = HttpResponse(body, content_type='text/event-stream')
+        else:
+            subscription = hub.subscribe(pk for pk, _, _ in rows)
+            response = StreamingHttpResponse(price_events(subscription, snapshot), content_type='text/event-stream')
+            response['X-Accel-Buffering'] = 'no'
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class ProfilingStatsView(UserPassesTestMixin, View):
     """
-        Displays all stocks
+        Rolling request timings collected by ProfilingMiddleware, for staff only
+    """
+    raise_exception = True
+
+
+    def test_func(self):
+        """
+            only staff can see the stats
+        """
+        return self.request.user.is_staff
+
+
+    def get(self, request):
+        """
+            return the stats of this process as JSON, ?clear=1 starts a new window
+        """
+        snapshot = profiling_stats.snapshot()
+        if request.GET.get('clear') == '1':
+            profiling_stats.clear()
+        return JsonResponse(snapshot)
+
+
+class StockListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
+    """
+        Displays all stocks, a page at a time in ticker order
     """
     model = Stock
-    template_name = 'wt_scrooge_capital/all_stocks.html'
+    template_name = 'wt_scrooge_capital/stock_list.html'
     context_object_name = 'stocks'
-    paginate_by = 3  # number of stocks per page
+    keyset_ordering = ['ticker']
+    page_size = 3  # number of stocks per page
+    serialize_fields = ['id', 'ticker', 'company_name', 'current_price']
+
+
+    def get_queryset(self):
+        """
+            gets the requested page of stocks
+        """
+        return self.paginate_keyset(Stock.objects.all())
+
+
+    def get_context_data(self, **kwargs):
+        """
+            add the versions the cached cards are keyed by
+        """
+        context = super().get_context_data(**kwargs)
+        context['fragment_timeout'] = fragment_timeout()
+        context['fragment_version'] = stock_list_fragment_version()
+        context['form_version'] = form_fragment_version(self.request)
+        return context
+
+
+class StockSearchView(View):
+    """
+        JSON typeahead search over tickers and company names, ?q=app&limit=10
+
+        the listing is public, so the endpoint is open and answers may be cached for a short while
+    """
+    def get(self, request):
+        """
+            return the best matching stocks, best first
+        """
+        try:
+            limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+        results = stock_search.search(request.GET.get('q', '')[:64], limit)
+        response = JsonResponse({'results': results})
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'STOCK_SEARCH_MAX_AGE', 60))
+        return response
+
+
+class ScreenerView(LoginRequiredMixin, View):
+    """
+        JSON screen of every stock by its latest metrics, e.g. ?change__gt=0.05&region=United States&sort=-change
+    """
+    raise_exception = True
+
+
+    def get(self, request, *args, **kwargs):
+        """
+            return the number of matching stocks and the first `limit` of them in `sort` order
+        """
+        try:
+            limit = min(max(int(request.GET.get('limit', 50)), 1), getattr(settings, 'SCREENER_MAX_LIMIT', 500))
+            count, results = screener.screen(parse_filters(request.GET), request.GET.get('sort'), limit)
+        except (ScreenError, ValueError) as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        return JsonResponse({'count': count, 'results': results})
 
 
 class RemoveFromWatchlistView(LoginRequiredMixin, View):
@@ -334,7 +732,7 @@ class RemoveFromWatchlistView(LoginRequiredMixin, View):
         """
             method for removing an item from the watchlist
         """
-        user_profile = UserProfile.objects.get(user=request.user)
+        user_profile = get_user_profile(request)
         watchlist_item = get_object_or_404(WatchList, pk=pk, user=user_profile)
         watchlist_item.delete()
         return HttpResponseRedirect(reverse('watchlist'))
@@ -348,15 +746,13 @@ class AddToWatchlistView(LoginRequiredMixin, View):
         """
             method for adding a stock to the watchlist
         """
-        user_profile = UserProfile.objects.get(user=request.user)
+        user_profile = get_user_profile(request)
         stock = get_object_or_404(Stock, id=stock_id)
 
-        # check if the stock is already in the user's watchlist, if not then add it
-        if not WatchList.objects.filter(user=user_profile, stock=stock).exists():
-            WatchList.objects.create(
-                user=user_profile,
-                stock=stock,
-                added_price=stock.current_price,
-                current_price=stock.current_price
-            )
+        # add the stock unless it's already in the user's watchlist, the unique constraint settles races
+        WatchList.objects.get_or_create(
+            user=user_profile,
+            stock=stock,
+            defaults={'added_price': stock.current_price, 'current_price': stock.current_price},
+        )
         return redirect(reverse('stock_list'))
\ No newline at end of file